@@ -11,9 +11,9 @@
     'support': 'info@moeindp.ir',
     'description': """Behpardakht Payment Acquirer""",
     #'depends': ['payment_iran'],
-    'depends': ['payment'],
+    'depends': ['l10n_ir_payment'],
     'external_dependencies': {
-        'python': ['urllib3', 'zeep'],
+        'python': ['requests', 'urllib3', 'zeep'],
     },
     'data': [
         # Views
@@ -22,6 +22,7 @@
         'views/payment_behpardakht_templates.xml',
         # Data
         'data/payment_acquirer_data.xml',
+        'data/payment_behpardakht_cron.xml',
     ],
     'post_init_hook': 'create_missing_journal_for_acquirers',
     'uninstall_hook': 'uninstall_hook',
@@ -1,36 +1,56 @@
 # -*- coding: utf-8 -*-
 
-import logging
-import pprint
-
 import werkzeug
 
 from odoo import http, _
+from odoo.addons.l10n_ir_payment import deadline, eventlog
+from odoo.addons.l10n_ir_payment.controllers.main import render_pay_retry
+from odoo.addons.l10n_ir_payment.gateway import RetryLater
 from odoo.addons.payment.models.payment_acquirer import ValidationError
 from odoo.http import request
 
-_logger = logging.getLogger(__name__)
+_logger = eventlog.getLogger(__name__, 'behpardakht')
 
 
 class BehpardakhtController(http.Controller):
     _accept_url = '/payment/behpardakht/accept'
+    _pay_url = '/payment/behpardakht/pay'
 
     @staticmethod
     def behpardakht_validate_data(**post):
         """ Behpardakht contacts using GET, at least for accept """
-        _logger.info('Behpardakht: entering form_feedback with post data %s', pprint.pformat(post))  # debug
-        RefId = post.get('RefId')
-        tx = None
-        if RefId:
-            tx = request.env['payment.transaction'].sudo().search([('behpardakht_refid', '=', RefId)])
-
-        res = request.env['payment.transaction'].sudo().form_feedback(post, 'behpardakht')
-        _logger.info('Behpardakht: validated data')
-        if not res and tx:
+        # resolve the transaction once, form_feedback reuses it instead of searching again
+        tx = request.env['payment.transaction'].sudo()._behpardakht_form_get_tx_from_data(post)
+
+        res = tx.form_feedback(post, 'behpardakht')
+        _logger.info('callback.validated', tx=tx.reference, res_code=post.get('ResCode'), result=bool(res), sample=True)
+        if not res:
             tx._set_transaction_error(_('Validation error occured. Please contact your administrator.'))
 
         return res
 
+    @http.route([_pay_url], type='http', auth='public', methods=['GET', 'POST'], csrf=False)
+    def behpardakht_pay(self, reference=None, token=None, **post):
+        """ The customer submitted the payment form: ask Mellat for a RefId, or reuse the one already issued for
+        the transaction, and post it to the payment page of the bank. """
+        tx = request.env['payment.transaction'].sudo()._ir_get_pay_tx('behpardakht', reference, token)
+        if not tx or tx.state != 'draft':
+            return werkzeug.utils.redirect('/payment/process')
+        try:
+            with request.env['payment.profile'].sudo()._ir_profile('pay', 'behpardakht'), deadline.request_scope():
+                ref_id = tx._behpardakht_issue_refid()
+        except RetryLater as e:
+            # nothing was refused: the customer may submit the same payment again
+            return render_pay_retry(tx, e.args[0])
+        except ValidationError as e:
+            _logger.warning('pay.failed', tx=tx.reference, error=e.args[0])
+            tx._set_transaction_error(e.args[0])
+            return werkzeug.utils.redirect('/payment/process')
+        return request.render('payment_behpardakht.behpardakht_redirect', {
+            'tx_url': tx.acquirer_id.behpardakht_get_form_action_url(),
+            'RefId': ref_id,
+        })
+
     @http.route([_accept_url], type='http', auth='public', methods=['POST'], csrf=False, save_session=False)
     def behpardakht_form_feedback(self, **post):
         """
@@ -40,10 +60,13 @@ class BehpardakhtController(http.Controller):
         create a new session cookie. Therefore, the previous session and all related information will be lost, so it
         will lead to undesirable behaviors. This is the reason why `save_session=False` is needed.
         """
-        _logger.info('Behpardakht IPN form_feedback with post data %s', pprint.pformat(post))  # debug
+        _logger.info('callback.received', payload=post, remote_addr=request.httprequest.remote_addr, audit=True, sample=True)
         try:
-            self.behpardakht_validate_data(**post)
+            # the budget of the callback, set on the acquirer, counts from here
+            with request.env['payment.profile'].sudo()._ir_profile('callback', 'behpardakht'), \
+                    deadline.request_scope():
+                self.behpardakht_validate_data(**post)
         except ValidationError:
-            _logger.exception('Unable to validate the Paypal payment')
+            _logger.exception('callback.invalid', ref_id=post.get('RefId'))
 
         return werkzeug.utils.redirect('/payment/process')
@@ -1,17 +1,26 @@
 # coding: utf-8
 
 import datetime
-import logging
-
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+from odoo.addons.l10n_ir_payment import eventlog, gateway
+from odoo.addons.l10n_ir_payment.circuit import GatewayUnavailable
+from odoo.addons.l10n_ir_payment.gateway import DeadlineExceeded, RetryLater
+from odoo.addons.l10n_ir_payment.ratelimit import RateLimited
+from odoo.addons.l10n_ir_payment.snapshot import AcquirerSnapshot
 from odoo.addons.payment_behpardakht.controllers.main import BehpardakhtController
+from odoo.addons.payment_behpardakht import soap_client
+from odoo.addons.payment_behpardakht.soap_client import DEFAULT_CLIENT_TTL, DEFAULT_TIMEOUT, client_cache
 from werkzeug import urls
 
-from zeep import Client
-
-from odoo import api, fields, models, _
+from odoo import api, fields, models, tools, _
 from odoo.addons.payment.models.payment_acquirer import ValidationError
 
-_logger = logging.getLogger(__name__)
+_logger = eventlog.getLogger(__name__, 'behpardakht')
 
 BEHPARDAKHT_ERROR_MAP = {
     '0': _('Transaction Approved'),
@@ -61,6 +70,22 @@ BEHPARDAKHT_ERROR_MAP = {
     '61': _('Error In Settle'),
 }
 
+# gateway methods, as reported in the metrics
+BEHPARDAKHT_METHODS = {
+    'bpPayRequest': 'request',
+    'bpVerifyRequest': 'verify',
+    'bpSettleRequest': 'settle',
+    'bpInquiryRequest': 'inquiry',
+    'bpReversalRequest': 'reversal',
+}
+
+
+class BehpardakhtSnapshot(AcquirerSnapshot):
+    __slots__ = (
+        'environment', 'wsdl_url', 'order_url', 'wsdl', 'client_ttl', 'cache_path', 'timeout', 'callback_url',
+        'async_validation', 'settle_mode',
+    )
+
 
 class AcquirerBehpardakht(models.Model):
     _inherit = 'payment.acquirer'
@@ -69,6 +94,127 @@ class AcquirerBehpardakht(models.Model):
     bp_terminal_id = fields.Integer(string='Terminal Id', required_if_provider='behpardakht', help='Merchant Terminal ID', groups='base.group_user')
     bp_username = fields.Char(string='Merchant Username', required_if_provider='behpardakht', groups='base.group_user')
     bp_password = fields.Char(string='Merchant Password', required_if_provider='behpardakht', groups='base.group_user')
+    bp_wsdl_url = fields.Char(
+        string='Gateway WSDL URL', groups='base.group_user',
+        help='Overrides the WSDL url of the gateway, e.g. to point to a local stand-in server. '
+             'Leave empty to use the bank servers.')
+    bp_order_url = fields.Char(
+        string='Gateway Payment Page URL', groups='base.group_user',
+        help='Overrides the url customers are sent to for paying. Leave empty to use the bank servers.')
+    bp_wsdl_location = fields.Char(
+        string='Local WSDL File', groups='base.group_user',
+        help='Path of a local copy of the gateway WSDL. When set, workers load the service definition from this '
+             'file instead of fetching it from the bank.')
+    bp_client_ttl = fields.Integer(
+        string='SOAP Client Lifetime', default=DEFAULT_CLIENT_TTL, groups='base.group_user',
+        help='Number of seconds a parsed WSDL client is reused by a worker before being rebuilt. 0 disables the cache.')
+    bp_timeout = fields.Float(
+        string='Gateway Timeout', default=DEFAULT_TIMEOUT, groups='base.group_user',
+        help='Seconds to wait for the bank to answer a gateway call.')
+    bp_wsdl_disk_cache = fields.Boolean(
+        string='Cache WSDL On Disk', default=True, groups='base.group_user',
+        help='Keep the fetched WSDL and schema documents in the data directory so that new workers do not '
+             'download them again.')
+    bp_async_validation = fields.Boolean(
+        string='Validate Payments In Background', groups='base.group_user',
+        help='Record the bank callback and redirect the customer right away. Verification and settlement are '
+             'then performed by a scheduled action.')
+    bp_async_concurrency = fields.Integer(
+        string='Background Concurrency', default=4, groups='base.group_user',
+        help='Maximum number of simultaneous gateway calls made by the background validation and the reconciliation.')
+    bp_async_max_attempts = fields.Integer(
+        string='Background Attempts', default=5, groups='base.group_user',
+        help='Number of times the background validation retries a payment the bank could not be reached for.')
+    bp_settle_mode = fields.Selection([
+        ('inline', 'Right After Verification'),
+        ('deferred', 'Scheduled Batches'),
+    ], string='Settlement', default='inline', required=True, groups='base.group_user',
+        help='Scheduled batches leave verified payments authorized and settle them from a scheduled action.')
+    bp_settle_workers = fields.Integer(
+        string='Settlement Parallelism', default=4, groups='base.group_user',
+        help='Number of settlement requests sent to the bank at the same time.')
+    bp_settle_batch_size = fields.Integer(
+        string='Settlement Batch Size', default=100, groups='base.group_user',
+        help='Maximum number of payments settled by each run of the scheduled action.')
+    bp_settle_deadline = fields.Integer(
+        string='Settlement Deadline', default=12, groups='base.group_user',
+        help='Hours after verification after which a payment that could not be settled is reversed.')
+    bp_reconcile_after = fields.Integer(
+        string='Reconcile After', default=60, groups='base.group_user',
+        help='Minutes after its RefId expired after which a payment still waiting for its callback, or after '
+             'which a payment whose background validation has not progressed, is checked by the reconciliation.')
+
+    def _register_hook(self):
+        """ Pre-load the SOAP stack and the WSDL of the Behpardakht acquirers when the server configuration
+        sets ``behpardakht_prewarm = True``.
+
+        The SOAP stack is otherwise only imported by the first gateway call. Pre-loading it when the registry is
+        built by the prefork server means it is imported once, before the workers are forked, and the first
+        checkout of each worker does not wait for it.
+        """
+        super(AcquirerBehpardakht, self)._register_hook()
+        if not tools.str2bool(tools.config.get('behpardakht_prewarm') or '0', False):
+            return
+        _logger.info('soap.loaded', duration='%.3fs' % soap_client.load_soap_stack())
+        acquirers = self.sudo().search([('provider', '=', 'behpardakht'), ('state', '!=', 'disabled')])
+        configs = [acquirer._ir_snapshot() for acquirer in acquirers]
+        clients = [
+            (config.wsdl, config.environment, config.client_ttl, config.cache_path, config.timeout)
+            for config in configs
+        ]
+        if clients:
+            # fetching the WSDL must not delay the server start; with the disk cache enabled, workers forked
+            # afterwards find the documents there even though they rebuild their own clients
+            threading.Thread(target=self._behpardakht_prewarm_clients, args=(clients,),
+                             name='behpardakht-prewarm', daemon=True).start()
+
+    @staticmethod
+    def _behpardakht_prewarm_clients(clients):
+        for wsdl, environment, ttl, cache_path, timeout in clients:
+            try:
+                client_cache.get(wsdl, environment, ttl=ttl, cache_path=cache_path, timeout=timeout)
+            except Exception as e:
+                _logger.warning('wsdl.prewarm_failed', wsdl=wsdl, error=e)
+
+    def _ir_rate_limit_key(self):
+        if self.provider != 'behpardakht':
+            return super(AcquirerBehpardakht, self)._ir_rate_limit_key()
+        # Mellat throttles per terminal
+        return 'behpardakht:%s' % self.bp_terminal_id
+
+    def _ir_gateway_params(self):
+        if self.provider != 'behpardakht':
+            return super(AcquirerBehpardakht, self)._ir_gateway_params()
+        return dict(terminalId=self.bp_terminal_id, userName=self.bp_username, userPassword=self.bp_password)
+
+    def _ir_snapshot_class(self):
+        if self.provider != 'behpardakht':
+            return super(AcquirerBehpardakht, self)._ir_snapshot_class()
+        return BehpardakhtSnapshot
+
+    def _ir_snapshot_fields(self):
+        return super(AcquirerBehpardakht, self)._ir_snapshot_fields() | {name for name in self._fields if name.startswith('bp_')}
+
+    def _ir_snapshot_values(self):
+        values = super(AcquirerBehpardakht, self)._ir_snapshot_values()
+        if self.provider != 'behpardakht':
+            return values
+        environment = self._behpardakht_get_environment()
+        default_urls = self._get_behpardakht_urls(environment)
+        wsdl_url = self.bp_wsdl_url or default_urls['behpardakht_wsdl_url']
+        values.update(
+            environment=environment,
+            wsdl_url=wsdl_url,
+            order_url=self.bp_order_url or default_urls['behpardakht_order_url'],
+            wsdl=self.bp_wsdl_location or wsdl_url,
+            client_ttl=self.bp_client_ttl,
+            cache_path=self._behpardakht_get_wsdl_cache_path(),
+            timeout=self.bp_timeout or DEFAULT_TIMEOUT,
+            callback_url=urls.url_join(values['base_url'], BehpardakhtController._accept_url),
+            async_validation=self.bp_async_validation,
+            settle_mode=self.bp_settle_mode,
+        )
+        return values
 
     def _get_behpardakht_urls(self, environment):
         """ Behpardakht URLS """
@@ -83,23 +229,63 @@ class AcquirerBehpardakht(models.Model):
                 'behpardakht_order_url': 'https://banktest.ir/gateway/pgw.bpm.bankmellat.ir/pgwchannel/startpay.mellat',
             }
 
-    def _bp_request(self, params, method):
+    def _behpardakht_get_environment(self):
+        self.ensure_one()
+        return 'prod' if self.state == 'enabled' else 'test'
+
+    def _behpardakht_get_wsdl_location(self):
+        self.ensure_one()
+        return self._ir_snapshot().wsdl
+
+    def _behpardakht_get_wsdl_cache_path(self):
+        self.ensure_one()
+        if not self.bp_wsdl_disk_cache:
+            return None
+        return os.path.join(tools.config['data_dir'], 'behpardakht', 'wsdl_cache.db')
+
+    def _behpardakht_get_client(self):
+        self.ensure_one()
+        config = self._ir_snapshot()
+        return client_cache.get(
+            config.wsdl, config.environment, ttl=config.client_ttl, cache_path=config.cache_path, timeout=config.timeout)
+
+    def _behpardakht_get_credentials(self, credential=None):
+        """ Terminal parameters of the gateway calls made with ``credential``, or with the acquirer itself. """
+        self.ensure_one()
+        return dict(self._ir_snapshot().get_params(credential.id if credential else None))
+
+    def _behpardakht_gateway_call(self, method, credential=None):
+        """ Return the :class:`~odoo.addons.payment_behpardakht.soap_client.MellatCall` performing the ``method``
+        operation for this acquirer, with the terminal of ``credential`` when given. The call does not use the ORM,
+        so it may be sent from a worker thread or in a batch. """
+        self.ensure_one()
+        config = self._ir_snapshot()
+        return soap_client.MellatCall(
+            BEHPARDAKHT_METHODS.get(method, method), method,
+            credentials=self._behpardakht_get_credentials(credential),
+            wsdl=config.wsdl,
+            environment=config.environment,
+            ttl=config.client_ttl,
+            cache_path=config.cache_path,
+            timeout=config.timeout,
+            scope=self._ir_metrics_scope(),
+            guard=self._ir_circuit_guard(),
+            limiter=self._ir_rate_limiter(credential),
+            tracker=self._ir_credential_tracker(credential),
+            journal=self._ir_gateway_journal(),
+        )
+
+    def _bp_request(self, params, method, credential=None):
         try:
-            params.update({
-                'terminalId': self.bp_terminal_id,
-                'userName': self.bp_username,
-                'userPassword': self.bp_password,
-            })
-
-            WSDL_link = self.behpardakht_get_wsdl_url()
-            client = Client(WSDL_link)
             # BPM PGW Method Call
-            response = getattr(client.service, method)(**params)
+            return self._behpardakht_gateway_call(method, credential).send(params)
+        except (GatewayUnavailable, RateLimited, DeadlineExceeded) as e:
+            # Mellat Bank is known to be down or busy, or the request is out of time: fail fast
+            _logger.warning('call.skipped', method=method, reason=e)
         except Exception as e:
             # Error connecting to Mellat Bank
-            _logger.exception(str(e))  # debug
-            response = None
-        return response
+            _logger.exception('call.failed', method=method, error=e)
+        return None
 
     def _bp_default_params(self, params):
         return dict(
@@ -109,7 +295,7 @@ class AcquirerBehpardakht(models.Model):
         )
 
     # bpPayRequest call for Mallat gateway
-    def pay_request(self, params={}):
+    def pay_request(self, params={}, credential=None):
         data = dict(
             orderId=params['orderId'],
             amount=params['amount'],
@@ -119,90 +305,152 @@ class AcquirerBehpardakht(models.Model):
             callBackUrl=params['callBackUrl'],
             payerId=params['payerId']
         )
-        return self._bp_request(data, 'bpPayRequest')
+        return self._bp_request(data, 'bpPayRequest', credential)
 
     # bpVerifyRequest call for Mallat gateway
-    def verify_request(self, params):
-        return self._bp_request(self._bp_default_params(params), 'bpVerifyRequest')
+    def verify_request(self, params, credential=None):
+        return self._bp_request(self._bp_default_params(params), 'bpVerifyRequest', credential)
 
     # bpSettleRequest call for Mallat gateway
-    def settle_request(self, params):
-        return self._bp_request(self._bp_default_params(params), 'bpSettleRequest')
+    def settle_request(self, params, credential=None):
+        return self._bp_request(self._bp_default_params(params), 'bpSettleRequest', credential)
 
     # bpInquiryRequest call for Mallat gateway
-    def inquiry_request(self, params):
-        return self._bp_request(self._bp_default_params(params), 'bpInquiryRequest')
+    def inquiry_request(self, params, credential=None):
+        return self._bp_request(self._bp_default_params(params), 'bpInquiryRequest', credential)
 
     # bpReversalRequest call for Mallat gateway
-    def reversal_request(self, params):
-        return self._bp_request(self._bp_default_params(params), 'bpReversalRequest')
+    def reversal_request(self, params, credential=None):
+        return self._bp_request(self._bp_default_params(params), 'bpReversalRequest', credential)
+
+    def _behpardakht_get_amount(self, amount, currency, reference=None):
+        """ Return ``amount`` in rials, as Mellat expects it. """
+        if currency.name == 'IRR':
+            return int(amount)
+        elif currency.name == 'IRT':
+            return int(amount) * 10
+        _logger.info('pay.invalid_currency', reference=reference, currency=currency.name)
+        raise ValidationError('Currency: data error: Invalid Currency')
+
+    def _ir_pay_route(self):
+        if self.provider != 'behpardakht':
+            return super(AcquirerBehpardakht, self)._ir_pay_route()
+        return BehpardakhtController._pay_url
 
     def behpardakht_form_generate_values(self, values):
-        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+        self._ir_check_circuit()
+        # the RefId is only asked for when the customer submits the form, see _behpardakht_issue_refid
+        self._behpardakht_get_amount(values.get('amount'), values.get('currency'), values.get('reference'))
+        return dict(values)
 
-        behpardakht_tx_values = dict(values)
+    def behpardakht_get_wsdl_url(self):
+        self.ensure_one()
+        return self._ir_snapshot().wsdl_url
 
-        order_reference = values.get('reference')
-        additionalData = _('Customer Info: partner_id (%s), partner_name (%s)') % (values.get('partner_id'), values.get('partner_name'))
-        transaction = self.env['payment.transaction'].search([('reference', '=', order_reference), ('state', '=', 'draft')], limit=1)
+    def behpardakht_get_form_action_url(self):
+        self.ensure_one()
+        return self._ir_snapshot().order_url
 
-        currency_obj = values.get('currency')
-        amount_value = int(values.get('amount'))
-        if currency_obj.name == 'IRR':
-            amount = amount_value
-        elif currency_obj.name == 'IRT':
-            amount = amount_value * 10
-        else:
-            error_msg = 'Currency: data error: Invalid Currency'
-            _logger.info(error_msg)  # debug
-            raise ValidationError(error_msg)
 
-        data = {
-            'orderId': transaction.id,
-            'amount': amount,
-            'localDate': datetime.datetime.now().strftime('%Y%m%d'),
-            'localTime': datetime.datetime.now().strftime('%H%M%S'),
-            'additionalData': additionalData,
-            'callBackUrl': urls.url_join(base_url, BehpardakhtController._accept_url),
-            'payerId': 0,
-        }
-        # Pay Request Method Call
-        result = self.pay_request(data)
-        if result is not None:
-            result_list = result.split(',')
-            if result_list[0] == '0':
-                temp_behpardakht_tx_values = {'RefId': result_list[1]}
-                behpardakht_tx_values.update(temp_behpardakht_tx_values)
-                self.env['payment.transaction'].sudo()._behpardakht_set_tx_RefId(values.get('reference'), result_list[1])
-            else:
-                error_msg = _('Behpardakht: feedback error: ') + BEHPARDAKHT_ERROR_MAP.get(result_list[0])
-                _logger.info(error_msg)  # debug
-                raise ValidationError(error_msg)
+class BehpardakhtCredential(models.Model):
+    _inherit = 'payment.acquirer.credential'
 
-        return behpardakht_tx_values
+    bp_terminal_id = fields.Integer(string='Terminal Id', groups='base.group_system')
+    bp_username = fields.Char(string='Merchant Username', groups='base.group_system')
+    bp_password = fields.Char(string='Merchant Password', groups='base.group_system')
 
-    def behpardakht_get_wsdl_url(self):
-        self.ensure_one()
-        environment = 'prod' if self.state == 'enabled' else 'test'
-        return self._get_behpardakht_urls(environment)['behpardakht_wsdl_url']
+    def _ir_rate_limit_key(self):
+        if self.provider != 'behpardakht':
+            return super(BehpardakhtCredential, self)._ir_rate_limit_key()
+        return 'behpardakht:%s' % self.bp_terminal_id
 
-    def behpardakht_get_form_action_url(self):
-        self.ensure_one()
-        environment = 'prod' if self.state == 'enabled' else 'test'
-        return self._get_behpardakht_urls(environment)['behpardakht_order_url']
+    def _ir_gateway_params(self):
+        if self.provider != 'behpardakht':
+            return super(BehpardakhtCredential, self)._ir_gateway_params()
+        return dict(terminalId=self.bp_terminal_id, userName=self.bp_username, userPassword=self.bp_password)
 
 
 class PaymentTxBehpardakht(models.Model):
     _inherit = 'payment.transaction'
 
     behpardakht_refid = fields.Char(string='Behpardakht Reference Id', readonly=True, help='Reference of the TX as stored in the acquirer database')
+    behpardakht_refid_expiry = fields.Datetime(string='Behpardakht Reference Id Expiry', readonly=True, copy=False)
+    behpardakht_refid_amount = fields.Float(string='Behpardakht Reference Id Amount', readonly=True, copy=False)
+    behpardakht_sale_reference_id = fields.Char(string='Behpardakht Sale Reference Id', readonly=True, copy=False)
+    behpardakht_callback_data = fields.Text(string='Behpardakht Callback Data', readonly=True, copy=False)
+    behpardakht_async_state = fields.Selection([
+        ('queued', 'Queued'),
+        ('verified', 'Verified'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='Behpardakht Background State', readonly=True, copy=False, index=True)
+    behpardakht_async_attempts = fields.Integer(string='Behpardakht Background Attempts', readonly=True, copy=False)
+    behpardakht_async_next_date = fields.Datetime(string='Behpardakht Next Attempt', readonly=True, copy=False)
+    behpardakht_settle_state = fields.Selection([
+        ('pending', 'Awaiting Settlement'),
+        ('done', 'Settled'),
+        ('reversed', 'Reversed'),
+        ('failed', 'Failed'),
+    ], string='Behpardakht Settlement', readonly=True, copy=False, index=True)
+    behpardakht_settle_attempts = fields.Integer(string='Behpardakht Settlement Attempts', readonly=True, copy=False)
+    behpardakht_verified_date = fields.Datetime(string='Behpardakht Verification Date', readonly=True, copy=False)
+
+    def init(self):
+        super(PaymentTxBehpardakht, self).init()
+        # callbacks look transactions up by RefId, which only Behpardakht transactions have
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS payment_transaction_behpardakht_refid_index
+            ON payment_transaction (behpardakht_refid)
+            WHERE behpardakht_refid IS NOT NULL
+        """)
+
+    def _behpardakht_issue_refid(self):
+        """ Return the RefId the customer pays this transaction with: the one already issued while it is valid
+        for the amount, a new one otherwise.
+
+            :raise RetryLater: when Mellat could not be reached
+            :raise ValidationError: when Mellat refused to issue a RefId
+        """
+        self.ensure_one()
+        self._ir_lock_token()
+        acquirer = self.acquirer_id
+        scope = acquirer._ir_metrics_scope()
+        if self.behpardakht_refid:
+            if self._ir_token_usable(self.behpardakht_refid_expiry, self.behpardakht_refid_amount):
+                scope.event('token', 'reused')
+                return self.behpardakht_refid
+            # Mellat refuses a second bpPayRequest with the same orderId (41: Duplicate Order Id)
+            scope.event('token', 'expired')
+            raise ValidationError(_('Behpardakht: the payment session has expired, please start the payment again.'))
 
-    @api.model
-    def _behpardakht_set_tx_RefId(self, reference, RefId):
-        tx = self.search([('reference', '=', reference)])
-        if tx:
-            tx.behpardakht_refid = RefId
-        return
+        data = {
+            'orderId': self.id,
+            'amount': acquirer._behpardakht_get_amount(self.amount, self.currency_id, self.reference),
+            'localDate': datetime.datetime.now().strftime('%Y%m%d'),
+            'localTime': datetime.datetime.now().strftime('%H%M%S'),
+            'additionalData': _('Customer Info: partner_id (%s), partner_name (%s)') % (self.partner_id.id, self.partner_name),
+            'callBackUrl': acquirer._ir_snapshot().callback_url,
+            'payerId': 0,
+        }
+        # spread the payments over the terminals of the acquirer; the callback is verified with the same one
+        credential = acquirer._ir_select_credential()
+        # Pay Request Method Call
+        with acquirer._ir_deadline('checkout'):
+            result = acquirer.pay_request(data, credential)
+        if result is None:
+            raise RetryLater(_('Behpardakht: the bank gateway could not be reached, please try again later.'))
+        result_list = result.split(',')
+        if result_list[0] != '0':
+            _logger.info('pay.rejected', reference=self.reference, status=result_list[0])
+            raise ValidationError(_('Behpardakht: feedback error: ') + BEHPARDAKHT_ERROR_MAP.get(result_list[0], result_list[0]))
+        self.write({
+            'credential_id': credential.id,
+            'behpardakht_refid': result_list[1],
+            'behpardakht_refid_expiry': self._ir_token_expiry(),
+            'behpardakht_refid_amount': self.amount,
+        })
+        scope.event('token', 'issued')
+        return self.behpardakht_refid
 
     def _behpardakht_form_get_invalid_parameters(self, data):
         invalid_parameters = []
@@ -220,10 +468,14 @@ class PaymentTxBehpardakht(models.Model):
 
         if not SaleOrderId or not ResCode or not RefId:
             error_msg = 'Behpardakht: received data with missing SaleOrderId (%s) or RefId (%s) or ResCode (%s)' % (SaleOrderId, RefId, ResCode)
-            _logger.info(error_msg)
+            _logger.info('callback.incomplete', sale_order_id=SaleOrderId, ref_id=RefId, res_code=ResCode)
             raise ValidationError(error_msg)
 
-        tx = self.env['payment.transaction'].search([('behpardakht_refid', '=', RefId)])
+        if len(self) == 1 and self.behpardakht_refid == RefId:
+            # already resolved by the controller
+            return self
+
+        tx = self.env['payment.transaction'].search([('behpardakht_refid', '=', RefId)], limit=2)
         if not tx or len(tx) > 1:
             error_msg = 'Behpardakht: received data for reference %s' % RefId
             if not tx:
@@ -231,47 +483,405 @@ class PaymentTxBehpardakht(models.Model):
             else:
                 error_msg += '; multiple order found'
 
-            _logger.info(error_msg)
+            _logger.info('callback.unknown_tx', ref_id=RefId, found=len(tx))
             raise ValidationError(error_msg)
 
         return tx
 
-    def _behpardakht_form_validate(self, data):
-        status = data.get('ResCode', None)
+    def _ir_notifies_state(self):
+        if self.provider != 'behpardakht':
+            return super(PaymentTxBehpardakht, self)._ir_notifies_state()
+        return True
+
+    @staticmethod
+    def _behpardakht_get_status(result):
+        return result.split(',')[0] if result is not None else None
+
+    def _behpardakht_get_settlement_params(self, data):
         SaleOrderId = data.get('SaleOrderId', '')
         SaleReferenceId = data.get('SaleReferenceId', '')
+        return {
+            'orderId': int(SaleOrderId),
+            'saleOrderId': int(SaleOrderId),
+            'saleReferenceId': int(SaleReferenceId),
+        }
 
-        former_tx_state = self.state
-
-        date = fields.date.today()
-        res = {}
+    def _behpardakht_get_stored_params(self):
+        """ Gateway parameters of a transaction whose callback has already been recorded. """
+        return {
+            'orderId': self.id,
+            'saleOrderId': self.id,
+            'saleReferenceId': int(self.behpardakht_sale_reference_id),
+        }
 
-        if status == '0':
-            behpardakht_acquirer_obj = self.env['payment.acquirer'].search([('provider', '=', 'behpardakht')])
-            data = {
-                'orderId': int(SaleOrderId),
-                'saleOrderId': int(SaleOrderId),
-                'saleReferenceId': int(SaleReferenceId),
-            }
+    def _behpardakht_set_verified(self, SaleReferenceId):
+        """ Payment verified but not settled yet: authorize it and let the settlement batch capture it. """
+        self.write({
+            'acquirer_reference': SaleReferenceId,
+            'behpardakht_sale_reference_id': SaleReferenceId,
+            'behpardakht_settle_state': 'pending',
+            'behpardakht_settle_attempts': 0,
+            'behpardakht_verified_date': fields.Datetime.now(),
+        })
+        self._set_transaction_authorized()
+        return True
 
-            result = behpardakht_acquirer_obj.verify_request(data)
-            status = result.split(',')[0] if result is not None else None
-            if status == '0':
-                result = behpardakht_acquirer_obj.settle_request(data)
-                status = result.split(',')[0] if result is not None else None
-                if status == '0':
-                    self.acquirer_reference = SaleReferenceId
-                    res.update(date=date)
-                    self._set_transaction_done()
-                    if self.state == 'done' and self.state != former_tx_state:
-                        _logger.info('Validated Behpardakht payment for tx %s: set as done' % self.reference)
-                        return self.write(res)
-                    return True
+    def _behpardakht_set_paid(self, SaleReferenceId):
+        former_tx_state = self.state
+        self.acquirer_reference = SaleReferenceId
+        self._set_transaction_done()
+        if self.state == 'done' and self.state != former_tx_state:
+            _logger.info('tx.done', tx=self.reference, sale_reference_id=SaleReferenceId, audit=True, sample=True)
+            return self.write({'date': fields.date.today()})
+        return True
 
+    def _behpardakht_set_failed(self, status):
         if status is not None:
             error = _('%s Transaction Error: (%s) %s') % (self.reference, status, BEHPARDAKHT_ERROR_MAP.get(status))
         else:
             error = _('Received unrecognized status for Behpardakht payment ') + self.reference
 
+        _logger.info('tx.failed', tx=self.reference, status=status, audit=True)
         self._set_transaction_error(error)
         return True
+
+    def _behpardakht_is_processed(self):
+        """ Whether the callback of this transaction has already been handled, or is being handled by a job. """
+        return self.state in ('authorized', 'done', 'cancel', 'error') or \
+            self.behpardakht_async_state in ('queued', 'verified')
+
+    def _behpardakht_form_validate(self, data):
+        status = data.get('ResCode', None)
+        SaleReferenceId = data.get('SaleReferenceId', '')
+
+        # banks and browsers repeat callbacks: only one of them may reach the gateway
+        if not self._ir_lock():
+            _logger.info('callback.locked', tx=self.reference)
+            return True
+        if self._behpardakht_is_processed():
+            _logger.info('callback.duplicate', tx=self.reference, state=self.state)
+            return True
+
+        if status == '0':
+            acquirer = self.acquirer_id
+            config = acquirer._ir_snapshot()
+            # the bank is known to be down: do not keep the customer waiting, the queue retries later
+            if config.async_validation or acquirer._ir_circuit_guard().is_open():
+                return self._behpardakht_enqueue_validation(data)
+
+            params = self._behpardakht_get_settlement_params(data)
+            with acquirer._ir_deadline('callback'):
+                result = acquirer.verify_request(params, self.credential_id)
+                if result is None:
+                    # the gateway was not reached (down, throttled, out of time): the payment is not lost,
+                    # verify it in the background
+                    return self._behpardakht_enqueue_validation(data)
+                status = self._behpardakht_get_status(result)
+                # 43: Duplicate Verify, the payment has already been verified
+                if status in ('0', '43') and config.settle_mode == 'deferred':
+                    return self._behpardakht_set_verified(SaleReferenceId)
+                if status in ('0', '43'):
+                    result = acquirer.settle_request(params, self.credential_id)
+                    if result is None:
+                        # verified, but no settlement could be sent: leave it to the background
+                        return self._behpardakht_enqueue_validation(data, 'verified')
+                    status = self._behpardakht_get_status(result)
+                    # 45: Transaction Has Been Settled
+                    if status in ('0', '45'):
+                        return self._behpardakht_set_paid(SaleReferenceId)
+
+        return self._behpardakht_set_failed(status)
+
+    # --------------------------------------------------
+    # Background validation
+    # --------------------------------------------------
+
+    def _behpardakht_enqueue_validation(self, data, state='queued'):
+        """ Record the callback payload and leave verify/settle to the scheduled action, starting with settle
+        when ``state`` is 'verified'. """
+        self.write({
+            'behpardakht_sale_reference_id': data.get('SaleReferenceId'),
+            'behpardakht_callback_data': json.dumps(data),
+            'behpardakht_async_state': state,
+            'behpardakht_async_attempts': 0,
+            'behpardakht_async_next_date': fields.Datetime.now(),
+        })
+        self._set_transaction_pending()
+        cron = self.env.ref('payment_behpardakht.cron_behpardakht_process_queue', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return True
+
+    def _behpardakht_schedule_retry(self):
+        """ The bank could not be reached: retry later with an exponential backoff, or give up. A payment the
+        bank has verified is not given up on: the money was taken, the deferred settlement settles or reverses it. """
+        attempts = self.behpardakht_async_attempts + 1
+        if attempts >= self.acquirer_id.bp_async_max_attempts:
+            if self.behpardakht_async_state == 'verified':
+                _logger.warning('settle.handed_over', tx=self.reference, attempts=attempts, audit=True)
+                self.behpardakht_async_state = 'done'
+                return self._behpardakht_set_verified(self.behpardakht_sale_reference_id)
+            self.behpardakht_async_state = 'failed'
+            return self._behpardakht_set_failed(None)
+        self.write({
+            'behpardakht_async_attempts': attempts,
+            'behpardakht_async_next_date': fields.Datetime.now() + datetime.timedelta(seconds=30 * 2 ** attempts),
+        })
+        return True
+
+    def _behpardakht_run_calls(self, acquirer, method, workers):
+        """ Call ``method`` for every transaction of ``self`` with at most ``workers`` concurrent calls and return
+        the statuses by transaction. """
+        # payments are handled by the terminal they were made with
+        by_credential = {}
+        for tx in self:
+            by_credential[tx.credential_id] = by_credential.get(tx.credential_id, self.browse()) | tx
+        statuses = {}
+        for credential, txs in by_credential.items():
+            results = gateway.run_batch(
+                acquirer._behpardakht_gateway_call(method, credential),
+                [tx._behpardakht_get_stored_params() for tx in txs],
+                concurrency=workers,
+            )
+            for tx, result in zip(txs, results):
+                if isinstance(result, Exception):
+                    _logger.warning('call.failed', method=method, tx=tx.reference, error=result)
+                    result = None
+                statuses[tx] = self._behpardakht_get_status(result)
+        return statuses
+
+    def _behpardakht_process_queue(self):
+        """ Verify and settle the queued transactions of ``self``. Committing releases the row locks: the
+        transactions are locked again after each commit, and only the ones still locked and in the expected
+        state are handled, so that the reconciliation or another run never handles them at the same time. """
+        for acquirer in self.mapped('acquirer_id'):
+            txs = self.filtered(lambda tx: tx.acquirer_id == acquirer)._ir_lock()
+
+            queued = txs.filtered(lambda tx: tx.behpardakht_async_state == 'queued')
+            for tx, status in queued._behpardakht_run_calls(acquirer, 'bpVerifyRequest', acquirer.bp_async_concurrency).items():
+                if status in ('0', '43') and acquirer.bp_settle_mode == 'deferred':
+                    tx.behpardakht_async_state = 'done'
+                    tx._behpardakht_set_verified(tx.behpardakht_sale_reference_id)
+                elif status in ('0', '43'):
+                    tx.behpardakht_async_state = 'verified'
+                elif status is None:
+                    tx._behpardakht_schedule_retry()
+                else:
+                    tx.behpardakht_async_state = 'failed'
+                    tx._behpardakht_set_failed(status)
+            self._ir_commit()
+
+            verified = txs._ir_lock().filtered(lambda tx: tx.behpardakht_async_state == 'verified')
+            for tx, status in verified._behpardakht_run_calls(acquirer, 'bpSettleRequest', acquirer.bp_async_concurrency).items():
+                if status in ('0', '45'):
+                    tx.behpardakht_async_state = 'done'
+                    tx._behpardakht_set_paid(tx.behpardakht_sale_reference_id)
+                elif status is None:
+                    tx._behpardakht_schedule_retry()
+                else:
+                    tx.behpardakht_async_state = 'failed'
+                    tx._behpardakht_set_failed(status)
+            self._ir_commit()
+
+    @api.model
+    def _cron_behpardakht_process_queue(self, limit=200):
+        txs = self.search([
+            ('behpardakht_async_state', 'in', ('queued', 'verified')),
+            ('behpardakht_async_next_date', '<=', fields.Datetime.now()),
+        ], order='behpardakht_async_next_date', limit=limit)
+        txs._ir_lock()._behpardakht_process_queue()
+
+    # --------------------------------------------------
+    # Deferred settlement
+    # --------------------------------------------------
+
+    def _behpardakht_settle_batch(self, acquirer):
+        """ Settle the authorized transactions of ``self``, reversing the ones past the settlement deadline. """
+        deadline = fields.Datetime.now() - datetime.timedelta(hours=acquirer.bp_settle_deadline)
+        expired = self.filtered(lambda tx: tx.behpardakht_verified_date < deadline)
+        to_settle = self - expired
+
+        for tx, status in to_settle._behpardakht_run_calls(acquirer, 'bpSettleRequest', acquirer.bp_settle_workers).items():
+            attempts = tx.behpardakht_settle_attempts + 1
+            # 45: the transaction has already been settled by a previous attempt
+            if status in ('0', '45'):
+                _logger.info('settle.done', tx=tx.reference, attempt=attempts, audit=True, sample=True)
+                tx.write({'behpardakht_settle_state': 'done', 'behpardakht_settle_attempts': attempts})
+                tx._behpardakht_set_paid(tx.behpardakht_sale_reference_id)
+            else:
+                _logger.warning('settle.failed', tx=tx.reference, attempt=attempts, status=status,
+                                error=BEHPARDAKHT_ERROR_MAP.get(status, ''))
+                tx.behpardakht_settle_attempts = attempts
+        self._ir_commit()
+
+        for tx, status in expired._behpardakht_run_calls(acquirer, 'bpReversalRequest', acquirer.bp_settle_workers).items():
+            # 48: the transaction has already been reversed by a previous attempt
+            if status in ('0', '48'):
+                _logger.info('settle.expired_reversed', tx=tx.reference, audit=True)
+                tx.behpardakht_settle_state = 'reversed'
+                tx._set_transaction_cancel()
+            else:
+                _logger.error('settle.reversal_failed', tx=tx.reference, status=status,
+                              error=BEHPARDAKHT_ERROR_MAP.get(status, ''), audit=True)
+                if status is not None:
+                    tx.behpardakht_settle_state = 'failed'
+        self._ir_commit()
+
+    @api.model
+    def _cron_behpardakht_settle(self):
+        # whatever the current settlement mode of the acquirer: the payments verified while it was deferring
+        # settlements, or handed over by the background validation, must still be settled or reversed
+        acquirers = self.env['payment.acquirer'].search([('provider', '=', 'behpardakht')])
+        for acquirer in acquirers:
+            # payments being refunded must not be settled
+            txs = self.search([
+                ('acquirer_id', '=', acquirer.id),
+                ('behpardakht_settle_state', '=', 'pending'),
+                ('refund_state', 'not in', ['queued', 'sent', 'done']),
+            ], order='behpardakht_verified_date', limit=acquirer.bp_settle_batch_size)
+            txs = txs._ir_lock().filtered(
+                lambda tx: tx.behpardakht_settle_state == 'pending' and tx.refund_state not in ('queued', 'sent', 'done'))
+            txs._behpardakht_settle_batch(acquirer)
+
+    # --------------------------------------------------
+    # Reconciliation report
+    # --------------------------------------------------
+
+    def _ir_reconciliation_columns(self):
+        return super(PaymentTxBehpardakht, self)._ir_reconciliation_columns() + [
+            ('behpardakht_sale_reference_id', _('Behpardakht Sale Reference Id'), 't.behpardakht_sale_reference_id'),
+            ('behpardakht_settle_state', _('Behpardakht Settlement'), 't.behpardakht_settle_state'),
+        ]
+
+    def _ir_reconciliation_issues(self, row):
+        issues = super(PaymentTxBehpardakht, self)._ir_reconciliation_issues(row)
+        if row['provider'] != 'behpardakht':
+            return issues
+        # payments settled along with their verification have no settlement state
+        settle_state = row['behpardakht_settle_state']
+        if settle_state == 'failed' or (row['state'] == 'done' and settle_state == 'pending'):
+            issues.append('missing_settlement')
+        return issues
+
+    # --------------------------------------------------
+    # Refunds
+    # --------------------------------------------------
+
+    def _behpardakht_refund_batch(self, acquirer, workers=None):
+        """ Reverse the payments of ``self`` and return ``(success, message)`` by transaction, ``success`` being
+        None when the bank could not be reached.
+
+        Mellat only reverses payments that are verified but not settled yet, i.e. the authorized payments of the
+        deferred settlement mode; settled payments must be refunded from the bank's merchant panel.
+        """
+        results = {}
+        reversible = self.filtered(
+            lambda tx: tx.state == 'authorized' and tx.behpardakht_sale_reference_id
+            and tx.behpardakht_settle_state in ('pending', 'reversed', False))
+        for tx in self - reversible:
+            results[tx] = (False, _('Only payments not settled yet can be reversed, '
+                                    'settled ones must be refunded from the bank panel.'))
+        statuses = reversible._behpardakht_run_calls(acquirer, 'bpReversalRequest', workers or acquirer.bp_settle_workers)
+        for tx, status in statuses.items():
+            # 48: the transaction has already been reversed, e.g. by a run that stopped before recording it
+            if status in ('0', '48'):
+                tx.behpardakht_settle_state = 'reversed'
+                tx._set_transaction_cancel()
+                results[tx] = (True, BEHPARDAKHT_ERROR_MAP[status])
+            elif status is None:
+                results[tx] = (None, _('The bank gateway could not be reached.'))
+            else:
+                results[tx] = (False, BEHPARDAKHT_ERROR_MAP.get(status, status))
+        return results
+
+    # --------------------------------------------------
+    # Reconciliation
+    # --------------------------------------------------
+
+    def _behpardakht_reconcile(self, acquirer):
+        """ Resolve the stale transactions of ``self`` and return the outcome counts.
+
+        Transactions whose callback has been recorded, but whose background validation is stuck, are looked up
+        with bpInquiryRequest and settled when the bank reports them as successful. Without a sale reference the
+        bank cannot be asked about the payment; Mellat reverses unverified payments on its own, so those are
+        cancelled.
+        """
+        stats = Counter()
+        with_reference = self.filtered('behpardakht_sale_reference_id')
+        without_reference = self - with_reference
+        without_reference._set_transaction_cancel()
+        stats['cancelled'] += len(without_reference)
+
+        verified = self.browse()
+        for tx, status in with_reference._behpardakht_run_calls(acquirer, 'bpInquiryRequest', acquirer.bp_async_concurrency).items():
+            if status == '0':
+                verified |= tx
+            elif status is None:
+                stats['unchanged'] += 1
+            else:
+                tx._behpardakht_set_failed(status)
+                stats['failed'] += 1
+
+        if acquirer.bp_settle_mode == 'deferred':
+            for tx in verified:
+                tx._behpardakht_set_verified(tx.behpardakht_sale_reference_id)
+            stats['authorized'] += len(verified)
+        else:
+            for tx, status in verified._behpardakht_run_calls(acquirer, 'bpSettleRequest', acquirer.bp_async_concurrency).items():
+                if status in ('0', '45'):
+                    tx._behpardakht_set_paid(tx.behpardakht_sale_reference_id)
+                    stats['done'] += 1
+                elif status is None:
+                    stats['unchanged'] += 1
+                else:
+                    tx._behpardakht_set_failed(status)
+                    stats['failed'] += 1
+
+        # the background validation must not handle the payments resolved here again
+        resolved = with_reference.filtered(lambda tx: tx.state not in ('draft', 'pending'))
+        resolved.filtered(lambda tx: tx.state == 'error').write({'behpardakht_async_state': 'failed'})
+        resolved.filtered(lambda tx: tx.state != 'error').write({'behpardakht_async_state': 'done'})
+        return stats
+
+    @api.model
+    def _cron_behpardakht_reconcile(self, chunk_size=200):
+        """ Resolve Behpardakht transactions whose customer never came back from the gateway.
+
+        Transactions are walked by increasing id in chunks of ``chunk_size``, committing and clearing the
+        cache after each chunk, so that memory stays bounded whatever the number of stale transactions.
+        """
+        started = time.monotonic()
+        stats = Counter()
+        for acquirer in self.env['payment.acquirer'].search([('provider', '=', 'behpardakht')]):
+            stale = fields.Datetime.now() - datetime.timedelta(minutes=acquirer.bp_reconcile_after)
+            domain = [
+                ('acquirer_id', '=', acquirer.id),
+                ('state', 'in', ('draft', 'pending')),
+                ('behpardakht_refid', '!=', False),
+                '|',
+                # the customer never came back from the gateway, and the RefId they were sent with can no longer
+                # be used: transactions whose RefId is reused by a customer still paying are left alone
+                '&', ('behpardakht_sale_reference_id', '=', False),
+                '|', ('behpardakht_refid_expiry', '=', False), ('behpardakht_refid_expiry', '<', stale),
+                # the callback was recorded, but the background validation has not been able to finish it
+                '&', ('behpardakht_sale_reference_id', '!=', False), ('behpardakht_async_next_date', '<', stale),
+            ]
+            last_id = 0
+            while True:
+                txs = self.search(domain + [('id', '>', last_id)], order='id', limit=chunk_size)
+                if not txs:
+                    break
+                last_id = txs[-1].id
+                # a new RefId may have been issued since the search
+                txs = txs._ir_lock().filtered(lambda tx: tx.state in ('draft', 'pending') and (
+                    tx.behpardakht_sale_reference_id or not tx.behpardakht_refid_expiry
+                    or tx.behpardakht_refid_expiry < stale))
+                stats.update(txs._behpardakht_reconcile(acquirer))
+                self._ir_commit()
+                self.invalidate_cache()
+        elapsed = time.monotonic() - started
+        total = sum(stats.values())
+        _logger.info(
+            'reconcile.done', total=total, elapsed='%.2fs' % elapsed,
+            throughput='%.1f' % (total / elapsed if elapsed else 0.0), **stats)
+        return stats
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from odoo.addons.l10n_ir_payment import deadline, eventlog
+from odoo.addons.l10n_ir_payment.gateway import GatewayCall, load_httpx
+from odoo.addons.l10n_ir_payment.metrics import connection_count
+
+# zeep (and lxml, isodate, ... with it) is only imported by the first gateway
+# call, so that processes which never talk to Mellat do not pay for it
+
+_logger = eventlog.getLogger(__name__, 'behpardakht')
+
+DEFAULT_CLIENT_TTL = 3600
+DEFAULT_TIMEOUT = 15
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+
+def load_soap_stack():
+    """ Import the SOAP stack used to talk to the gateway and return the time it took, in seconds. """
+    started = time.monotonic()
+    import zeep.cache
+    import zeep.exceptions
+    import zeep.transports
+    return time.monotonic() - started
+
+
+def transport_errors():
+    """ Exceptions raised when the gateway cannot be reached. zeep's and httpx's own are only added once they
+    have been loaded, as they cannot be raised before. """
+    errors = (requests.exceptions.RequestException,)
+    zeep_exceptions = sys.modules.get('zeep.exceptions')
+    if zeep_exceptions is not None:
+        errors += (zeep_exceptions.TransportError,)
+    httpx = sys.modules.get('httpx')
+    if httpx is not None:
+        errors += (httpx.TransportError,)
+    return errors
+
+
+class SoapClientCache(object):
+    """ Per-process cache of zeep clients keyed by WSDL location and environment.
+
+    Building a zeep client downloads and parses the WSDL, which costs more than
+    the gateway call itself. Clients are kept for ``ttl`` seconds and all of them
+    share a single pooled ``requests.Session`` so connections to the bank are
+    kept alive between calls.
+
+    A client is built under a lock of its own key: threads asking for the same
+    client wait for the one building it, the others are not held by a slow
+    WSDL download. The cache lock is only taken to read and publish clients.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_locks = {}
+        self._clients = {}
+        self._session = None
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # prefork workers inherit the cache of the parent process, but must not
+        # share its sockets
+        if self._pid != os.getpid():
+            self._clients.clear()
+            self._build_locks = {}
+            self._session = None
+            self._pid = os.getpid()
+
+    def _get_session(self):
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+        return self._session
+
+    def _build_client(self, wsdl, ttl, cache_path, timeout):
+        from zeep import Client
+        from zeep.cache import SqliteCache
+        from zeep.transports import Transport
+
+        cache = None
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            cache = SqliteCache(path=cache_path, timeout=ttl)
+        transport = Transport(session=self.session, cache=cache, timeout=timeout, operation_timeout=timeout)
+        return Client(wsdl, transport=transport)
+
+    @property
+    def session(self):
+        """ The ``requests.Session`` shared by all cached clients. """
+        with self._lock:
+            self._check_fork()
+            return self._get_session()
+
+    def lookup(self, wsdl, environment, ttl=DEFAULT_CLIENT_TTL, cache_path=None, timeout=DEFAULT_TIMEOUT):
+        """ Return a ``(client, hit)`` pair, ``hit`` telling whether the client came from the cache.
+        See :meth:`get` for the parameters. """
+        key = (wsdl, environment, timeout)
+        client = self._get_cached(key)
+        if client is not None:
+            return client, True
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            # built by another thread while this one was waiting
+            client = self._get_cached(key)
+            if client is not None:
+                return client, True
+            _logger.info('wsdl.load', wsdl=wsdl, environment=environment)
+            client = self._build_client(wsdl, ttl, cache_path, timeout)
+            if ttl > 0:
+                with self._lock:
+                    self._clients[key] = (client, time.monotonic() + ttl)
+        return client, False
+
+    def _get_cached(self, key):
+        with self._lock:
+            self._check_fork()
+            entry = self._clients.get(key)
+            if entry and entry[1] > time.monotonic():
+                return entry[0]
+            return None
+
+    def get(self, wsdl, environment, ttl=DEFAULT_CLIENT_TTL, cache_path=None, timeout=DEFAULT_TIMEOUT):
+        """ Return a zeep client for ``wsdl``, building it if missing or expired.
+
+            :param str wsdl: WSDL url or path of a local WSDL file
+            :param str environment: 'prod' or 'test'
+            :param int ttl: lifetime of the cached client, in seconds
+            :param str cache_path: optional sqlite file where fetched WSDL/XSD
+                                   documents are persisted between processes
+            :param float timeout: seconds to wait for the WSDL and for each operation
+        """
+        return self.lookup(wsdl, environment, ttl, cache_path, timeout)[0]
+
+    def invalidate(self, wsdl=None, environment=None):
+        """ Drop the cached clients of ``(wsdl, environment)``, or all of them. """
+        with self._lock:
+            for key in list(self._clients):
+                if wsdl is None or key[:2] == (wsdl, environment):
+                    del self._clients[key]
+
+
+client_cache = SoapClientCache()
+
+
+class MellatCall(GatewayCall):
+    """ One operation of the Mellat PGW SOAP service, e.g. ``bpVerifyRequest``.
+
+    Payloads are the operation parameters, the credentials of the terminal are
+    added to them. In batches, the operation is sent through zeep's httpx based
+    asynchronous client when zeep and httpx support it, reusing the WSDL parsed
+    by the cached synchronous client.
+    """
+
+    def __init__(self, method, operation, credentials, wsdl, environment, ttl=DEFAULT_CLIENT_TTL, cache_path=None,
+                 timeout=DEFAULT_TIMEOUT, scope=None, guard=None, limiter=None, tracker=None, journal=None):
+        super(MellatCall, self).__init__(method, scope, guard, limiter, tracker, journal)
+        self.operation = operation
+        self.credentials = credentials
+        self.wsdl = wsdl
+        self.environment = environment
+        self.ttl = ttl
+        self.cache_path = cache_path
+        self.timeout = timeout
+
+    def _get_transport_errors(self):
+        return transport_errors()
+
+    def _on_transport_error(self):
+        # do not keep using a client that may hold a broken definition
+        client_cache.invalidate(self.wsdl, self.environment)
+
+    def _journal_reference(self, payload, result):
+        # the order id of Mellat is the id of the transaction
+        order_id = payload.get('orderId')
+        return str(order_id) if order_id else None
+
+    def _lookup(self):
+        client, hit = client_cache.lookup(self.wsdl, self.environment, ttl=self.ttl, cache_path=self.cache_path,
+                                          timeout=self.timeout)
+        if self.scope:
+            self.scope.event('wsdl_cache', 'hit' if hit else 'miss')
+        return client
+
+    @staticmethod
+    def _bounded_client(client, timeout):
+        """ Return a client sharing the parsed WSDL and the session of ``client``, whose operations time out
+        after ``timeout`` seconds. The cached client cannot be changed, other threads use it. """
+        from zeep import Client
+        from zeep.transports import Transport
+
+        transport = Transport(session=client.transport.session, timeout=timeout, operation_timeout=timeout)
+        return Client(client.wsdl, transport=transport)
+
+    @staticmethod
+    def _decode(result):
+        return result, str(result).split(',')[0] if result is not None else 'empty'
+
+    def _send(self, payload):
+        client = self._lookup()
+        timeout = deadline.bound(self.timeout)
+        if timeout < self.timeout:
+            client = self._bounded_client(client, timeout)
+        session = client_cache.session
+        connections = connection_count(session)
+        result = getattr(client.service, self.operation)(**dict(payload, **self.credentials))
+        if self.scope:
+            self.scope.event('connection', 'new' if connection_count(session) > connections else 'reused')
+        return self._decode(result)
+
+    @staticmethod
+    def _async_supported():
+        """ Whether zeep and httpx provide an asynchronous SOAP client. """
+        if load_httpx() is None:
+            return False
+        try:
+            import zeep
+            from zeep.transports import AsyncTransport
+        except ImportError:
+            return False
+        # zeep < 4.1 has an aiohttp based transport
+        return hasattr(zeep, 'AsyncClient') and 'client' in AsyncTransport.__init__.__code__.co_varnames
+
+    def _get_async_client(self, client, context):
+        """ Return the asynchronous zeep client of the batch, sharing the WSDL of the synchronous ``client``. """
+        import httpx
+        import zeep
+        from zeep.transports import AsyncTransport
+
+        def build():
+            transport = context.resource(
+                ('mellat-transport', self.wsdl, self.environment, self.timeout),
+                lambda: AsyncTransport(
+                    client=httpx.AsyncClient(
+                        timeout=self.timeout, limits=httpx.Limits(max_connections=context.concurrency)),
+                    operation_timeout=self.timeout))
+            return zeep.AsyncClient(client.wsdl, transport=transport)
+
+        return context.resource(('mellat', self.wsdl, self.environment, self.timeout), build)
+
+    async def _asend(self, payload, context):
+        if not self._async_supported():
+            return await super(MellatCall, self)._asend(payload, context)
+        # looking the client up may download and parse the WSDL, which blocks
+        client = await context.run_sync(self._lookup)
+        async_client = self._get_async_client(client, context)
+        result = await getattr(async_client.service, self.operation)(**dict(payload, **self.credentials))
+        return self._decode(result)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+from . import test_callback_queries
+from . import test_duplicate_callbacks
+from . import test_pay
+from . import test_reconcile
+from . import test_settlement
+from . import test_soap_client
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from odoo import fields
+
+from odoo.addons.l10n_ir_payment.tests.common import IrPaymentCommon
+
+
+class BehpardakhtCommon(IrPaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super(BehpardakhtCommon, cls).setUpClass()
+        cls.acquirer = cls._create_acquirer(
+            'behpardakht', bp_terminal_id=1, bp_username='test', bp_password='test', bp_wsdl_disk_cache=False)
+        cls.Acquirer = type(cls.env['payment.acquirer'])
+
+    @classmethod
+    def _create_issued_tx(cls, **values):
+        """ Return a transaction whose RefId has been issued, as the pay route leaves it. """
+        return cls._create_tx(cls.acquirer, **dict({
+            'behpardakht_refid': 'R%015d' % next(cls._references),
+            'behpardakht_refid_expiry': fields.Datetime.now() + datetime.timedelta(minutes=10),
+            'behpardakht_refid_amount': 100000.0,
+        }, **values))
+
+    @staticmethod
+    def _callback_data(tx, res_code='0', sale_reference_id='158796325'):
+        return {
+            'RefId': tx.behpardakht_refid,
+            'ResCode': res_code,
+            'SaleOrderId': str(tx.id),
+            'SaleReferenceId': sale_reference_id,
+        }
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.tests import tagged
+from odoo.tests.common import warmup
+
+from odoo.addons.payment_behpardakht.tests.common import BehpardakhtCommon
+
+
+@tagged('post_install', '-at_install')
+class TestCallbackQueries(BehpardakhtCommon):
+    """ The controller resolves the transaction of a callback once and form_feedback reuses it. The counts are
+    ceilings: ``assertQueryCount`` only fails when more queries are made. """
+
+    @warmup
+    def test_callback_queries(self):
+        tx = self._create_issued_tx()
+        with patch.object(self.Acquirer, 'verify_request', return_value='0'), \
+                patch.object(self.Acquirer, 'settle_request', return_value='0'), \
+                self.assertQueryCount(12):
+            tx.form_feedback(self._callback_data(tx), 'behpardakht')
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.acquirer_reference, '158796325')
+
+    def test_resolved_tx_is_not_searched_again(self):
+        tx = self._create_issued_tx()
+        with self.assertQueryCount(0):
+            found = tx._behpardakht_form_get_tx_from_data(self._callback_data(tx))
+        self.assertEqual(found, tx)
+
+    def test_lookup_is_a_single_query(self):
+        tx = self._create_issued_tx()
+        with self.assertQueryCount(1):
+            found = self.env['payment.transaction']._behpardakht_form_get_tx_from_data(self._callback_data(tx))
+        self.assertEqual(found, tx)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from odoo.addons.payment_behpardakht.tests.common import BehpardakhtCommon
+
+
+@tagged('post_install', '-at_install')
+class TestDuplicateCallbacks(BehpardakhtCommon):
+
+    def test_repeated_callback_verifies_once(self):
+        tx = self._create_issued_tx()
+        data = self._callback_data(tx)
+        with patch.object(self.Acquirer, 'verify_request', return_value='0') as verify_request, \
+                patch.object(self.Acquirer, 'settle_request', return_value='0') as settle_request:
+            tx.form_feedback(data, 'behpardakht')
+            tx.form_feedback(data, 'behpardakht')
+        self.assertEqual(verify_request.call_count, 1)
+        self.assertEqual(settle_request.call_count, 1)
+        self.assertEqual(tx.state, 'done')
+
+    def test_callback_of_queued_payment_is_ignored(self):
+        tx = self._create_issued_tx()
+        tx._behpardakht_enqueue_validation(self._callback_data(tx))
+        with patch.object(self.Acquirer, 'verify_request') as verify_request:
+            tx.form_feedback(self._callback_data(tx), 'behpardakht')
+        verify_request.assert_not_called()
+        self.assertEqual(tx.behpardakht_async_state, 'queued')
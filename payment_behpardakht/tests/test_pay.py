@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.exceptions import ValidationError
+from odoo.tests import HttpCase, tagged
+
+from odoo.addons.l10n_ir_payment.gateway import RetryLater
+from odoo.addons.payment_behpardakht.tests.common import BehpardakhtCommon
+
+
+@tagged('post_install', '-at_install')
+class TestPay(BehpardakhtCommon):
+
+    def test_refid_is_reused(self):
+        tx = self._create_tx(self.acquirer)
+        with patch.object(self.Acquirer, 'pay_request', return_value='0,AF82041A2BF6989') as pay_request:
+            self.assertEqual(tx._behpardakht_issue_refid(), 'AF82041A2BF6989')
+            self.assertEqual(tx._behpardakht_issue_refid(), 'AF82041A2BF6989')
+        self.assertEqual(pay_request.call_count, 1)
+
+    def test_refid_of_another_amount_is_not_reused(self):
+        tx = self._create_issued_tx()
+        tx.amount = 200000.0
+        with patch.object(self.Acquirer, 'pay_request') as pay_request, self.assertRaises(ValidationError):
+            tx._behpardakht_issue_refid()
+        # Mellat refuses a second RefId for the same order
+        pay_request.assert_not_called()
+
+    def test_unreachable_gateway_may_be_retried(self):
+        tx = self._create_tx(self.acquirer)
+        with patch.object(self.Acquirer, 'pay_request', return_value=None), self.assertRaises(RetryLater):
+            tx._behpardakht_issue_refid()
+        self.assertEqual(tx.state, 'draft')
+        self.assertFalse(tx.behpardakht_refid)
+
+    def test_refused_payment(self):
+        tx = self._create_tx(self.acquirer)
+        # 21: Invalid Merchant
+        with patch.object(self.Acquirer, 'pay_request', return_value='21'), \
+                self.assertRaises(ValidationError) as error:
+            tx._behpardakht_issue_refid()
+        self.assertNotIsInstance(error.exception, RetryLater)
+
+
+@tagged('post_install', '-at_install')
+class TestPayRoute(HttpCase):
+
+    def setUp(self):
+        super(TestPayRoute, self).setUp()
+        self.env.ref('base.IRR').active = True
+        acquirer = self.env['payment.acquirer'].create({
+            'name': 'Test behpardakht',
+            'provider': 'behpardakht',
+            'state': 'test',
+            'bp_terminal_id': 1,
+            'bp_username': 'test',
+            'bp_password': 'test',
+            'bp_wsdl_disk_cache': False,
+        })
+        self.tx = self.env['payment.transaction'].create({
+            'acquirer_id': acquirer.id,
+            'amount': 100000.0,
+            'currency_id': self.env.ref('base.IRR').id,
+            'partner_id': self.env['res.partner'].create({'name': 'Payment Test'}).id,
+            'reference': 'IR-TEST-ROUTE',
+        })
+        self.Acquirer = type(self.env['payment.acquirer'])
+
+    def _pay(self):
+        return self.url_open('/payment/behpardakht/pay?reference=%s&token=%s' % (
+            self.tx.reference, self.tx._ir_get_pay_token()), allow_redirects=False)
+
+    def test_unreachable_gateway_leaves_the_payment_as_is(self):
+        with patch.object(self.Acquirer, 'pay_request', return_value=None):
+            response = self._pay()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('could not be reached', response.text)
+        self.tx.invalidate_cache()
+        self.assertEqual(self.tx.state, 'draft')
+
+    def test_refused_payment_is_an_error(self):
+        with patch.object(self.Acquirer, 'pay_request', return_value='21'):
+            self._pay()
+        self.tx.invalidate_cache()
+        self.assertEqual(self.tx.state, 'error')
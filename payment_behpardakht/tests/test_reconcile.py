@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import tagged
+
+from odoo.addons.payment_behpardakht.tests.common import BehpardakhtCommon
+
+
+@tagged('post_install', '-at_install')
+class TestReconcile(BehpardakhtCommon):
+
+    def _create_stuck_tx(self):
+        """ Return a payment whose callback was recorded, but whose background validation stopped an hour and a
+        half ago. """
+        tx = self._create_issued_tx()
+        tx._behpardakht_enqueue_validation(self._callback_data(tx))
+        tx.behpardakht_async_next_date = fields.Datetime.now() - datetime.timedelta(minutes=90)
+        return tx
+
+    def test_stuck_validation_is_inquired(self):
+        tx = self._create_stuck_tx()
+        methods = []
+
+        def run_batch(call, payloads, concurrency=10):
+            methods.append(call.operation)
+            return ['0'] * len(payloads)
+
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=run_batch):
+            stats = self.env['payment.transaction']._cron_behpardakht_reconcile()
+        self.assertEqual(methods, ['bpInquiryRequest', 'bpSettleRequest'])
+        self.assertEqual(stats['done'], 1)
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.behpardakht_async_state, 'done')
+
+    def test_recent_validation_is_left_to_the_queue(self):
+        tx = self._create_issued_tx()
+        tx._behpardakht_enqueue_validation(self._callback_data(tx))
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch') as run_batch:
+            self.env['payment.transaction']._cron_behpardakht_reconcile()
+        run_batch.assert_not_called()
+        self.assertEqual(tx.state, 'pending')
+        self.assertEqual(tx.behpardakht_async_state, 'queued')
+
+    def test_abandoned_payment_is_cancelled_once_its_refid_expired(self):
+        tx = self._create_issued_tx(
+            behpardakht_refid_expiry=fields.Datetime.now() - datetime.timedelta(minutes=90))
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch') as run_batch:
+            stats = self.env['payment.transaction']._cron_behpardakht_reconcile()
+        run_batch.assert_not_called()
+        self.assertEqual(stats['cancelled'], 1)
+        self.assertEqual(tx.state, 'cancel')
+
+    def test_old_payment_with_a_valid_refid_is_left_alone(self):
+        tx = self._create_issued_tx()
+        # created long ago, its RefId was issued again a moment ago for a customer now paying
+        self.env.cr.execute("UPDATE payment_transaction SET create_date = create_date - interval '1 day' WHERE id = %s",
+                            [tx.id])
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch') as run_batch:
+            stats = self.env['payment.transaction']._cron_behpardakht_reconcile()
+        run_batch.assert_not_called()
+        self.assertFalse(stats['cancelled'])
+        self.assertEqual(tx.state, 'draft')
+
+    def test_refused_payment_fails(self):
+        tx = self._create_stuck_tx()
+        # 17: Customer Cancellation
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=lambda call, payloads, **kw: ['17']):
+            stats = tx._behpardakht_reconcile(self.acquirer)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(tx.state, 'error')
+        self.assertEqual(tx.behpardakht_async_state, 'failed')
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from odoo.addons.payment_behpardakht.tests.common import BehpardakhtCommon
+
+
+def answer(status):
+    """ Return a ``run_batch`` stand-in answering ``status`` to every call. """
+    return lambda call, payloads, concurrency=10: [status] * len(payloads)
+
+
+@tagged('post_install', '-at_install')
+class TestSettlement(BehpardakhtCommon):
+
+    def _create_verified_tx(self):
+        tx = self._create_issued_tx()
+        tx._behpardakht_set_verified('158796325')
+        return tx
+
+    def test_settle_mode_reaches_the_snapshot(self):
+        self.acquirer.bp_settle_mode = 'deferred'
+        self.assertEqual(self.acquirer._ir_snapshot().settle_mode, 'deferred')
+        self.acquirer.bp_settle_mode = 'inline'
+        self.assertEqual(self.acquirer._ir_snapshot().settle_mode, 'inline')
+
+    def test_deferred_settlement(self):
+        self.acquirer.bp_settle_mode = 'deferred'
+        tx = self._create_issued_tx()
+        with patch.object(self.Acquirer, 'verify_request', return_value='0'), \
+                patch.object(self.Acquirer, 'settle_request') as settle_request:
+            tx.form_feedback(self._callback_data(tx), 'behpardakht')
+        settle_request.assert_not_called()
+        self.assertEqual(tx.state, 'authorized')
+        self.assertEqual(tx.behpardakht_settle_state, 'pending')
+
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=answer('0')):
+            self.env['payment.transaction']._cron_behpardakht_settle()
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.behpardakht_settle_state, 'done')
+
+    def test_settle_after_switching_back_to_inline(self):
+        self.acquirer.bp_settle_mode = 'deferred'
+        tx = self._create_verified_tx()
+        self.acquirer.bp_settle_mode = 'inline'
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=answer('0')):
+            self.env['payment.transaction']._cron_behpardakht_settle()
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.behpardakht_settle_state, 'done')
+
+    def test_reverse_past_deadline(self):
+        tx = self._create_verified_tx()
+        tx.behpardakht_verified_date = '2000-01-01 00:00:00'
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=answer('0')):
+            self.env['payment.transaction']._cron_behpardakht_settle()
+        self.assertEqual(tx.state, 'cancel')
+        self.assertEqual(tx.behpardakht_settle_state, 'reversed')
+
+    def test_verified_payment_is_not_given_up(self):
+        """ The bank verified the payment but could never be reached for the settlement: the money was taken, the
+        payment is left to the deferred settlement instead of being put in error. """
+        tx = self._create_issued_tx()
+        tx._behpardakht_enqueue_validation(self._callback_data(tx), 'verified')
+        tx.behpardakht_async_attempts = self.acquirer.bp_async_max_attempts - 1
+        tx._behpardakht_schedule_retry()
+        self.assertEqual(tx.state, 'authorized')
+        self.assertEqual(tx.behpardakht_settle_state, 'pending')
+        self.assertEqual(tx.behpardakht_async_state, 'done')
+
+    def test_queue_only_settles_the_payments_it_locked_again(self):
+        """ Committing the verifications releases the row locks: a payment locked meanwhile by another run or by
+        the reconciliation is left to it. """
+        tx = self._create_issued_tx()
+        tx._behpardakht_enqueue_validation(self._callback_data(tx))
+        locked = iter([True, False])
+        methods = []
+
+        def run_batch(call, payloads, concurrency=10):
+            methods.append(call.method)
+            return ['0'] * len(payloads)
+
+        with patch.object(type(tx), '_ir_lock', autospec=True,
+                          side_effect=lambda txs: txs if next(locked) else txs.browse()), \
+                patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=run_batch):
+            tx._behpardakht_process_queue()
+        self.assertEqual(methods, ['bpVerifyRequest'])
+        self.assertEqual(tx.behpardakht_async_state, 'verified')
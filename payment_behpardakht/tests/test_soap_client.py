@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from unittest.mock import patch
+
+from odoo.tests import common, tagged
+
+from odoo.addons.payment_behpardakht.soap_client import SoapClientCache
+
+
+@tagged('post_install', '-at_install')
+class TestSoapClientCache(common.BaseCase):
+
+    def test_slow_build_does_not_block_other_clients(self):
+        cache = SoapClientCache()
+        building = threading.Event()
+        release = threading.Event()
+
+        def build(wsdl, ttl, cache_path, timeout):
+            if wsdl == 'slow':
+                building.set()
+                release.wait(5)
+            return object()
+
+        with patch.object(cache, '_build_client', side_effect=build):
+            client = cache.get('fast', 'test')
+            thread = threading.Thread(target=cache.get, args=('slow', 'test'))
+            thread.start()
+            try:
+                self.assertTrue(building.wait(5))
+                self.assertEqual(cache.lookup('fast', 'test'), (client, True))
+            finally:
+                release.set()
+                thread.join()
+
+    def test_concurrent_misses_build_once(self):
+        cache = SoapClientCache()
+        release = threading.Event()
+
+        def build(wsdl, ttl, cache_path, timeout):
+            release.wait(5)
+            return object()
+
+        with patch.object(cache, '_build_client', side_effect=build) as build_client:
+            threads = [threading.Thread(target=cache.get, args=('wsdl', 'test')) for _i in range(4)]
+            for thread in threads:
+                thread.start()
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(build_client.call_count, 1)
+
+    def test_zero_ttl_is_not_cached(self):
+        cache = SoapClientCache()
+        with patch.object(cache, '_build_client', side_effect=lambda *args: object()) as build_client:
+            self.assertFalse(cache.lookup('wsdl', 'test', ttl=0)[1])
+            self.assertFalse(cache.lookup('wsdl', 'test', ttl=0)[1])
+        self.assertEqual(build_client.call_count, 2)
+        self.assertEqual(build_client.call_args[0][1], 0)
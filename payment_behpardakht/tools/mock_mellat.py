@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the Mellat (Behpardakht) PGW SOAP gateway.
+
+Serves the WSDL on ``/pgwchannel/services/pgw?wsdl``, answers the bpPayRequest,
+bpVerifyRequest, bpSettleRequest, bpInquiryRequest and bpReversalRequest
+operations, and provides ``/pgwchannel/startpay.mellat``, which immediately
+posts the customer back to the callback url as if the payment had succeeded.
+Latency, result codes and failure rates are configurable::
+
+    python mock_mellat.py --port 8802 --latency 250 --error-rate 0.01 --error-code 34
+
+Point the acquirer to it with Gateway WSDL URL
+``http://127.0.0.1:8802/pgwchannel/services/pgw?wsdl`` and Gateway Payment Page
+URL ``http://127.0.0.1:8802/pgwchannel/startpay.mellat``.
+"""
+import argparse
+import html
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+_logger = logging.getLogger(__name__)
+
+NAMESPACE = 'http://interfaces.core.sw.bps.com/'
+OPERATIONS = ('bpPayRequest', 'bpVerifyRequest', 'bpSettleRequest', 'bpInquiryRequest', 'bpReversalRequest')
+
+_PAY_PARAMS = (
+    ('terminalId', 'long'), ('userName', 'string'), ('userPassword', 'string'), ('orderId', 'long'),
+    ('amount', 'long'), ('localDate', 'string'), ('localTime', 'string'), ('additionalData', 'string'),
+    ('callBackUrl', 'string'), ('payerId', 'long'),
+)
+_DEFAULT_PARAMS = (
+    ('terminalId', 'long'), ('userName', 'string'), ('userPassword', 'string'), ('orderId', 'long'),
+    ('saleOrderId', 'long'), ('saleReferenceId', 'long'),
+)
+
+
+def _build_wsdl(address):
+    types, messages, port_ops, binding_ops = [], [], [], []
+    for operation in OPERATIONS:
+        params = _PAY_PARAMS if operation == 'bpPayRequest' else _DEFAULT_PARAMS
+        types.append(
+            '<xs:element name="%s"><xs:complexType><xs:sequence>%s</xs:sequence></xs:complexType></xs:element>' % (
+                operation, ''.join('<xs:element name="%s" type="xs:%s"/>' % param for param in params)))
+        types.append(
+            '<xs:element name="%sResponse"><xs:complexType><xs:sequence>'
+            '<xs:element name="return" type="xs:string" minOccurs="0"/>'
+            '</xs:sequence></xs:complexType></xs:element>' % operation)
+        messages.append(
+            '<message name="{0}"><part name="parameters" element="tns:{0}"/></message>'
+            '<message name="{0}Response"><part name="parameters" element="tns:{0}Response"/></message>'.format(operation))
+        port_ops.append(
+            '<operation name="{0}"><input message="tns:{0}"/><output message="tns:{0}Response"/></operation>'.format(operation))
+        binding_ops.append(
+            '<operation name="{0}"><soap:operation soapAction=""/>'
+            '<input><soap:body use="literal"/></input><output><soap:body use="literal"/></output>'
+            '</operation>'.format(operation))
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+        'xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="{ns}" targetNamespace="{ns}" name="PaymentGatewayImplService">'
+        '<types><xs:schema targetNamespace="{ns}" elementFormDefault="unqualified">{types}</xs:schema></types>'
+        '{messages}'
+        '<portType name="IPaymentGateway">{port_ops}</portType>'
+        '<binding name="PaymentGatewayImplServiceSoapBinding" type="tns:IPaymentGateway">'
+        '<soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>{binding_ops}</binding>'
+        '<service name="PaymentGatewayImplService">'
+        '<port name="PaymentGatewayImplPort" binding="tns:PaymentGatewayImplServiceSoapBinding">'
+        '<soap:address location="{address}"/></port></service>'
+        '</definitions>'
+    ).format(ns=NAMESPACE, types=''.join(types), messages=''.join(messages), port_ops=''.join(port_ops),
+             binding_ops=''.join(binding_ops), address=html.escape(address))
+
+
+def _envelope(operation, result):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>'
+        '<ns2:{0}Response xmlns:ns2="{1}"><return>{2}</return></ns2:{0}Response>'
+        '</soap:Body></soap:Envelope>'
+    ).format(operation, NAMESPACE, html.escape(result))
+
+
+class MockSettings(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_code='34', failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.failure_rate = failure_rate
+
+
+class MockMellatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+    def _wait(self):
+        settings = self.server.settings
+        delay = settings.latency + random.uniform(-settings.jitter, settings.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def _send(self, status, content, content_type='text/xml; charset=utf-8'):
+        content = content.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode()
+
+    @staticmethod
+    def _param(body, name):
+        match = re.search(r'<(?:\w+:)?%s>([^<]*)</' % name, body)
+        return match and match.group(1)
+
+    def do_GET(self):
+        if self.path.startswith('/pgwchannel/services/pgw'):
+            address = 'http://%s/pgwchannel/services/pgw' % self.headers.get('Host')
+            return self._send(200, _build_wsdl(address))
+        return self._send(404, 'Not Found', 'text/plain')
+
+    def do_POST(self):
+        body = self._read_body()
+        if self.path.startswith('/pgwchannel/startpay.mellat'):
+            return self._startpay(parse_qs(body))
+        if not self.path.startswith('/pgwchannel/services/pgw'):
+            return self._send(404, 'Not Found', 'text/plain')
+
+        operation = next((op for op in OPERATIONS if re.search(r'<(?:\w+:)?%s[\s>]' % op, body)), None)
+        if not operation:
+            return self._send(500, 'Unknown operation', 'text/plain')
+        settings = self.server.settings
+        self._wait()
+        if random.random() < settings.failure_rate:
+            return self._send(503, 'Service Unavailable', 'text/plain')
+        if random.random() < settings.error_rate:
+            return self._send(200, _envelope(operation, settings.error_code))
+
+        if operation == 'bpPayRequest':
+            ref_id = uuid.uuid4().hex[:16].upper()
+            with self.server.lock:
+                self.server.payments[ref_id] = {
+                    'orderId': self._param(body, 'orderId'),
+                    'callBackUrl': html.unescape(self._param(body, 'callBackUrl') or ''),
+                }
+            return self._send(200, _envelope(operation, '0,%s' % ref_id))
+        return self._send(200, _envelope(operation, '0'))
+
+    def _startpay(self, form):
+        ref_id = (form.get('RefId') or [''])[0]
+        with self.server.lock:
+            payment = self.server.payments.get(ref_id)
+        if not payment:
+            return self._send(404, 'Unknown RefId', 'text/plain')
+        fields = {
+            'RefId': ref_id,
+            'ResCode': '0',
+            'SaleOrderId': payment['orderId'],
+            'SaleReferenceId': str(random.randint(10 ** 9, 10 ** 10)),
+            'CardHolderPan': '610433******0003',
+        }
+        inputs = ''.join('<input type="hidden" name="%s" value="%s"/>' % (k, html.escape(v)) for k, v in fields.items())
+        page = '<html><body onload="document.forms[0].submit()"><form method="post" action="%s">%s</form></body></html>' % (
+            html.escape(payment['callBackUrl']), inputs)
+        return self._send(200, page, 'text/html; charset=utf-8')
+
+
+def make_server(host='127.0.0.1', port=8802, settings=None):
+    """ Build the mock server; call ``serve_forever`` on it, or use :func:`start_in_thread`. """
+    server = ThreadingHTTPServer((host, port), MockMellatHandler)
+    server.daemon_threads = True
+    server.settings = settings or MockSettings()
+    server.payments = {}
+    server.lock = threading.Lock()
+    return server
+
+
+def start_in_thread(host='127.0.0.1', port=0, settings=None):
+    server = make_server(host, port, settings)
+    thread = threading.Thread(target=server.serve_forever, name='mock-mellat', daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8802)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response latency, in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency jitter, in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answered with an error code')
+    parser.add_argument('--error-code', default='34', help='result code returned for those calls')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of calls answered with HTTP 503')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    settings = MockSettings(args.latency, args.jitter, args.error_rate, args.error_code, args.failure_rate)
+    server = make_server(args.host, args.port, settings)
+    _logger.info('Mock Mellat gateway listening on http://%s:%s', args.host, server.server_port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
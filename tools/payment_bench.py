@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""Load-test benchmark for the ZarinPal and Behpardakht acquirers.
+
+Starts the local stand-in gateways shipped with the modules, points the
+acquirer of an existing database to them and drives concurrent checkouts and
+callbacks through the Odoo ORM and HTTP controllers. Reports latency
+percentiles, throughput and SQL query counts per phase::
+
+    python3 tools/payment_bench.py -c /etc/odoo/odoo.conf -d bench --provider zarinpal -n 500 -j 20
+    python3 tools/payment_bench.py -c /etc/odoo/odoo.conf -d bench --provider behpardakht --latency 200 --json out.json
+
+Checkouts create the transaction and render the payment form as the checkout
+pages do, then submit it to the pay route, which asks the gateway for a token;
+the pay routes and callbacks go through the public controllers with a werkzeug
+test client, in process. A checkout that gets no token or a callback that does
+not bring its transaction to a final state is counted as an error, and errors
+make the run exit with status 1. The database must have the module installed
+and an accounting setup, and its transactions are left in place: use a
+throw-away database.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# states a transaction must be in once its callback has been handled
+FINAL_STATES = ('authorized', 'done', 'cancel', 'error')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class PhaseStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.durations = []
+        self.queries = []
+        self.errors = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, duration, queries, error=False):
+        with self.lock:
+            self.durations.append(duration)
+            self.queries.append(queries)
+            self.errors += int(error)
+
+    def summary(self):
+        count = len(self.durations)
+        return {
+            'phase': self.name,
+            'ops': count,
+            'errors': self.errors,
+            'throughput': count / self.elapsed if self.elapsed else 0.0,
+            'p50_ms': percentile(self.durations, 50) * 1000,
+            'p95_ms': percentile(self.durations, 95) * 1000,
+            'p99_ms': percentile(self.durations, 99) * 1000,
+            'queries_avg': sum(self.queries) / count if count else 0.0,
+            'queries_p95': percentile(self.queries, 95),
+        }
+
+
+class Bench(object):
+
+    def __init__(self, args):
+        import odoo
+        from odoo import api, SUPERUSER_ID
+        from werkzeug.test import Client
+        from werkzeug.wrappers import Response
+
+        self.odoo = odoo
+        self.api = api
+        self.uid = SUPERUSER_ID
+        self.args = args
+        self.registry = odoo.registry(args.database)
+        self.client_factory = lambda: Client(odoo.http.root, Response)
+        self.acquirer_id = self.invoice_id = self.partner_id = self.currency_id = None
+        self.mock = None
+
+    # setup -----------------------------------------------------------------
+
+    def _env(self, cr):
+        return self.api.Environment(cr, self.uid, {})
+
+    def start_mock(self):
+        args = self.args
+        if args.provider == 'zarinpal':
+            from odoo.addons.payment_zarinpal.tools import mock_zarinpal as mock
+            settings = mock.MockSettings(args.latency, args.jitter, args.error_rate, failure_rate=args.failure_rate)
+        else:
+            from odoo.addons.payment_behpardakht.tools import mock_mellat as mock
+            settings = mock.MockSettings(args.latency, args.jitter, args.error_rate, failure_rate=args.failure_rate)
+        self.mock = mock.start_in_thread(port=args.mock_port, settings=settings)
+        return 'http://127.0.0.1:%s' % self.mock.server_port
+
+    def setup(self):
+        mock_url = self.start_mock()
+        with self.registry.cursor() as cr:
+            env = self._env(cr)
+            acquirer = env['payment.acquirer'].search([('provider', '=', self.args.provider)], limit=1)
+            if not acquirer:
+                sys.exit('No %s acquirer in database %s' % (self.args.provider, self.args.database))
+            currency = env.ref('base.IRR')
+            currency.active = True
+            partner = env['res.partner'].create({
+                'name': 'Payment Benchmark', 'email': 'bench@example.com', 'phone': '09120000000'})
+            if self.args.provider == 'zarinpal':
+                acquirer.write({
+                    'state': 'test',
+                    'zarinpal_merchant_id': 'BENCHMARK-%s' % uuid.uuid4().hex,
+                    'zarinpal_api_url': mock_url + '/pg/v4/payment/',
+                    'zarinpal_form_url': mock_url + '/pg/StartPay/',
+                })
+                invoice = env['account.move'].create({
+                    'move_type': 'out_invoice',
+                    'partner_id': partner.id,
+                    'currency_id': currency.id,
+                    'invoice_line_ids': [(0, 0, {'name': 'Benchmark', 'quantity': 1, 'price_unit': self.args.amount})],
+                })
+                self.invoice_id = invoice.id
+            else:
+                acquirer.write({
+                    'state': 'test',
+                    'bp_terminal_id': 1,
+                    'bp_username': 'bench',
+                    'bp_password': 'bench',
+                    'bp_wsdl_url': mock_url + '/pgwchannel/services/pgw?wsdl',
+                    'bp_order_url': mock_url + '/pgwchannel/startpay.mellat',
+                    'bp_wsdl_location': False,
+                    # callbacks must leave their transaction in a final state
+                    'bp_async_validation': False,
+                })
+            self.acquirer_id, self.partner_id, self.currency_id = acquirer.id, partner.id, currency.id
+
+    # operations ------------------------------------------------------------
+
+    def _get_token(self, tx):
+        return tx.acquirer_reference if self.args.provider == 'zarinpal' else tx.behpardakht_refid
+
+    def _request(self, url, **kwargs):
+        """ Send a request to the public controllers and return the number of queries it made. """
+        current = threading.current_thread()
+        current.query_count = 0
+        client = self.client_factory()
+        response = client.post(url, **kwargs) if 'data' in kwargs else client.get(url, **kwargs)
+        if response.status_code >= 400:
+            raise RuntimeError('%s answered %s' % (url, response.status_code))
+        return getattr(current, 'query_count', 0)
+
+    def checkout(self, index):
+        """ Create a transaction, render its payment form, as the checkout pages do, and submit it to the pay
+        route, which asks the gateway for a token. """
+        with self.registry.cursor() as cr:
+            env = self._env(cr)
+            queries = cr.sql_log_count
+            values = {
+                'acquirer_id': self.acquirer_id,
+                'amount': self.args.amount,
+                'currency_id': self.currency_id,
+                'partner_id': self.partner_id,
+                'reference': 'BENCH-%s-%s' % (index, uuid.uuid4().hex[:8]),
+            }
+            if self.invoice_id:
+                values['invoice_ids'] = [(6, 0, [self.invoice_id])]
+            tx = env['payment.transaction'].create(values)
+            tx.acquirer_id.render(tx.reference, tx.amount, tx.currency_id.id, values={'partner_id': self.partner_id})
+            tx_id, queries = tx.id, cr.sql_log_count - queries
+            pay_url, pay_data = tx.acquirer_id._ir_pay_route(), {'reference': tx.reference, 'token': tx._ir_get_pay_token()}
+        queries += self._request(pay_url, query_string=pay_data)
+        with self.registry.cursor() as cr:
+            tx = self._env(cr)['payment.transaction'].browse(tx_id)
+            if not self._get_token(tx):
+                raise RuntimeError('%s got no token from the gateway, transaction %s' % (tx.reference, tx.state))
+        return tx_id, queries
+
+    def callback(self, tx_id):
+        """ Send the gateway callback of ``tx_id`` through the public controller. """
+        with self.registry.cursor() as cr:
+            tx = self._env(cr)['payment.transaction'].browse(tx_id)
+            if self.args.provider == 'zarinpal':
+                url, kwargs = '/payment/zarinpal/redirect/', {
+                    'query_string': {'Authority': tx.acquirer_reference, 'Status': 'OK'}}
+            else:
+                url, kwargs = '/payment/behpardakht/accept', {'data': {
+                    'RefId': tx.behpardakht_refid,
+                    'ResCode': '0',
+                    'SaleOrderId': str(tx.id),
+                    'SaleReferenceId': str(random.randint(10 ** 9, 10 ** 10)),
+                }}
+        queries = self._request(url, **kwargs)
+        with self.registry.cursor() as cr:
+            tx = self._env(cr)['payment.transaction'].browse(tx_id)
+            if tx.state not in FINAL_STATES:
+                raise RuntimeError('%s is still %s after its callback' % (tx.reference, tx.state))
+        return tx_id, queries
+
+    def run_phase(self, stats, func, items):
+        def timed(item):
+            started = time.perf_counter()
+            try:
+                result, queries = func(item)
+            except Exception as e:
+                stats.record(time.perf_counter() - started, 0, error=True)
+                if self.args.verbose:
+                    print('%s failed: %s' % (stats.name, e), file=sys.stderr)
+                return None
+            stats.record(time.perf_counter() - started, queries)
+            return result
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            results = list(executor.map(timed, items))
+        stats.elapsed = time.perf_counter() - started
+        return [result for result in results if result is not None]
+
+    def run(self):
+        self.setup()
+        checkout = PhaseStats('checkout')
+        callback = PhaseStats('callback')
+        tx_ids = self.run_phase(checkout, self.checkout, range(self.args.checkouts))
+        self.run_phase(callback, self.callback, tx_ids)
+        self.mock.shutdown()
+        return [checkout.summary(), callback.summary()]
+
+
+def print_report(rows):
+    header = ('phase', 'ops', 'errors', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'sql avg', 'sql p95')
+    print('%-10s %6s %7s %9s %9s %9s %9s %8s %8s' % header)
+    for row in rows:
+        print('%-10s %6d %7d %9.1f %9.1f %9.1f %9.1f %8.1f %8d' % (
+            row['phase'], row['ops'], row['errors'], row['throughput'], row['p50_ms'], row['p95_ms'],
+            row['p99_ms'], row['queries_avg'], row['queries_p95']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('-c', '--config', required=True, help='Odoo configuration file')
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--provider', choices=('zarinpal', 'behpardakht'), required=True)
+    parser.add_argument('-n', '--checkouts', type=int, default=100)
+    parser.add_argument('-j', '--concurrency', type=int, default=10)
+    parser.add_argument('--amount', type=float, default=100000)
+    parser.add_argument('--latency', type=float, default=0.0, help='mock gateway latency, in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='mock gateway latency jitter, in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--mock-port', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    import odoo
+    odoo.tools.config.parse_config(['-c', args.config, '-d', args.database, '--log-level', 'warn'])
+    rows = Bench(args).run()
+    print_report(rows)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'provider': args.provider, 'concurrency': args.concurrency, 'results': rows}, f, indent=2)
+    if any(row['errors'] for row in rows):
+        sys.exit('Some checkouts or callbacks failed, run with -v for the details')
+
+
+if __name__ == '__main__':
+    main()
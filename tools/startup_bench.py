@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Startup benchmark for the payment modules.
+
+Measures, in fresh interpreters, how long loading the registry of a database
+takes, so that a database with the payment modules installed can be compared
+with one without them::
+
+    python3 tools/startup_bench.py -c /etc/odoo/odoo.conf -d with_payment -d without_payment -n 10
+
+Each run also reports whether the SOAP stack (zeep) got imported while the
+registry was loading, which it should only be when ``behpardakht_prewarm`` is
+set in the configuration file.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import odoo
+imported = time.perf_counter()
+odoo.tools.config.parse_config(['-c', sys.argv[1], '--log-level', 'warn'])
+loaded = time.perf_counter()
+odoo.modules.registry.Registry.new(sys.argv[2])
+done = time.perf_counter()
+print(json.dumps({
+    'import_odoo': imported - started,
+    'registry': done - loaded,
+    'total': done - started,
+    'modules': len(sys.modules),
+    'zeep': 'zeep' in sys.modules,
+}))
+"""
+
+
+def run_once(config, database):
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE, config, database],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(database, runs):
+    registry = [run['registry'] for run in runs]
+    total = [run['total'] for run in runs]
+    return {
+        'database': database,
+        'runs': len(runs),
+        'registry_min_ms': min(registry) * 1000,
+        'registry_median_ms': statistics.median(registry) * 1000,
+        'total_median_ms': statistics.median(total) * 1000,
+        'modules': runs[-1]['modules'],
+        'zeep_loaded': any(run['zeep'] for run in runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('-c', '--config', required=True, help='Odoo configuration file')
+    parser.add_argument('-d', '--database', action='append', required=True,
+                        help='database to load, may be given several times')
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    rows = []
+    for database in args.database:
+        # a first load warms the OS file cache and is not counted
+        run_once(args.config, database)
+        rows.append(summarize(database, [run_once(args.config, database) for _i in range(args.runs)]))
+
+    print('%-20s %5s %12s %12s %12s %8s %5s' % (
+        'database', 'runs', 'registry min', 'registry p50', 'total p50', 'modules', 'zeep'))
+    for row in rows:
+        print('%-20s %5d %10.1fms %10.1fms %10.1fms %8d %5s' % (
+            row['database'], row['runs'], row['registry_min_ms'], row['registry_median_ms'],
+            row['total_median_ms'], row['modules'], 'yes' if row['zeep_loaded'] else 'no'))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,7 +7,14 @@
     'description': """Payment Acquirers Localization""",
     'depends': ['payment'],
     'data': [
+        'security/ir.model.access.csv',
         'data/payment_icon_data.xml',
+        'data/payment_reconciliation_data.xml',
+        'data/payment_refund_data.xml',
+        'views/assets.xml',
+        'views/payment_templates.xml',
+        'views/payment_views.xml',
+        'wizard/payment_reconciliation_report_views.xml',
     ],
     'auto_install': True,
 }
@@ -0,0 +1,190 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from odoo.addons.l10n_ir_payment.gateway import GatewayError
+
+_logger = logging.getLogger(__name__)
+
+# seconds a worker trusts its last reading of the shared circuit state
+STATE_TTL = 2.0
+
+
+class GatewayUnavailable(GatewayError):
+    """ Raised instead of calling a gateway whose circuit is open. """
+
+
+class CircuitSettings(object):
+    __slots__ = ('enabled', 'failure_rate', 'slow_call', 'min_calls', 'window', 'open_duration')
+
+    def __init__(self, enabled=True, failure_rate=0.5, slow_call=5.0, min_calls=10, window=60, open_duration=30):
+        self.enabled = enabled
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.min_calls = min_calls
+        self.window = window
+        self.open_duration = open_duration
+
+
+class Guard(object):
+    """ Circuit breaker of one acquirer, as seen by one gateway call.
+
+    Holds no ORM record, so it can be handed to worker threads. Use as::
+
+        probe = guard.before()      # raises GatewayUnavailable when open
+        ...call the gateway...
+        guard.after(probe, failed, duration)
+    """
+    __slots__ = ('dbname', 'acquirer_id', 'settings')
+
+    def __init__(self, dbname, acquirer_id, settings):
+        self.dbname = dbname
+        self.acquirer_id = acquirer_id
+        self.settings = settings
+
+    def before(self):
+        if not self.settings.enabled:
+            return False
+        return breaker.before(self)
+
+    def after(self, probe, failed, duration):
+        if self.settings.enabled:
+            breaker.after(self, probe, failed or duration > self.settings.slow_call)
+
+    def is_open(self):
+        return self.settings.enabled and breaker.is_open(self)
+
+
+class CircuitBreaker(object):
+    """ Per-process circuit breaker whose open/half-open state is shared through
+    the ``payment_circuit_state`` table, on a cursor of its own so that a
+    request holding the row of the acquirer never blocks it.
+
+    Each worker computes the failure rate of its own recent calls. The first
+    worker reaching the threshold opens the circuit for every worker. Once the
+    open period is over, a single call, claimed atomically in the database, is
+    let through as a probe: its success closes the circuit, its failure opens
+    it again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._calls = {}
+        self._states = {}
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._calls = {}
+            self._states = {}
+            self._pid = os.getpid()
+
+    def _execute(self, dbname, query, params):
+        """ Run ``query`` on a cursor of its own and return its rows, None when it returns none or the
+        database failed. """
+        from odoo.sql_db import db_connect
+        try:
+            with db_connect(dbname).cursor() as cr:
+                cr.execute(query, params)
+                return cr.fetchall() if cr.description else None
+        except Exception:
+            # the breaker must never be the reason a payment fails
+            _logger.warning('Unable to access the shared circuit state', exc_info=True)
+            return None
+
+    def _open_until(self, guard):
+        """ Return the end of the open period of the circuit as a unix timestamp, or None when closed. """
+        key = (guard.dbname, guard.acquirer_id)
+        now = time.time()
+        with self._lock:
+            self._check_fork()
+            state = self._states.get(key)
+        if state and now - state[1] < STATE_TTL:
+            return state[0]
+        rows = self._execute(guard.dbname, """
+            SELECT EXTRACT(EPOCH FROM open_until AT TIME ZONE 'UTC')
+            FROM payment_circuit_state WHERE acquirer_id = %s
+        """, [guard.acquirer_id])
+        open_until = rows and rows[0][0] and float(rows[0][0])
+        with self._lock:
+            self._states[key] = (open_until or None, now)
+        return open_until or None
+
+    def _set_open_until(self, dbname, acquirer_id, open_until):
+        key = (dbname, acquirer_id)
+        with self._lock:
+            self._check_fork()
+            self._states[key] = (open_until, time.time())
+            self._calls.pop(key, None)
+
+    def is_open(self, guard):
+        open_until = self._open_until(guard)
+        return bool(open_until) and open_until > time.time()
+
+    def before(self, guard):
+        """ Return False when the call may proceed, True when it is the half-open probe, and raise
+        :class:`GatewayUnavailable` when the circuit is open. """
+        open_until = self._open_until(guard)
+        if not open_until:
+            return False
+        if open_until > time.time():
+            raise GatewayUnavailable('Gateway of acquirer %s is temporarily unavailable' % guard.acquirer_id)
+        # half-open: only one call across all workers gets to probe the gateway
+        rows = self._execute(guard.dbname, """
+            UPDATE payment_circuit_state
+               SET probe_until = (now() at time zone 'UTC') + make_interval(secs => %s)
+             WHERE acquirer_id = %s
+               AND open_until <= (now() at time zone 'UTC')
+               AND (probe_until IS NULL OR probe_until < (now() at time zone 'UTC'))
+         RETURNING acquirer_id
+        """, [guard.settings.open_duration, guard.acquirer_id])
+        if rows is None:
+            # the probe could not be claimed: let the call through rather than fail the payment
+            return False
+        if not rows:
+            raise GatewayUnavailable('Gateway of acquirer %s is temporarily unavailable' % guard.acquirer_id)
+        return True
+
+    def after(self, guard, probe, failed):
+        key = (guard.dbname, guard.acquirer_id)
+        if probe:
+            if failed:
+                self._trip(guard)
+            else:
+                _logger.info('Payment gateway of acquirer %s recovered, closing its circuit', guard.acquirer_id)
+                self.reset(guard.dbname, guard.acquirer_id)
+            return
+
+        settings = guard.settings
+        now = time.monotonic()
+        with self._lock:
+            self._check_fork()
+            calls = self._calls.setdefault(key, deque())
+            calls.append((now, failed))
+            while calls and calls[0][0] < now - settings.window:
+                calls.popleft()
+            failures = sum(1 for _at, call_failed in calls if call_failed)
+            trip = len(calls) >= settings.min_calls and failures >= settings.failure_rate * len(calls)
+        if trip:
+            self._trip(guard)
+
+    def _trip(self, guard):
+        _logger.warning('Payment gateway of acquirer %s is degraded, opening its circuit for %ss',
+                        guard.acquirer_id, guard.settings.open_duration)
+        self._execute(guard.dbname, """
+            INSERT INTO payment_circuit_state (acquirer_id, open_until)
+            VALUES (%s, (now() at time zone 'UTC') + make_interval(secs => %s))
+            ON CONFLICT (acquirer_id) DO UPDATE
+               SET open_until = EXCLUDED.open_until, probe_until = NULL
+        """, [guard.acquirer_id, guard.settings.open_duration])
+        self._set_open_until(guard.dbname, guard.acquirer_id, time.time() + guard.settings.open_duration)
+
+    def reset(self, dbname, acquirer_id):
+        """ Close the circuit of an acquirer. """
+        self._execute(dbname, "DELETE FROM payment_circuit_state WHERE acquirer_id = %s", [acquirer_id])
+        self._set_open_until(dbname, acquirer_id, None)
+
+
+breaker = CircuitBreaker()
@@ -0,0 +1,51 @@
+import hmac
+
+from odoo import http
+from odoo.http import request
+
+from odoo.addons.payment.controllers.portal import PaymentProcessing
+
+from odoo.addons.l10n_ir_payment import metrics, status
+
+
+def render_pay_retry(tx, message):
+    """ Render the page showing why the payment of ``tx`` could not be started for now, from which the customer
+    submits it again. """
+    return request.render('l10n_ir_payment.pay_retry', {
+        'message': message,
+        'pay_url': tx.acquirer_id._ir_pay_route(),
+        'reference': tx.reference,
+        'token': tx._ir_get_pay_token(),
+    })
+
+
+class IrPaymentController(http.Controller):
+
+    @http.route('/payment/ir/metrics', type='http', auth='public', methods=['GET'], csrf=False, save_session=False)
+    def payment_gateway_metrics(self, token=None, **kwargs):
+        """ Prometheus endpoint, enabled by setting the ``l10n_ir_payment.metrics_token`` system parameter. """
+        expected = request.env['ir.config_parameter'].sudo().get_param('l10n_ir_payment.metrics_token')
+        auth = request.httprequest.headers.get('Authorization', '')
+        token = token or (auth[7:] if auth.startswith('Bearer ') else None)
+        if not expected or not token or not hmac.compare_digest(expected, token):
+            return request.not_found()
+        columns = ['kind', 'provider', 'acquirer_id', 'method', 'code', 'count', 'duration_sum']
+        columns += ['bucket_%s' % (i + 1) for i in range(len(metrics.BUCKETS))]
+        request.env.cr.execute('SELECT %s FROM payment_gateway_metric ORDER BY provider, acquirer_id, method, code' % ', '.join(columns))
+        rows = request.env.cr.dictfetchall()
+        return request.make_response(
+            metrics.render_prometheus(rows), headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
+
+    @http.route('/longpolling/payment/ir/status', type='json', auth='none')
+    def payment_status(self, states=None, **kwargs):
+        """ Long-polling companion of ``/payment/process/poll``: wait until the state of a transaction of the
+        session differs from ``states``, the state by reference last polled by the client.
+
+        The route opens no cursor of its own, which would be held while waiting: the states are read once with a
+        short-lived one, then the request sleeps until the transactions are notified or the timeout expires.
+        Returns ``{'changed': None}`` when none of the transactions is notified, and the client polls instead.
+        """
+        tx_ids = PaymentProcessing.get_payment_transaction_ids()
+        if not request.db or not tx_ids or not isinstance(states, dict):
+            return {'changed': None}
+        return {'changed': status.wait_for_change(request.db, tx_ids, states)}
@@ -0,0 +1,63 @@
+"""Time budget of a request.
+
+A controller opens a :func:`request_scope` when a request comes in, and the
+payment code wraps each operation in a :func:`budget` configured on its
+acquirer, e.g. 20 seconds to verify and settle a payment on callback. The
+budget counts from the start of the request, so the time already spent in the
+ORM is taken from it. Gateway calls made within the budget get only the time
+left as timeout, and are not sent at all once it is used up: the work left is
+then handed over to the background jobs.
+
+The budget is kept per thread. Background jobs have none, and the worker
+threads of a batch do not inherit the one of their caller.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+_local = threading.local()
+
+
+@contextmanager
+def request_scope():
+    """ Mark the start of a request: the budgets opened within it count the time elapsed since. """
+    previous = getattr(_local, 'started', None)
+    _local.started = time.monotonic()
+    try:
+        yield
+    finally:
+        _local.started = previous
+
+
+@contextmanager
+def budget(seconds):
+    """ Give the block ``seconds`` from the start of the request, or from now outside of a request. Nested
+    budgets can only shorten the one they are in; ``0`` or None leaves it as is. """
+    previous = getattr(_local, 'deadline', None)
+    if seconds and seconds > 0:
+        start = getattr(_local, 'started', None) or time.monotonic()
+        deadline = start + seconds
+        _local.deadline = deadline if previous is None else min(previous, deadline)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def remaining():
+    """ Return the seconds left in the current budget, None without budget. """
+    deadline = getattr(_local, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def bound(timeout):
+    """ Return ``timeout``, a number of seconds or a ``(connect, read)`` pair, shortened to the time left. """
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, 0.0)
+    if isinstance(timeout, tuple):
+        return tuple(min(t, left) for t in timeout)
+    return min(timeout, left)
@@ -0,0 +1,186 @@
+"""Structured logging of the payment events.
+
+Payment modules log events rather than sentences::
+
+    _logger = eventlog.getLogger(__name__, 'zarinpal')
+    _logger.info('callback.received', payload=get, remote_addr=addr, sample=True)
+
+which gives ``zarinpal callback.received payload={"Authority": "****a1b2", ...}
+remote_addr=...``. The line is only formatted when a handler actually writes
+it, and fields carrying secrets, personal data or payment identifiers are
+redacted whatever the level: secrets are removed, personal data and
+identifiers keep their last four characters so that support can still match
+them with the customer and the bank.
+
+``sample=True`` marks frequent, successful events: below the warning level
+they are only logged for the share of them set by the
+``payment_log_sample_rate`` option of the configuration file (1 by default,
+all of them). Debug logging disables the sampling.
+
+``audit=True`` also writes the event, never sampled, as a JSON line to the
+``odoo.addons.l10n_ir_payment.audit`` logger. When the configuration file sets
+``payment_audit_log``, that logger writes to this file only.
+"""
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+
+from odoo.tools import config
+
+AUDIT_LOGGER = 'odoo.addons.l10n_ir_payment.audit'
+
+# field names are compared lowercased and without underscores
+SECRETS = {
+    'password', 'bppassword', 'username', 'bpusername', 'merchantid', 'zarinpalmerchantid', 'terminalid',
+    'bpterminalid', 'token', 'cardhash', 'cardholderinfo',
+}
+IDENTIFIERS = {
+    'authority', 'refid', 'salereferenceid', 'cardpan', 'cardholderpan', 'acquirerreference',
+    'behpardakhtrefid', 'behpardakhtsalereferenceid', 'zarinpaltxrefid',
+}
+# personal data of the customers, e.g. the metadata of the ZarinPal payment requests
+PERSONAL = {'mobile', 'email', 'phone', 'partnerphone', 'partneremail'}
+
+_audit_lock = threading.Lock()
+_audit_ready = False
+
+
+def _normalize(key):
+    return str(key).lower().replace('_', '')
+
+
+def mask(value):
+    """ Return ``value`` with all but its last four characters hidden. """
+    value = str(value)
+    if len(value) <= 4:
+        return '****'
+    return '****' + value[-4:]
+
+
+def redact(key, value, mask_identifiers=True):
+    """ Return ``value`` as it may be logged under ``key``, recursing into dicts and lists. Personal data is
+    masked even when identifiers are not. """
+    name = _normalize(key)
+    if name in SECRETS:
+        return '[redacted]'
+    if isinstance(value, dict):
+        return {k: redact(k, v, mask_identifiers) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(key, v, mask_identifiers) for v in value]
+    if (name in PERSONAL or mask_identifiers and name in IDENTIFIERS) and value not in (None, False, ''):
+        return mask(value)
+    return value
+
+
+def _format_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, ensure_ascii=False, sort_keys=True)
+    value = str(value)
+    if not value or any(c in value for c in ' ="\n'):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+class Event(object):
+    """ Logged event, only rendered when a handler formats it. """
+    __slots__ = ('provider', 'name', 'fields', 'created')
+
+    def __init__(self, provider, name, fields):
+        self.provider = provider
+        self.name = name
+        self.fields = fields
+        self.created = datetime.datetime.utcnow()
+
+    def redacted(self):
+        return {key: redact(key, value) for key, value in self.fields.items()}
+
+    def __str__(self):
+        parts = [self.provider, self.name] if self.provider else [self.name]
+        parts.extend('%s=%s' % (key, _format_value(value)) for key, value in self.redacted().items())
+        return ' '.join(parts)
+
+
+class AuditEvent(Event):
+    __slots__ = ()
+
+    def __str__(self):
+        record = {
+            'ts': self.created.isoformat() + 'Z',
+            'db': getattr(threading.current_thread(), 'dbname', None),
+            'pid': os.getpid(),
+            'provider': self.provider,
+            'event': self.name,
+        }
+        record.update(self.redacted())
+        return json.dumps(record, default=str, ensure_ascii=False)
+
+
+def _setup_audit():
+    global _audit_ready
+    if _audit_ready:
+        return
+    with _audit_lock:
+        if _audit_ready:
+            return
+        path = config.get('payment_audit_log')
+        if path:
+            logger = logging.getLogger(AUDIT_LOGGER)
+            handler = logging.handlers.WatchedFileHandler(path)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+        _audit_ready = True
+
+
+def sample_rate():
+    try:
+        return float(config.get('payment_log_sample_rate') or 1.0)
+    except ValueError:
+        return 1.0
+
+
+class EventLogger(object):
+    """ Logger of the events of a payment provider, see the module documentation. """
+
+    def __init__(self, name, provider=None):
+        self.logger = logging.getLogger(name)
+        self.provider = provider
+
+    def log(self, level, event, sample=False, audit=False, exc_info=False, **fields):
+        if audit:
+            _setup_audit()
+            audit_logger = logging.getLogger(AUDIT_LOGGER)
+            if audit_logger.isEnabledFor(logging.INFO):
+                audit_logger.info('%s', AuditEvent(self.provider, event, fields))
+        if not self.logger.isEnabledFor(level):
+            return
+        if sample and level < logging.WARNING and not self.logger.isEnabledFor(logging.DEBUG):
+            rate = sample_rate()
+            if rate < 1.0 and random.random() >= rate:
+                return
+        self.logger.log(level, '%s', Event(self.provider, event, fields), exc_info=exc_info)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event, **fields):
+        fields.setdefault('exc_info', True)
+        self.log(logging.ERROR, event, **fields)
+
+
+def getLogger(name, provider=None):
+    return EventLogger(name, provider)
@@ -0,0 +1,332 @@
+"""Gateway client layer shared by the Iranian payment acquirers.
+
+A :class:`GatewayCall` performs one kind of request against a bank gateway,
+e.g. ZarinPal's verify or Mellat's bpSettleRequest. It goes through the
+circuit breaker of its acquirer, records metrics and journals the exchange,
+and turns transport failures into :class:`GatewayTransportError`, whatever the
+underlying stack.
+
+A call holds no ORM record. It can be sent synchronously with
+:meth:`GatewayCall.send`, or many times concurrently from a single thread with
+:func:`run_batch`. The batch runs on an asyncio event loop. Calls that have a
+non-blocking implementation use it; for the others the blocking ``send`` runs
+in a bounded pool of threads.
+
+A synchronous call only gets the time left in the budget of the request, see
+:mod:`~odoo.addons.l10n_ir_payment.deadline`.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from odoo.exceptions import ValidationError
+
+from odoo.addons.l10n_ir_payment import deadline
+from odoo.addons.l10n_ir_payment.metrics import connection_count
+
+_logger = logging.getLogger(__name__)
+
+# times a call of a batch asks again for a rate limited slot before giving up
+BATCH_RATE_LIMIT_RETRIES = 10
+# calls are not sent with less time than this left in the budget of the request
+MIN_CALL_TIME = 0.5
+
+
+class GatewayError(Exception):
+    """ Base class of the errors raised by gateway calls. """
+
+
+class GatewayTransportError(GatewayError):
+    """ The gateway could not be reached, or answered with a server error. """
+
+
+class DeadlineExceeded(GatewayError):
+    """ Raised instead of calling a gateway when the time budget of the request is used up. """
+
+
+class RetryLater(ValidationError):
+    """ A payment could not be started because its gateway was unreachable, busy or out of time, not because it
+    refused the payment: the transaction is left as it is, and the customer may submit it again. """
+
+
+def load_httpx():
+    """ Return the ``httpx`` module, or None when it is not installed. """
+    try:
+        import httpx
+    except ImportError:
+        return None
+    return httpx
+
+
+class BatchContext(object):
+    """ Resources shared by the calls of one :func:`run_batch`: its event loop, the thread pool that blocking
+    calls run in, and clients opened for the batch (closed with it). """
+
+    def __init__(self, loop, executor, concurrency):
+        self.loop = loop
+        self.executor = executor
+        self.concurrency = concurrency
+        self._resources = {}
+
+    def run_sync(self, func, *args):
+        """ Run the blocking ``func`` in the thread pool of the batch and return an awaitable of its result. """
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def resource(self, key, factory):
+        """ Return the resource registered under ``key``, creating it with ``factory()`` on first use. """
+        resource = self._resources.get(key)
+        if resource is None:
+            resource = self._resources[key] = factory()
+        return resource
+
+    async def aclose(self):
+        for resource in self._resources.values():
+            try:
+                if hasattr(resource, 'aclose'):
+                    await resource.aclose()
+                elif hasattr(resource, 'close'):
+                    resource.close()
+            except Exception:
+                _logger.warning('Unable to close %r', resource, exc_info=True)
+        self._resources.clear()
+
+
+class GatewayCall(object):
+    """ One kind of gateway request of an acquirer.
+
+    Subclasses implement :meth:`_send`, and :meth:`_asend` when they have a
+    non-blocking implementation. Both return a ``(result, code)`` pair, where
+    ``code`` is the result code recorded in the metrics.
+    """
+    # exceptions meaning the gateway could not be reached
+    transport_errors = (requests.exceptions.RequestException,)
+
+    def __init__(self, method, scope=None, guard=None, limiter=None, tracker=None, journal=None):
+        self.method = method
+        self.scope = scope
+        self.guard = guard
+        self.limiter = limiter
+        self.tracker = tracker
+        self.journal = journal
+
+    def _send(self, payload):
+        raise NotImplementedError()
+
+    async def _asend(self, payload, context):
+        return await context.run_sync(self._send, payload)
+
+    def _get_transport_errors(self):
+        return self.transport_errors
+
+    def _error_code(self, error):
+        """ Result code recorded for the transport error ``error``. """
+        return 'transport_error'
+
+    def _is_failure(self, code):
+        """ Whether a call answered with ``code`` counts as a failure for the circuit breaker. """
+        return code in ('error', 'transport_error')
+
+    def _on_transport_error(self):
+        """ Hook called when the gateway could not be reached. """
+
+    def _journal_reference(self, payload, result):
+        """ Return the identifier of the payment a call is about, as recorded in the journal. """
+        return None
+
+    def _time_left(self):
+        """ Return the seconds left in the budget of the request, None without budget.
+
+            :raise DeadlineExceeded: when too little time is left to send the call
+        """
+        left = deadline.remaining()
+        if left is not None and left < MIN_CALL_TIME:
+            if self.scope:
+                self.scope.event('deadline', 'exceeded')
+            raise DeadlineExceeded('No time left to call the payment gateway.')
+        return left
+
+    def _before(self):
+        probe = self.guard.before() if self.guard else False
+        if self.tracker:
+            self.tracker.start()
+        return probe
+
+    def _after(self, probe, code, started, payload, result, error):
+        duration = time.monotonic() - started
+        if self.scope:
+            self.scope.observe(self.method, code, duration)
+        if self.guard:
+            self.guard.after(probe, self._is_failure(code), duration)
+        if self.tracker:
+            self.tracker.done(self._is_failure(code))
+        if self.journal:
+            self.journal.record(self, payload, result, code, duration, error)
+
+    def send(self, payload):
+        """ Send ``payload`` and return the answer of the gateway.
+
+            :raise DeadlineExceeded: when the budget of the request is used up
+            :raise RateLimited: when the call would wait too long for its turn
+            :raise GatewayUnavailable: when the circuit of the acquirer is open
+            :raise GatewayTransportError: when the gateway could not be reached
+        """
+        left = self._time_left()
+        if self.limiter:
+            # waiting for a slot must leave time for the call itself
+            max_wait = None if left is None else min(self.limiter.max_wait, left - MIN_CALL_TIME)
+            wait = self.limiter.reserve(max_wait)
+            if wait:
+                time.sleep(wait)
+                self._time_left()
+        probe = self._before()
+        started = time.monotonic()
+        code = 'error'
+        result = error = None
+        try:
+            result, code = self._send(payload)
+            return result
+        except self._get_transport_errors() as e:
+            code = self._error_code(e)
+            error = e
+            self._on_transport_error()
+            raise GatewayTransportError(str(e)) from e
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._after(probe, code, started, payload, result, error)
+
+    async def _areserve(self, context):
+        # batches are background work: rather than failing, they leave the free slots to the checkouts and
+        # ask again later. The semaphore of the batch bounds the slots they hold at any time.
+        from odoo.addons.l10n_ir_payment.ratelimit import RateLimited
+
+        for attempt in range(BATCH_RATE_LIMIT_RETRIES):
+            try:
+                # a database round trip, kept off the event loop
+                wait = await context.run_sync(self.limiter.reserve)
+                break
+            except RateLimited:
+                if attempt == BATCH_RATE_LIMIT_RETRIES - 1:
+                    raise
+                await asyncio.sleep(max(self.limiter.max_wait, 1.0))
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def asend(self, payload, context):
+        """ Coroutine version of :meth:`send`, to be awaited within :func:`run_batch`. """
+        if self.limiter:
+            await self._areserve(context)
+        # the breaker, the metrics and the journal may reach the database as well
+        probe = await context.run_sync(self._before)
+        started = time.monotonic()
+        code = 'error'
+        result = error = None
+        try:
+            result, code = await self._asend(payload, context)
+            return result
+        except self._get_transport_errors() as e:
+            code = self._error_code(e)
+            error = e
+            self._on_transport_error()
+            raise GatewayTransportError(str(e)) from e
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            await context.run_sync(self._after, probe, code, started, payload, result, error)
+
+
+class RestCall(GatewayCall):
+    """ JSON POST to a REST gateway, through a pooled ``requests`` session or, in batches and when httpx is
+    installed, through a non-blocking httpx client. """
+
+    def __init__(self, method, url, session, timeout, retries=0, scope=None, guard=None, limiter=None, tracker=None,
+                 journal=None, headers=None):
+        super(RestCall, self).__init__(method, scope, guard, limiter, tracker, journal)
+        self.url = url
+        self.session = session
+        self.timeout = timeout
+        self.retries = retries
+        self.headers = headers
+
+    def _get_transport_errors(self):
+        httpx = load_httpx()
+        if httpx is None:
+            return self.transport_errors
+        return self.transport_errors + (httpx.TransportError, httpx.HTTPStatusError)
+
+    def _error_code(self, error):
+        response = getattr(error, 'response', None)
+        if response is not None:
+            return 'http_%s' % response.status_code
+        return super(RestCall, self)._error_code(error)
+
+    def _is_failure(self, code):
+        return super(RestCall, self)._is_failure(code) or str(code).startswith('http_5')
+
+    def _result_code(self, response):
+        """ Return the result code of a decoded answer of the gateway, None when it has none. """
+        return None
+
+    def _decode(self, status, response):
+        return response, self._result_code(response) or 'http_%s' % status
+
+    def _send(self, payload):
+        connections = connection_count(self.session)
+        req = self.session.post(self.url, json=payload, headers=self.headers, timeout=deadline.bound(self.timeout))
+        if self.scope:
+            self.scope.event('connection', 'new' if connection_count(self.session) > connections else 'reused')
+        req.raise_for_status()
+        return self._decode(req.status_code, req.json())
+
+    async def _asend(self, payload, context):
+        httpx = load_httpx()
+        if httpx is None:
+            return await super(RestCall, self)._asend(payload, context)
+        connect, read = self.timeout if isinstance(self.timeout, tuple) else (self.timeout, self.timeout)
+        client = context.resource(('httpx', connect, read, self.retries), lambda: httpx.AsyncClient(
+            headers={'accept': 'application/json'},
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=context.concurrency),
+            transport=httpx.AsyncHTTPTransport(retries=self.retries),
+        ))
+        req = await client.post(self.url, json=payload, headers=self.headers)
+        req.raise_for_status()
+        return self._decode(req.status_code, req.json())
+
+
+async def _gather(call, payloads, concurrency, context):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(payload):
+        async with semaphore:
+            return await call.asend(payload, context)
+
+    try:
+        return await asyncio.gather(*[send(payload) for payload in payloads], return_exceptions=True)
+    finally:
+        await context.aclose()
+
+
+def run_batch(call, payloads, concurrency=10):
+    """ Send every payload of ``payloads`` with ``call``, at most ``concurrency`` at a time, and return the
+    answers in the same order. A payload whose call failed gets the exception raised instead of an answer.
+
+    Must not be called from a running event loop.
+    """
+    payloads = list(payloads)
+    if not payloads:
+        return []
+    concurrency = max(concurrency, 1)
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='gateway')
+    try:
+        context = BatchContext(loop, executor, concurrency)
+        return loop.run_until_complete(_gather(call, payloads, concurrency, context))
+    finally:
+        executor.shutdown(wait=True)
+        loop.close()
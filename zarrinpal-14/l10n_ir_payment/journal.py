@@ -0,0 +1,86 @@
+"""Journal of the requests sent to the payment gateways and of their answers.
+
+The gateway calls made within a database transaction are buffered in a
+:class:`Journal` and written to ``payment_gateway_event`` in a single
+multi-row statement just before the transaction commits. When it is rolled
+back, e.g. because a checkout failed, they are written in a transaction of
+their own: those are the calls one wants to look at afterwards.
+"""
+import datetime
+import json
+import logging
+import threading
+
+from odoo.addons.l10n_ir_payment import eventlog
+
+_logger = logging.getLogger(__name__)
+
+
+def _dump(value):
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(eventlog.redact(None, value, mask_identifiers=False), default=str, ensure_ascii=False)
+
+
+class Journal(object):
+    """ Gateway calls of one database transaction, waiting to be written.
+
+    Calls of a batch record themselves from the worker threads of the batch.
+    """
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self._lock = threading.Lock()
+        self._entries = []
+
+    def record(self, call, payload, result, code, duration, error=None):
+        scope = call.scope
+        entry = (
+            datetime.datetime.utcnow(),
+            scope.provider if scope else None,
+            scope.acquirer_id if scope else None,
+            call.method,
+            str(code),
+            duration * 1000,
+            call._journal_reference(payload, result),
+            _dump(payload),
+            _dump(result),
+            str(error) if error is not None else None,
+        )
+        with self._lock:
+            self._entries.append(entry)
+
+    def _pop(self):
+        with self._lock:
+            entries, self._entries = self._entries, []
+        return entries
+
+    def flush(self, cr):
+        """ Write the buffered calls with the cursor ``cr``. """
+        _insert(cr, self._pop())
+
+    def flush_apart(self):
+        """ Write the buffered calls in a transaction of their own, the one they were made in being rolled back. """
+        from odoo.sql_db import db_connect
+
+        entries = self._pop()
+        if not entries:
+            return
+        try:
+            with db_connect(self.dbname).cursor() as cr:
+                _insert(cr, entries)
+        except Exception:
+            # the journal must never get in the way of payments
+            _logger.warning('Unable to journal %s payment gateway calls of %s', len(entries), self.dbname, exc_info=True)
+
+
+def _insert(cr, entries):
+    from psycopg2.extras import execute_values
+
+    if not entries:
+        return
+    execute_values(cr._obj, """
+        INSERT INTO payment_gateway_event
+            (create_date, provider, acquirer_id, method, code, duration, reference, request, response, error)
+        VALUES %s
+    """, entries, page_size=len(entries))
@@ -0,0 +1,203 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+_logger = logging.getLogger(__name__)
+
+# upper bounds, in seconds, of the gateway call duration histogram
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FLUSH_INTERVAL = 60
+
+GATEWAY_METHODS = ('request', 'verify', 'settle', 'inquiry', 'reversal', 'refund')
+
+
+class Scope(object):
+    """ Labels under which the gateway calls of an acquirer are recorded.
+
+    A scope holds no ORM record, so it can be handed to worker threads.
+    """
+    __slots__ = ('dbname', 'provider', 'acquirer_id')
+
+    def __init__(self, dbname, provider, acquirer_id):
+        self.dbname = dbname
+        self.provider = provider
+        self.acquirer_id = acquirer_id
+
+    def observe(self, method, code, duration):
+        collector.observe(self, method, code, duration)
+
+    def event(self, name, result, count=1):
+        collector.event(self, name, result, count)
+
+
+class MetricsCollector(object):
+    """ Per-process accumulator of gateway call metrics.
+
+    Recording a call only updates a few counters under a lock. Every
+    ``flush_interval`` seconds the accumulated deltas are added to the
+    ``payment_gateway_metric`` table in a single statement, which is where
+    metrics of all workers are aggregated. The deltas are flushed by a
+    background thread, so that an idle worker does not keep them, and when
+    the process exits, e.g. when a worker is recycled.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._flusher = None
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # deltas inherited from the parent process are flushed by the parent, its flusher is not running here
+            self._pending = {}
+            self._flusher = None
+            self._pid = os.getpid()
+
+    def _start_flusher(self):
+        # called under the lock
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run_flusher, name='payment-metrics', daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush_if_due()
+
+    def _row(self, dbname, key):
+        rows = self._pending.setdefault(dbname, {})
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = [0, 0.0] + [0] * len(BUCKETS)
+        return row
+
+    def observe(self, scope, method, code, duration):
+        key = ('call', scope.provider, scope.acquirer_id, method, str(code))
+        index = bisect_left(BUCKETS, duration)
+        with self._lock:
+            self._check_fork()
+            row = self._row(scope.dbname, key)
+            row[0] += 1
+            row[1] += duration
+            if index < len(BUCKETS):
+                row[2 + index] += 1
+            self._start_flusher()
+        self.flush_if_due()
+
+    def event(self, scope, name, result, count=1):
+        key = ('event', scope.provider, scope.acquirer_id, name, str(result))
+        with self._lock:
+            self._check_fork()
+            self._row(scope.dbname, key)[0] += count
+            self._start_flusher()
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Add the accumulated deltas to the database and reset them. """
+        with self._lock:
+            self._check_fork()
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        for dbname, rows in pending.items():
+            try:
+                _flush_rows(dbname, rows)
+            except Exception:
+                # metrics must never get in the way of payments
+                _logger.warning('Unable to flush payment gateway metrics of %s', dbname, exc_info=True)
+
+
+def _flush_rows(dbname, rows):
+    from psycopg2.extras import execute_values
+    from odoo.sql_db import db_connect
+
+    bucket_columns = ', '.join('bucket_%s' % (i + 1) for i in range(len(BUCKETS)))
+    bucket_updates = ', '.join(
+        'bucket_{0} = payment_gateway_metric.bucket_{0} + EXCLUDED.bucket_{0}'.format(i + 1) for i in range(len(BUCKETS)))
+    values = [key + tuple(row) for key, row in rows.items()]
+    with db_connect(dbname).cursor() as cr:
+        execute_values(cr._obj, """
+            INSERT INTO payment_gateway_metric
+                (kind, provider, acquirer_id, method, code, count, duration_sum, {buckets},
+                 create_date, write_date)
+            VALUES %s
+            ON CONFLICT (kind, acquirer_id, method, code) DO UPDATE SET
+                count = payment_gateway_metric.count + EXCLUDED.count,
+                duration_sum = payment_gateway_metric.duration_sum + EXCLUDED.duration_sum,
+                {updates},
+                write_date = EXCLUDED.write_date
+        """.format(buckets=bucket_columns, updates=bucket_updates), values,
+            template='(%s)' % ', '.join(['%s'] * (len(BUCKETS) + 7) + ["(now() at time zone 'UTC')"] * 2))
+
+
+def connection_count(session):
+    """ Number of connections opened so far by the pools of a ``requests`` session. """
+    total = 0
+    for adapter in session.adapters.values():
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                total += pool.num_connections
+    return total
+
+
+def render_prometheus(rows):
+    """ Render aggregated metric rows (dicts read from ``payment.gateway.metric``) in the Prometheus text format. """
+    def labels(**kw):
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in kw.items())
+
+    histograms = {}
+    lines = [
+        '# HELP payment_gateway_results_total Payment gateway calls by result code.',
+        '# TYPE payment_gateway_results_total counter',
+    ]
+    events = []
+    for row in rows:
+        base = dict(provider=row['provider'], acquirer=row['acquirer_id'], method=row['method'])
+        if row['kind'] == 'event':
+            events.append('payment_gateway_events_total%s %d' % (
+                labels(provider=row['provider'], acquirer=row['acquirer_id'], event=row['method'], result=row['code']),
+                row['count']))
+            continue
+        lines.append('payment_gateway_results_total%s %d' % (labels(code=row['code'], **base), row['count']))
+        histogram = histograms.setdefault(tuple(base.items()), [0, 0.0] + [0] * len(BUCKETS))
+        histogram[0] += row['count']
+        histogram[1] += row['duration_sum']
+        for i in range(len(BUCKETS)):
+            histogram[2 + i] += row['bucket_%s' % (i + 1)]
+
+    lines += [
+        '# HELP payment_gateway_request_duration_seconds Duration of payment gateway calls.',
+        '# TYPE payment_gateway_request_duration_seconds histogram',
+    ]
+    for base, histogram in histograms.items():
+        base = dict(base)
+        cumulated = 0
+        for bound, count in zip(BUCKETS, histogram[2:]):
+            cumulated += count
+            lines.append('payment_gateway_request_duration_seconds_bucket%s %d' % (labels(le=bound, **base), cumulated))
+        lines.append('payment_gateway_request_duration_seconds_bucket%s %d' % (labels(le='+Inf', **base), histogram[0]))
+        lines.append('payment_gateway_request_duration_seconds_sum%s %f' % (labels(**base), histogram[1]))
+        lines.append('payment_gateway_request_duration_seconds_count%s %d' % (labels(**base), histogram[0]))
+
+    lines += [
+        '# HELP payment_gateway_events_total Connection reuse, cache and other payment gateway events.',
+        '# TYPE payment_gateway_events_total counter',
+    ] + events
+    return '\n'.join(lines) + '\n'
+
+
+collector = MetricsCollector()
+# prefork workers leave through sys.exit when they are recycled
+atexit.register(collector.flush)
@@ -0,0 +1,8 @@
+from . import payment_acquirer
+from . import payment_acquirer_credential
+from . import payment_circuit_state
+from . import payment_gateway_event
+from . import payment_gateway_metric
+from . import payment_profile
+from . import payment_rate_bucket
+from . import payment_transaction
@@ -0,0 +1,309 @@
+from werkzeug import urls
+
+from odoo import _, fields, models, tools
+from odoo.exceptions import ValidationError
+
+from odoo.addons.l10n_ir_payment import circuit, deadline, journal, metrics, ratelimit, routing, snapshot
+
+
+class PaymentAcquirer(models.Model):
+    _inherit = 'payment.acquirer'
+
+    gateway_metric_ids = fields.One2many('payment.gateway.metric', 'acquirer_id', string='Gateway Metrics', readonly=True)
+
+    circuit_breaker = fields.Boolean(
+        'Circuit Breaker', default=True,
+        help='Stop sending requests to the gateway for a while when too many of them fail or are slow, '
+             'so that checkouts fail fast instead of waiting for a dead gateway.')
+    circuit_failure_rate = fields.Float(
+        'Failure Rate Threshold', default=0.5,
+        help='Share of failed or slow calls, between 0 and 1, that opens the circuit.')
+    circuit_slow_call = fields.Float(
+        'Slow Call Threshold', default=5.0, help='Seconds after which a gateway call counts as failed.')
+    circuit_min_calls = fields.Integer(
+        'Minimum Calls', default=10, help='Number of calls within the window needed before the circuit may open.')
+    circuit_window = fields.Integer('Window', default=60, help='Seconds of recent calls the failure rate is computed on.')
+    circuit_open_duration = fields.Integer(
+        'Open Duration', default=30,
+        help='Seconds the circuit stays open before a single probe call is let through.')
+    circuit_open_until = fields.Datetime('Circuit Open Until', compute='_compute_circuit_open_until')
+
+    rate_limit = fields.Boolean(
+        'Rate Limit', help='Throttle the calls sent to the gateway for this merchant or terminal, across all workers, '
+                           'to stay within the limits of the bank.')
+    rate_limit_rate = fields.Float('Calls per Second', default=10.0)
+    rate_limit_burst = fields.Integer('Burst', default=20, help='Number of calls that may be sent at once after an idle period.')
+    rate_limit_max_wait = fields.Float(
+        'Maximum Wait', default=3.0,
+        help='Seconds a call may wait for its turn. Calls that would wait longer fail at once.')
+
+    deadline_checkout = fields.Float(
+        'Checkout Budget', default=20.0,
+        help='Seconds the gateway calls made when a customer starts a payment may take in total. 0 for no limit.')
+    deadline_callback = fields.Float(
+        'Callback Budget', default=20.0,
+        help='Seconds the handling of a customer coming back from the gateway may take, counted from the start of '
+             'the request. Calls that do not fit in it are left to the background jobs. 0 for no limit.')
+
+    gateway_token_lifetime = fields.Integer(
+        'Payment Token Lifetime', default=10,
+        help='Minutes a payment token of the gateway is reused for. Tokens are only asked for when the customer '
+             'submits the payment form, and the same one is used again while the transaction and its amount do '
+             'not change.')
+
+    gateway_journal = fields.Boolean(
+        'Journal Gateway Calls', default=True,
+        help='Keep the requests sent to the gateway and its answers, e.g. to settle disputes without asking the bank.')
+
+    credential_ids = fields.One2many(
+        'payment.acquirer.credential', 'acquirer_id', string='Credentials', groups='base.group_system',
+        help='Merchants or terminals payments are spread over. When empty, the credentials of the acquirer are used.')
+    credential_routing = fields.Selection([
+        ('weighted', 'Weighted Round-Robin'),
+        ('least_loaded', 'Least Loaded'),
+    ], string='Routing', default='weighted', required=True,
+        help='How payments are spread over the credentials. Credentials whose recent calls fail as much as the '
+             'circuit breaker threshold are skipped while others are healthy.')
+
+    def write(self, vals):
+        res = super(PaymentAcquirer, self).write(vals)
+        # drop the configuration snapshots, in this worker and, through the registry signaling, in the others.
+        # This empties every ormcache of the registry, so only when the snapshot is affected.
+        if not self._ir_snapshot_fields().isdisjoint(vals):
+            self.clear_caches()
+        return res
+
+    def unlink(self):
+        circuits = self.env['payment.circuit.state'].sudo().search([('acquirer_id', 'in', self.ids)])
+        res = super(PaymentAcquirer, self).unlink()
+        circuits.unlink()
+        self.clear_caches()
+        return res
+
+    def _compute_circuit_open_until(self):
+        circuits = self.env['payment.circuit.state'].sudo().search([('acquirer_id', 'in', self.ids)])
+        open_until = {circuit.acquirer_id: circuit.open_until for circuit in circuits}
+        for acquirer in self:
+            acquirer.circuit_open_until = open_until.get(acquirer.id, False)
+
+    # --------------------------------------------------
+    # Configuration snapshot
+    # --------------------------------------------------
+
+    def _ir_snapshot(self):
+        """ Return the :class:`~odoo.addons.l10n_ir_payment.snapshot.AcquirerSnapshot` of the configuration of this
+        acquirer, which the gateway code paths read instead of the records. """
+        self.ensure_one()
+        return self._ir_build_snapshot(self.id)
+
+    @tools.ormcache('acquirer_id')
+    def _ir_build_snapshot(self, acquirer_id):
+        acquirer = self.sudo().with_context(active_test=False).browse(acquirer_id)
+        return acquirer._ir_snapshot_class()(**acquirer._ir_snapshot_values())
+
+    def _ir_snapshot_class(self):
+        """ Return the class of the snapshot of this acquirer, see :meth:`_ir_snapshot_values`. """
+        return snapshot.AcquirerSnapshot
+
+    def _ir_snapshot_fields(self):
+        """ Return the names of the fields :meth:`_ir_snapshot_values` reads. Writing other fields keeps the
+        snapshots; providers extend it with their own fields. """
+        return {
+            'provider', 'state', 'website_id', 'credential_ids', 'credential_routing',
+            'circuit_breaker', 'circuit_failure_rate', 'circuit_slow_call', 'circuit_min_calls', 'circuit_window',
+            'circuit_open_duration',
+            'rate_limit', 'rate_limit_rate', 'rate_limit_burst', 'rate_limit_max_wait',
+            'deadline_checkout', 'deadline_callback', 'gateway_journal', 'gateway_token_lifetime',
+            'fees_active', 'fees_dom_fixed', 'fees_dom_var', 'fees_int_fixed', 'fees_int_var',
+        }
+
+    def _ir_snapshot_values(self):
+        """ Return the attributes of the snapshot of this acquirer. Called as superuser; providers extend both
+        the values and :meth:`_ir_snapshot_class`. """
+        self.ensure_one()
+        return {
+            'id': self.id,
+            'provider': self.provider,
+            'dbname': self.env.cr.dbname,
+            'base_url': self._ir_get_base_url(),
+            'params': snapshot.frozen(self._ir_gateway_params()),
+            'circuit': circuit.CircuitSettings(
+                enabled=self.circuit_breaker,
+                failure_rate=self.circuit_failure_rate,
+                slow_call=self.circuit_slow_call,
+                min_calls=max(self.circuit_min_calls, 1),
+                window=self.circuit_window,
+                open_duration=self.circuit_open_duration,
+            ),
+            'health': routing.HealthSettings(
+                failure_rate=self.circuit_failure_rate,
+                min_calls=max(self.circuit_min_calls, 1),
+                window=self.circuit_window,
+            ),
+            'rate_limit': self.rate_limit and self.rate_limit_rate > 0,
+            'rate_limit_key': self._ir_rate_limit_key(),
+            'rate_limit_rate': self.rate_limit_rate,
+            'rate_limit_burst': self.rate_limit_burst,
+            'rate_limit_max_wait': self.rate_limit_max_wait,
+            'deadline_checkout': self.deadline_checkout,
+            'deadline_callback': self.deadline_callback,
+            'gateway_journal': self.gateway_journal,
+            'token_lifetime': self.gateway_token_lifetime,
+            'credential_routing': self.credential_routing,
+            # archived credentials are kept: the payments made with them are still verified with them
+            'credentials': tuple(snapshot.CredentialSnapshot(
+                id=credential.id,
+                active=credential.active,
+                weight=credential.weight,
+                rate_limit_key=credential._ir_rate_limit_key(),
+                params=snapshot.frozen(credential._ir_gateway_params()),
+            ) for credential in self.credential_ids),
+            'fees_active': self.fees_active,
+            'fees_dom_fixed': self.fees_dom_fixed,
+            'fees_dom_var': self.fees_dom_var,
+            'fees_int_fixed': self.fees_int_fixed,
+            'fees_int_var': self.fees_int_var,
+        }
+
+    def _ir_get_base_url(self):
+        """ Return the base url of the callbacks of this acquirer. Unlike :meth:`get_base_url`, it does not depend
+        on the current request, so that it can be kept in the snapshot. """
+        self.ensure_one()
+        url = ''
+        if 'website_id' in self and self.website_id:
+            url = self.website_id._get_http_domain()
+        return url or self.env['ir.config_parameter'].sudo().get_param('web.base.url')
+
+    def _ir_gateway_params(self):
+        """ Return the parameters identifying the merchant in the gateway calls made with the credentials of
+        the acquirer itself. """
+        return {}
+
+    # --------------------------------------------------
+    # Gateway calls
+    # --------------------------------------------------
+
+    def _ir_metrics_scope(self):
+        """ Return the :class:`~odoo.addons.l10n_ir_payment.metrics.Scope` gateway calls of this acquirer are
+        recorded under. """
+        self.ensure_one()
+        config = self._ir_snapshot()
+        return metrics.Scope(config.dbname, config.provider, config.id)
+
+    def _ir_circuit_guard(self):
+        """ Return the :class:`~odoo.addons.l10n_ir_payment.circuit.Guard` protecting the gateway calls of this
+        acquirer. """
+        self.ensure_one()
+        config = self._ir_snapshot()
+        return circuit.Guard(config.dbname, config.id, config.circuit)
+
+    def _ir_check_circuit(self):
+        """ Fail fast when the gateway of this acquirer is known to be unavailable. """
+        self.ensure_one()
+        if self._ir_circuit_guard().is_open():
+            raise ValidationError(_('%s is temporarily unavailable. Please try again in a few minutes or choose '
+                                    'another payment method.') % self.name)
+
+    def _ir_select_credential(self):
+        """ Return the credential a new payment should be made with, or an empty recordset to use the
+        credentials of the acquirer itself. """
+        self.ensure_one()
+        config = self._ir_snapshot()
+        credentials = self.env['payment.acquirer.credential'].sudo()
+        candidates = [(credential.id, credential.weight) for credential in config.credentials if credential.active]
+        if not candidates:
+            return credentials
+        credential_id = routing.router.select(
+            config.dbname, config.id, candidates, config.credential_routing, config.health)
+        return credentials.browse(credential_id)
+
+    def _ir_health_settings(self):
+        self.ensure_one()
+        return self._ir_snapshot().health
+
+    def _ir_credential_tracker(self, credential):
+        """ Return the :class:`~odoo.addons.l10n_ir_payment.routing.Tracker` reporting the gateway calls made
+        with ``credential`` to the router, or None without credential. """
+        self.ensure_one()
+        if not credential:
+            return None
+        config = self._ir_snapshot()
+        return routing.Tracker(config.dbname, credential.id, config.health)
+
+    def _ir_deadline(self, operation):
+        """ Return the :func:`~odoo.addons.l10n_ir_payment.deadline.budget` of ``operation`` ('checkout' or
+        'callback') for this acquirer, to be used as a context manager. """
+        self.ensure_one()
+        return deadline.budget(getattr(self._ir_snapshot(), 'deadline_%s' % operation))
+
+    def _ir_rate_limit_key(self):
+        """ Return the key gateway calls of this acquirer are throttled under. Acquirers sharing a merchant or
+        terminal must share it, as the bank counts the calls of all of them together. """
+        self.ensure_one()
+        return '%s:%s' % (self.provider, self.id)
+
+    def _ir_rate_limiter(self, credential=None):
+        """ Return the :class:`~odoo.addons.l10n_ir_payment.ratelimit.RateLimiter` throttling the gateway calls of
+        this acquirer made with ``credential``, or None when they are not throttled. """
+        self.ensure_one()
+        config = self._ir_snapshot()
+        if not config.rate_limit:
+            return None
+        credential = config.credential(credential.id) if credential else None
+        key = credential.rate_limit_key if credential else config.rate_limit_key
+        return ratelimit.RateLimiter(
+            config.dbname, key, config.rate_limit_rate,
+            burst=config.rate_limit_burst, max_wait=config.rate_limit_max_wait, scope=self._ir_metrics_scope())
+
+    def _ir_gateway_journal(self):
+        """ Return the :class:`~odoo.addons.l10n_ir_payment.journal.Journal` the gateway calls of this acquirer
+        are buffered in until the current database transaction ends, or None when they are not journaled. """
+        self.ensure_one()
+        if not self._ir_snapshot().gateway_journal:
+            return None
+        cr = self.env.cr
+        gateway_journal = cr.precommit.data.get('l10n_ir_payment.journal')
+        if gateway_journal is None:
+            gateway_journal = cr.precommit.data['l10n_ir_payment.journal'] = journal.Journal(cr.dbname)
+            cr.precommit.add(lambda: gateway_journal.flush(cr))
+            cr.postrollback.add(gateway_journal.flush_apart)
+        return gateway_journal
+
+    # --------------------------------------------------
+    # Payment form
+    # --------------------------------------------------
+
+    def render(self, reference, amount, currency_id, partner_id=False, values=None):
+        # the form of acquirers issuing payment tokens posts to their pay route, which asks for the token
+        pay_url = self._ir_get_pay_url(reference)
+        acquirer = self.with_context(tx_url=pay_url) if pay_url else self
+        return super(PaymentAcquirer, acquirer).render(
+            reference, amount, currency_id, partner_id=partner_id, values=values)
+
+    def _ir_pay_route(self):
+        """ Return the route the payment form of this acquirer is submitted to when the gateway token is only
+        asked for at that time, None when the form posts to the gateway. """
+        return None
+
+    def _ir_get_pay_url(self, reference):
+        """ Return the url the payment form of the transaction ``reference`` is submitted to, see
+        :meth:`_ir_pay_route`. """
+        route = self._ir_pay_route()
+        if not route:
+            return None
+        tx = self.env['payment.transaction'].sudo().search([('reference', '=', reference)], limit=1)
+        if not tx:
+            return None
+        # each rendering used to cost a gateway call
+        self._ir_metrics_scope().event('token', 'deferred')
+        return '%s?%s' % (route, urls.url_encode({'reference': reference, 'token': tx._ir_get_pay_token()}))
+
+    def action_view_gateway_events(self):
+        self.ensure_one()
+        action = self.env['ir.actions.actions']._for_xml_id('l10n_ir_payment.action_payment_gateway_event')
+        action['domain'] = [('acquirer_id', '=', self.id)]
+        return action
+
+    def action_reset_circuit(self):
+        for acquirer in self:
+            circuit.breaker.reset(self.env.cr.dbname, acquirer.id)
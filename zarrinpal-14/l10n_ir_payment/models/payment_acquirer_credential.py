@@ -0,0 +1,41 @@
+from odoo import api, fields, models
+
+
+class PaymentAcquirerCredential(models.Model):
+    _name = 'payment.acquirer.credential'
+    _description = 'Payment Acquirer Credential'
+    _order = 'acquirer_id, sequence, id'
+
+    name = fields.Char(required=True)
+    acquirer_id = fields.Many2one('payment.acquirer', required=True, ondelete='cascade')
+    provider = fields.Selection(related='acquirer_id.provider')
+    sequence = fields.Integer(default=10)
+    active = fields.Boolean(default=True, help='Archived credentials get no new payment, but the payments made with '
+                                               'them are still verified and settled with them.')
+    weight = fields.Integer(default=1, help='Share of the payments sent with this credential, relative to the others.')
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        records = super(PaymentAcquirerCredential, self).create(vals_list)
+        # the credentials are part of the configuration snapshot of their acquirer
+        self.clear_caches()
+        return records
+
+    def write(self, vals):
+        res = super(PaymentAcquirerCredential, self).write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(PaymentAcquirerCredential, self).unlink()
+        self.clear_caches()
+        return res
+
+    def _ir_gateway_params(self):
+        """ Return the parameters identifying the merchant in the gateway calls made with this credential. """
+        return {}
+
+    def _ir_rate_limit_key(self):
+        """ Return the key gateway calls made with this credential are throttled under. """
+        self.ensure_one()
+        return '%s:credential:%s' % (self.provider, self.id)
@@ -0,0 +1,18 @@
+from odoo import fields, models
+
+
+class PaymentCircuitState(models.Model):
+    _name = 'payment.circuit.state'
+    _description = 'Payment Gateway Circuit State'
+    _order = 'acquirer_id'
+    _log_access = False
+
+    # no foreign key: the breaker updates this table on a cursor of its own, which must never wait for a
+    # request holding the row of the acquirer, see circuit.CircuitBreaker
+    acquirer_id = fields.Integer('Acquirer', required=True, readonly=True)
+    open_until = fields.Datetime('Open Until', readonly=True)
+    probe_until = fields.Datetime('Probe Until', readonly=True, help='End of the probe call let through while half-open.')
+
+    _sql_constraints = [
+        ('acquirer_uniq', 'unique(acquirer_id)', 'There is a single circuit per acquirer.'),
+    ]
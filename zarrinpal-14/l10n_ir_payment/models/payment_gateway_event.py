@@ -0,0 +1,52 @@
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+GC_BATCH_SIZE = 10000
+
+
+class PaymentGatewayEvent(models.Model):
+    _name = 'payment.gateway.event'
+    _description = 'Payment Gateway Journal'
+    _order = 'id desc'
+    _log_access = False
+
+    create_date = fields.Datetime('Date', readonly=True)
+    provider = fields.Char(readonly=True)
+    acquirer_id = fields.Many2one('payment.acquirer', readonly=True, ondelete='set null')
+    method = fields.Char(readonly=True)
+    code = fields.Char('Result Code', readonly=True)
+    duration = fields.Float('Duration (ms)', readonly=True)
+    reference = fields.Char(readonly=True, index=True, help='Payment the call is about: Mellat order id, ZarinPal authority.')
+    request = fields.Text(readonly=True, help='Payload sent to the gateway, without secrets nor personal data.')
+    response = fields.Text(readonly=True, help='Answer of the gateway, as received.')
+    error = fields.Text(readonly=True)
+
+    def init(self):
+        # the journal is append-only: a BRIN index keeps the retention cheap whatever its size
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS payment_gateway_event_create_date_brin
+            ON payment_gateway_event USING brin (create_date)
+        """)
+
+    def write(self, vals):
+        raise UserError(_('The payment gateway journal cannot be modified.'))
+
+    @api.autovacuum
+    def _gc_gateway_events(self):
+        """ Delete the journal entries older than the ``l10n_ir_payment.gateway_event_days`` system parameter
+        (30 days by default, 0 to keep them), in batches so that no long lock is held. """
+        days = int(self.env['ir.config_parameter'].sudo().get_param('l10n_ir_payment.gateway_event_days', 30))
+        if days <= 0:
+            return
+        while True:
+            self.env.cr.execute("""
+                DELETE FROM payment_gateway_event
+                 WHERE id IN (
+                    SELECT id FROM payment_gateway_event
+                     WHERE create_date < (now() at time zone 'UTC') - make_interval(days => %s)
+                     LIMIT %s
+                 )
+            """, [days, GC_BATCH_SIZE])
+            if self.env.cr.rowcount < GC_BATCH_SIZE:
+                break
+            self.env.cr.commit()
@@ -0,0 +1,36 @@
+from odoo import fields, models
+
+
+class PaymentGatewayMetric(models.Model):
+    _name = 'payment.gateway.metric'
+    _description = 'Payment Gateway Metric'
+    _order = 'provider, acquirer_id, kind, method, code'
+    _log_access = False
+
+    kind = fields.Selection([('call', 'Gateway Call'), ('event', 'Event')], required=True, readonly=True)
+    provider = fields.Char(required=True, readonly=True)
+    acquirer_id = fields.Many2one('payment.acquirer', required=True, readonly=True, ondelete='cascade')
+    method = fields.Char(required=True, readonly=True, help='Gateway method of a call, or name of an event.')
+    code = fields.Char(required=True, readonly=True, help='Result code of a call, or outcome of an event.')
+    count = fields.Integer(readonly=True, group_operator='sum')
+    duration_sum = fields.Float('Total Duration (s)', readonly=True, group_operator='sum')
+    # non-cumulative histogram of the call durations, bounds are metrics.BUCKETS
+    bucket_1 = fields.Integer('<= 50 ms', readonly=True, group_operator='sum')
+    bucket_2 = fields.Integer('<= 100 ms', readonly=True, group_operator='sum')
+    bucket_3 = fields.Integer('<= 250 ms', readonly=True, group_operator='sum')
+    bucket_4 = fields.Integer('<= 500 ms', readonly=True, group_operator='sum')
+    bucket_5 = fields.Integer('<= 1 s', readonly=True, group_operator='sum')
+    bucket_6 = fields.Integer('<= 2.5 s', readonly=True, group_operator='sum')
+    bucket_7 = fields.Integer('<= 5 s', readonly=True, group_operator='sum')
+    bucket_8 = fields.Integer('<= 10 s', readonly=True, group_operator='sum')
+    duration_avg = fields.Float('Average Duration (ms)', compute='_compute_duration_avg')
+    create_date = fields.Datetime('First Seen', readonly=True)
+    write_date = fields.Datetime('Last Seen', readonly=True)
+
+    _sql_constraints = [
+        ('metric_uniq', 'unique(kind, acquirer_id, method, code)', 'Metrics are aggregated by acquirer, method and code.'),
+    ]
+
+    def _compute_duration_avg(self):
+        for metric in self:
+            metric.duration_avg = metric.count and metric.duration_sum * 1000 / metric.count
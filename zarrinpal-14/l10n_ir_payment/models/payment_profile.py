@@ -0,0 +1,95 @@
+import base64
+import datetime
+import random
+from contextlib import contextmanager
+
+import odoo
+from odoo import SUPERUSER_ID, api, fields, models
+
+from odoo.addons.l10n_ir_payment import eventlog, profiler
+
+_logger = eventlog.getLogger(__name__)
+
+
+class PaymentProfile(models.Model):
+    _name = 'payment.profile'
+    _description = 'Payment Profile'
+    _order = 'id desc'
+
+    name = fields.Char('Operation', required=True, readonly=True)
+    provider = fields.Char(readonly=True)
+    duration = fields.Float('Duration (ms)', readonly=True)
+    sql_time = fields.Float('SQL (ms)', readonly=True)
+    remote_time = fields.Float('Remote (ms)', readonly=True)
+    cpu_time = fields.Float('Python (ms)', readonly=True)
+    samples = fields.Integer(readonly=True)
+    error = fields.Char(readonly=True, help='Exception the profiled operation ended with.')
+    stacks = fields.Binary(
+        'Folded Stacks', attachment=True, readonly=True,
+        help='Sampled stacks in the folded format of flamegraph.pl, also read by speedscope.')
+    stacks_filename = fields.Char(readonly=True)
+
+    def _ir_get_float_param(self, key, default):
+        try:
+            return float(self.env['ir.config_parameter'].sudo().get_param(key, default) or default)
+        except ValueError:
+            return default
+
+    @contextmanager
+    def _ir_profile(self, operation, provider):
+        """ Profile the code run within the context for the share of the calls set by the
+        ``l10n_ir_payment.profile_sample_rate`` system parameter (0 by default, between 0 and 1), sampling its
+        stack every ``l10n_ir_payment.profile_interval_ms`` milliseconds (20 by default). Calls nested in a profiled
+        one are part of its profile. """
+        rate = self._ir_get_float_param('l10n_ir_payment.profile_sample_rate', 0.0)
+        if rate <= 0 or profiler.is_active() or random.random() >= rate:
+            yield
+            return
+        sampler = profiler.start(self._ir_get_float_param('l10n_ir_payment.profile_interval_ms', 20.0) / 1000)
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            profiler.stop(sampler)
+            self._ir_store_profile(sampler, operation, provider, error)
+
+    def _ir_store_profile(self, sampler, operation, provider, error):
+        times = sampler.bucket_times()
+        values = {
+            'name': operation,
+            'provider': provider,
+            'duration': sampler.duration * 1000,
+            'sql_time': times['sql'] * 1000,
+            'remote_time': times['remote'] * 1000,
+            'cpu_time': times['cpu'] * 1000,
+            'samples': sum(sampler.samples.values()),
+            'error': error,
+            'stacks': base64.b64encode(sampler.folded().encode()),
+            'stacks_filename': '%s-%s-%s.folded' % (
+                provider, operation, datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')),
+        }
+        _logger.info('profile.recorded', operation=operation, duration='%.0fms' % values['duration'],
+                     sql='%.0fms' % values['sql_time'], remote='%.0fms' % values['remote_time'],
+                     cpu='%.0fms' % values['cpu_time'])
+        # in a transaction of its own: the profile of an operation that failed is kept
+        try:
+            with odoo.registry(self.env.cr.dbname).cursor() as cr:
+                self.with_env(self.env(cr=cr, user=SUPERUSER_ID)).create(values)
+        except Exception:
+            _logger.exception('profile.store_failed', operation=operation)
+
+    @api.autovacuum
+    def _gc_profiles(self):
+        """ Delete the profiles older than the ``l10n_ir_payment.profile_days`` system parameter (7 days by
+        default) and the ones beyond the ``l10n_ir_payment.profile_limit`` most recent (500 by default). """
+        days = int(self._ir_get_float_param('l10n_ir_payment.profile_days', 7))
+        limit = int(self._ir_get_float_param('l10n_ir_payment.profile_limit', 500))
+        profiles = self.browse()
+        if days > 0:
+            profiles |= self.search([('create_date', '<', fields.Datetime.now() - datetime.timedelta(days=days))])
+        if limit > 0:
+            profiles |= self.search([], offset=limit)
+        profiles.unlink()
@@ -0,0 +1,16 @@
+from odoo import fields, models
+
+
+class PaymentRateBucket(models.Model):
+    _name = 'payment.rate.bucket'
+    _description = 'Payment Gateway Rate Limit'
+    _order = 'key'
+    _log_access = False
+
+    key = fields.Char(required=True, readonly=True, help='Provider and merchant or terminal the calls are counted for.')
+    # theoretical arrival time of the next call, as a unix timestamp, see ratelimit.RateLimiter
+    tat = fields.Float('Next Free Slot', readonly=True)
+
+    _sql_constraints = [
+        ('key_uniq', 'unique(key)', 'There is a single rate limit per key.'),
+    ]
@@ -0,0 +1,400 @@
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from odoo import _, api, fields, models
+from odoo.exceptions import AccessError, UserError
+from odoo.tools import consteq, float_compare
+from odoo.tools.misc import hmac
+
+from odoo.addons.l10n_ir_payment import eventlog, reconciliation, status
+
+_logger = eventlog.getLogger(__name__)
+
+# minutes a refund batch may take before its transactions are taken over by another run
+REFUND_LEASE = 15
+REFUND_MAX_ATTEMPTS = 5
+
+
+class PaymentTransaction(models.Model):
+    _inherit = 'payment.transaction'
+
+    credential_id = fields.Many2one(
+        'payment.acquirer.credential', string='Credential', readonly=True, copy=False, ondelete='restrict',
+        help='Merchant or terminal the payment was made with. The gateway calls of the payment all use it.')
+
+    refund_state = fields.Selection([
+        ('queued', 'Queued'),
+        ('sent', 'Sent'),
+        ('done', 'Refunded'),
+        ('failed', 'Failed'),
+    ], string='Refund Status', readonly=True, copy=False, index=True)
+    refund_attempts = fields.Integer('Refund Attempts', readonly=True, copy=False)
+    refund_lease_until = fields.Datetime(readonly=True, copy=False)
+    refund_message = fields.Char('Refund Result', readonly=True, copy=False)
+    refund_date = fields.Datetime('Refund Date', readonly=True, copy=False)
+
+    def init(self):
+        super(PaymentTransaction, self).init()
+        # the reconciliation report selects the transactions of a period
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS payment_transaction_create_date_index
+            ON payment_transaction (create_date)
+        """)
+
+    def action_view_gateway_events(self):
+        """ Open the journal of the gateway calls made for this transaction. """
+        self.ensure_one()
+        action = self.env['ir.actions.actions']._for_xml_id('l10n_ir_payment.action_payment_gateway_event')
+        references = [str(self.id)] + ([self.acquirer_reference] if self.acquirer_reference else [])
+        action['domain'] = [('acquirer_id', '=', self.acquirer_id.id), ('reference', 'in', references)]
+        return action
+
+    # --------------------------------------------------
+    # Payment tokens
+    # --------------------------------------------------
+
+    def _ir_get_pay_token(self):
+        """ Return the signature of the pay url of this transaction, so that only the customer it was rendered
+        for asks the gateway for a token. """
+        self.ensure_one()
+        return hmac(self.env(su=True), 'l10n_ir_payment.pay', self.id)
+
+    @api.model
+    def _ir_get_pay_tx(self, provider, reference, token):
+        """ Return the transaction of ``provider`` whose payment form was submitted with ``reference`` and
+        ``token``, an empty recordset when they do not match. """
+        tx = self.sudo().search([('reference', '=', reference), ('provider', '=', provider)], limit=1) \
+            if reference else self.browse()
+        if not tx or not token or not consteq(tx._ir_get_pay_token(), token):
+            return self.browse()
+        return tx
+
+    def _ir_token_usable(self, expiry, amount):
+        """ Whether a gateway token issued for ``amount`` and valid until ``expiry`` may still be used to pay
+        this transaction. """
+        self.ensure_one()
+        return bool(expiry) and expiry > fields.Datetime.now() and \
+            float_compare(amount, self.amount, precision_rounding=self.currency_id.rounding) == 0
+
+    def _ir_lock_token(self):
+        """ Lock the row of this transaction until the end of the database transaction, waiting for a concurrent
+        submission of its payment form to have issued its token. """
+        self.ensure_one()
+        self.env.cr.execute('SELECT id FROM payment_transaction WHERE id = %s FOR UPDATE', [self.id])
+        self.invalidate_cache(ids=self.ids)
+
+    def _ir_token_expiry(self):
+        """ Return the expiry of a gateway token issued now for this transaction. """
+        self.ensure_one()
+        return fields.Datetime.now() + timedelta(minutes=self.acquirer_id._ir_snapshot().token_lifetime)
+
+    # --------------------------------------------------
+    # State notifications
+    # --------------------------------------------------
+
+    def _set_transaction_authorized(self):
+        res = super(PaymentTransaction, self)._set_transaction_authorized()
+        self._ir_notify_state()
+        return res
+
+    def _set_transaction_done(self):
+        res = super(PaymentTransaction, self)._set_transaction_done()
+        self._ir_notify_state()
+        return res
+
+    def _set_transaction_cancel(self):
+        res = super(PaymentTransaction, self)._set_transaction_cancel()
+        self._ir_notify_state()
+        return res
+
+    def _set_transaction_error(self, msg):
+        res = super(PaymentTransaction, self)._set_transaction_error(msg)
+        self._ir_notify_state()
+        return res
+
+    def _ir_notifies_state(self):
+        """ Whether the state changes of this transaction are notified to the status requests, see
+        :mod:`~odoo.addons.l10n_ir_payment.status`. """
+        return False
+
+    def _ir_notify_state(self):
+        txs = self.filtered(lambda tx: tx._ir_notifies_state())
+        if txs:
+            status.notify(self.env.cr, txs.ids)
+
+    # --------------------------------------------------
+    # Locking
+    # --------------------------------------------------
+
+    def _ir_lock(self):
+        """ Lock the rows of ``self`` until the end of the database transaction and return the records that
+        could be locked. Rows already locked by a concurrent request or job are skipped, not waited for. """
+        if not self.ids:
+            return self
+        self.env.cr.execute(
+            'SELECT id FROM payment_transaction WHERE id IN %s FOR UPDATE SKIP LOCKED', [tuple(self.ids)])
+        locked = self.browse([row[0] for row in self.env.cr.fetchall()])
+        # the request that held the lock may have changed the transactions
+        locked.invalidate_cache(ids=locked.ids)
+        return locked
+
+    def _ir_commit(self):
+        """ Commit the work of a scheduled action done so far, except in tests. """
+        if not getattr(threading.current_thread(), 'testing', False):
+            self.env.cr.commit()
+
+    # --------------------------------------------------
+    # Refunds
+    # --------------------------------------------------
+
+    def _ir_can_refund(self):
+        self.ensure_one()
+        return self.state in ('authorized', 'done') and self.refund_state not in ('queued', 'sent', 'done') and \
+            hasattr(self, '_%s_refund_batch' % self.provider)
+
+    def _ir_cancel_payments(self):
+        """ Cancel the payments of the refunded transactions of ``self`` that stay done. A payment whose journal
+        entry cannot be reset, e.g. in a locked period, is left posted: the reconciliation report flags it. """
+        for payment in self.mapped('payment_id').filtered(lambda payment: payment.state != 'cancel'):
+            try:
+                with self.env.cr.savepoint():
+                    if payment.state == 'posted':
+                        payment.action_draft()
+                    payment.action_cancel()
+            except UserError as e:
+                _logger.warning('refund.payment_not_cancelled', payment=payment.name, error=e.args[0], audit=True)
+
+    def _ir_queue_refunds(self):
+        """ Queue the refund of the transactions of ``self`` that can be refunded and return them. """
+        txs = self.filtered(lambda tx: tx._ir_can_refund())
+        txs.write({'refund_state': 'queued', 'refund_attempts': 0, 'refund_message': False})
+        return txs
+
+    def action_ir_refund(self):
+        """ Server action: queue the refunds and let the scheduled action send them. """
+        txs = self._ir_queue_refunds()
+        if not txs:
+            raise UserError(_('None of the selected payments can be refunded.'))
+        cron = self.env.ref('l10n_ir_payment.cron_ir_process_refunds', raise_if_not_found=False)
+        if cron:
+            cron._trigger()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Refunds queued'),
+                'message': _('%s of %s payments will be refunded in the background.') % (len(txs), len(self)),
+                'sticky': False,
+            },
+        }
+
+    def ir_bulk_refund(self, workers=None, chunk_size=100):
+        """ Refund the transactions of ``self`` now and return a report of the run.
+
+        Refunds are sent through the bounded worker pool of each acquirer and their progress is committed chunk by
+        chunk: after a crash, calling it again (or the scheduled action) resumes where it stopped. The result of
+        each transaction is kept in ``refund_state`` and ``refund_message``.
+
+            :param int workers: concurrent gateway calls, defaults to the background concurrency of the acquirer
+            :return: dict with the number of transactions ``done``, ``failed`` and ``retry`` (gateway not reached,
+                     queued again), the ``failed_ids``, the ``elapsed`` seconds and the ``throughput`` in tx/s
+        """
+        self._ir_queue_refunds()
+        return self._ir_process_refunds(workers=workers, chunk_size=chunk_size)
+
+    def _ir_claim_refunds(self):
+        """ Mark the refunds of ``self`` as sent and commit, so that no other run sends them again. Refunds sent
+        by a run that did not finish within its lease are taken over. """
+        if not self.ids:
+            return self
+        self.env.cr.execute("""
+            UPDATE payment_transaction
+               SET refund_state = 'sent',
+                   refund_attempts = COALESCE(refund_attempts, 0) + 1,
+                   refund_lease_until = (now() at time zone 'UTC') + make_interval(mins => %s)
+             WHERE id IN (
+                SELECT id FROM payment_transaction
+                 WHERE id IN %s
+                   AND (refund_state = 'queued'
+                        OR (refund_state = 'sent' AND refund_lease_until < (now() at time zone 'UTC')))
+                   FOR UPDATE SKIP LOCKED
+             )
+         RETURNING id
+        """, [REFUND_LEASE, tuple(self.ids)])
+        claimed = self.browse([row[0] for row in self.env.cr.fetchall()])
+        claimed.invalidate_cache(ids=claimed.ids)
+        self._ir_commit()
+        return claimed
+
+    def _ir_process_refunds(self, workers=None, chunk_size=100):
+        started = time.monotonic()
+        stats = Counter()
+        failed_ids = []
+        for acquirer in self.mapped('acquirer_id'):
+            method = '_%s_refund_batch' % acquirer.provider
+            if not hasattr(self, method):
+                continue
+            pending = self.filtered(lambda tx: tx.acquirer_id == acquirer and tx.refund_state in ('queued', 'sent'))
+            for index in range(0, len(pending), chunk_size):
+                txs = pending[index:index + chunk_size]._ir_claim_refunds()
+                if not txs:
+                    continue
+                results = getattr(txs, method)(acquirer, workers)
+                for tx in txs:
+                    success, message = results.get(tx, (None, _('No answer from the gateway')))
+                    if success is None and tx.refund_attempts < REFUND_MAX_ATTEMPTS:
+                        tx.write({'refund_state': 'queued', 'refund_lease_until': False, 'refund_message': message})
+                        stats['retry'] += 1
+                        _logger.info('refund.retry', provider=acquirer.provider, tx=tx.reference, reason=message)
+                    elif success:
+                        tx.write({'refund_state': 'done', 'refund_lease_until': False, 'refund_message': message,
+                                  'refund_date': fields.Datetime.now()})
+                        stats['done'] += 1
+                        _logger.info('refund.done', provider=acquirer.provider, tx=tx.reference,
+                                     amount=tx.amount, audit=True, sample=True)
+                    else:
+                        tx.write({'refund_state': 'failed', 'refund_lease_until': False, 'refund_message': message})
+                        failed_ids.append(tx.id)
+                        stats['failed'] += 1
+                        _logger.warning('refund.failed', provider=acquirer.provider, tx=tx.reference,
+                                        reason=message, audit=True)
+                self._ir_commit()
+        elapsed = time.monotonic() - started
+        total = stats['done'] + stats['failed'] + stats['retry']
+        report = {
+            'done': stats['done'],
+            'failed': stats['failed'],
+            'retry': stats['retry'],
+            'failed_ids': failed_ids,
+            'elapsed': elapsed,
+            'throughput': total / elapsed if elapsed else 0.0,
+        }
+        _logger.info(
+            'refund.batch', done=report['done'], failed=report['failed'], retry=report['retry'],
+            elapsed='%.2fs' % elapsed, throughput='%.1f' % report['throughput'])
+        return report
+
+    @api.model
+    def _cron_ir_process_refunds(self, chunk_size=100):
+        """ Send the queued refunds, and resume those of runs that stopped half-way. """
+        last_id = 0
+        report = Counter()
+        domain = ['|', ('refund_state', '=', 'queued'),
+                  '&', ('refund_state', '=', 'sent'), ('refund_lease_until', '<', fields.Datetime.now())]
+        while True:
+            txs = self.search(domain + [('id', '>', last_id)], order='id', limit=chunk_size)
+            if not txs:
+                break
+            last_id = txs[-1].id
+            run = txs._ir_process_refunds(chunk_size=chunk_size)
+            report.update({key: run[key] for key in ('done', 'failed', 'retry')})
+            self.invalidate_cache()
+        return report
+
+    # --------------------------------------------------
+    # Reconciliation report
+    # --------------------------------------------------
+
+    def _ir_reconciliation_columns(self):
+        """ Return the ``(key, label, sql)`` columns of the reconciliation report. ``sql`` selects the value from
+        the transaction ``t``, its acquirer ``a``, currency ``c``, payment ``p`` and journal entry ``m``. Columns
+        without label are only used to find the issues of the rows. Providers add the data of their gateway. """
+        return [
+            ('id', _('ID'), 't.id'),
+            ('reference', _('Reference'), 't.reference'),
+            ('acquirer', _('Acquirer'), 'a.name'),
+            ('provider', _('Provider'), 'a.provider'),
+            ('state', _('Status'), 't.state'),
+            ('create_date', _('Created on'), 't.create_date'),
+            ('date', _('Validated on'), 't.date'),
+            ('currency', _('Currency'), 'c.name'),
+            ('rounding', None, 'c.rounding'),
+            ('amount', _('Amount'), 't.amount'),
+            ('fees', _('Fees'), 't.fees'),
+            ('acquirer_reference', _('Acquirer Reference'), 't.acquirer_reference'),
+            ('refund_state', _('Refund Status'), 't.refund_state'),
+            ('payment', _('Payment'), 'm.name'),
+            ('payment_amount', _('Payment Amount'), 'p.amount'),
+            ('move_state', _('Journal Entry Status'), 'm.state'),
+        ]
+
+    def _ir_reconciliation_issues(self, row):
+        """ Return the issues of the report ``row``, a dict of the values by column key:
+
+        - ``missing_reference``: paid, but the gateway reference of the payment was not recorded
+        - ``missing_payment``: done, but no payment was created
+        - ``payment_not_posted``: the journal entry of the payment is not posted
+        - ``refund_not_booked``: refunded, but the journal entry of the payment is still posted
+        - ``amount_mismatch``: the payment is not of the amount of the transaction
+
+        Providers add ``missing_settlement`` and ``fee_mismatch`` from the data of their gateway.
+        """
+        issues = []
+        if row['state'] in ('authorized', 'done') and not row['acquirer_reference']:
+            issues.append('missing_reference')
+        if row['payment'] is None:
+            if row['state'] == 'done' and row['refund_state'] != 'done':
+                issues.append('missing_payment')
+            return issues
+        if row['refund_state'] == 'done':
+            if row['move_state'] == 'posted':
+                issues.append('refund_not_booked')
+        elif row['move_state'] != 'posted':
+            issues.append('payment_not_posted')
+        if float_compare(abs(row['amount']), row['payment_amount'], precision_rounding=row['rounding']):
+            issues.append('amount_mismatch')
+        return issues
+
+    def _ir_reconciliation_query(self, columns, date_from, date_to, acquirer_ids=None):
+        query = """
+            SELECT {}
+              FROM payment_transaction t
+              JOIN payment_acquirer a ON a.id = t.acquirer_id
+              JOIN res_currency c ON c.id = t.currency_id
+         LEFT JOIN account_payment p ON p.id = t.payment_id
+         LEFT JOIN account_move m ON m.id = p.move_id
+             WHERE t.create_date >= %s AND t.create_date < %s
+               AND (t.state IN ('authorized', 'done') OR t.payment_id IS NOT NULL OR t.refund_state IS NOT NULL)
+        """.format(', '.join(sql for _key, _label, sql in columns))
+        params = [date_from, date_to]
+        if acquirer_ids:
+            query += ' AND t.acquirer_id IN %s'
+            params.append(tuple(acquirer_ids))
+        return query + ' ORDER BY t.id', params
+
+    @api.model
+    def ir_reconciliation_report(self, fileobj, date_from, date_to, file_format='csv', acquirer_ids=None,
+                                 issues_only=False, batch_size=2000):
+        """ Write the reconciliation report of the transactions created from ``date_from`` (included) to
+        ``date_to`` (excluded) to the binary file ``fileobj``.
+
+        The transactions are compared with their payments and journal entries and with the data recorded from
+        their gateway; each row lists its issues. The rows are streamed from the database, in constant memory.
+
+            :param str file_format: 'csv' or 'xlsx'
+            :param bool issues_only: only export the transactions with issues
+            :return: Counter of the rows exported (``rows``) and of each issue
+        """
+        if not self.env.su and not self.env.user.has_group('account.group_account_manager'):
+            raise AccessError(_('Only accounting managers can export the payment reconciliation report.'))
+        columns = self._ir_reconciliation_columns()
+        keys = [key for key, _label, _sql in columns]
+        exported = [index for index, (_key, label, _sql) in enumerate(columns) if label]
+        writer = reconciliation.WRITERS[file_format](
+            fileobj, [columns[index][1] for index in exported] + [_('Issues')])
+        query, params = self._ir_reconciliation_query(columns, date_from, date_to, acquirer_ids)
+
+        stats = Counter()
+        self.flush()
+        for values in reconciliation.iter_rows(self.env.cr, query, params, batch_size=batch_size):
+            issues = self._ir_reconciliation_issues(dict(zip(keys, values)))
+            stats.update(issues)
+            if issues_only and not issues:
+                continue
+            writer.writerow([values[index] for index in exported] + [', '.join(issues)])
+            stats['rows'] += 1
+        writer.close()
+        _logger.info('reconciliation.exported', date_from=date_from, date_to=date_to, audit=True, **stats)
+        return stats
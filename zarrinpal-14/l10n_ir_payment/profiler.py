@@ -0,0 +1,114 @@
+"""Sampling profiler of the checkout and callback paths.
+
+A :class:`Sampler` runs in a thread of its own and, every few milliseconds,
+records the Python stack of the profiled thread, which is never interrupted
+nor instrumented. The stacks are aggregated in the folded format of
+flamegraph.pl and speedscope::
+
+    [sql];odoo/http.py:dispatch;...;odoo/sql_db.py:execute 12
+
+Each sample is put in one of three buckets, which prefix its stack:
+
+* ``sql``: waiting on PostgreSQL, the stack goes through ``odoo/sql_db.py``;
+* ``remote``: waiting on the network, the innermost frames are socket, TLS or
+  HTTP client reads, e.g. during a gateway call;
+* ``cpu``: running Python code, including the serialization of the gateway
+  requests.
+
+Profiling is not free, and not only for the profiled thread: each sample
+takes the GIL away from every thread of the worker for the time of walking the
+stack. Hence the coarse default interval, and profiles taken for a share of
+the calls only.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# innermost frames of a thread waiting on the network
+NETWORK_FILES = ('/socket.py', '/ssl.py', '/selectors.py', '/http/client.py', '/urllib3/connection.py')
+SQL_FILES = ('/odoo/sql_db.py',)
+BUCKETS = ('sql', 'remote', 'cpu')
+# innermost frames looked at to tell network waits
+NETWORK_DEPTH = 4
+
+_local = threading.local()
+
+
+def _frame_name(code):
+    directory, filename = os.path.split(code.co_filename)
+    return '%s/%s:%s' % (os.path.basename(directory), filename, code.co_name)
+
+
+class Sampler(object):
+    """ Samples the stack of ``thread_id`` every ``interval`` seconds until stopped. """
+
+    def __init__(self, thread_id, interval=0.02):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = Counter()
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._started = None
+        self._thread = threading.Thread(target=self._run, name='payment-profiler', daemon=True)
+
+    def start(self):
+        self._started = time.monotonic()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.monotonic() - self._started
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self._record(frame)
+
+    def _record(self, frame):
+        names = []
+        files = []
+        while frame is not None:
+            names.append(_frame_name(frame.f_code))
+            files.append(frame.f_code.co_filename)
+            frame = frame.f_back
+        if any(filename.endswith(SQL_FILES) for filename in files):
+            bucket = 'sql'
+        elif any(filename.endswith(NETWORK_FILES) for filename in files[:NETWORK_DEPTH]):
+            bucket = 'remote'
+        else:
+            bucket = 'cpu'
+        names.append('[%s]' % bucket)
+        self.samples[bucket] += 1
+        self.stacks[';'.join(reversed(names))] += 1
+
+    def bucket_times(self):
+        """ Return the seconds spent in each bucket, the duration being shared according to the samples. """
+        total = sum(self.samples.values())
+        return {bucket: self.duration * self.samples[bucket] / total if total else 0.0 for bucket in BUCKETS}
+
+    def folded(self):
+        """ Return the stacks in the folded format of flamegraph.pl. """
+        return ''.join('%s %d\n' % (stack, count) for stack, count in self.stacks.most_common())
+
+
+def is_active():
+    """ Whether the current thread is already being profiled. """
+    return getattr(_local, 'sampler', None) is not None
+
+
+def start(interval):
+    sampler = Sampler(threading.get_ident(), interval)
+    _local.sampler = sampler
+    return sampler.start()
+
+
+def stop(sampler):
+    _local.sampler = None
+    return sampler.stop()
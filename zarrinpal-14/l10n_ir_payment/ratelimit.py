@@ -0,0 +1,74 @@
+from odoo.addons.l10n_ir_payment import eventlog
+from odoo.addons.l10n_ir_payment.gateway import GatewayError
+
+_logger = eventlog.getLogger(__name__)
+
+
+class RateLimited(GatewayError):
+    """ Raised instead of calling a gateway when the call would have to wait longer than allowed for its turn. """
+
+
+class RateLimiter(object):
+    """ Token bucket shared by all workers through the ``payment_rate_bucket`` table.
+
+    The bucket is kept as the generic cell rate algorithm does: a single
+    "theoretical arrival time" per key, moved forward by ``1 / rate`` seconds
+    for every call, ``burst`` calls being allowed ahead of it. Taking a token is
+    one atomic statement that reserves the next free slot and returns how long
+    the caller must wait for it. Callers therefore form a first come, first
+    served queue, bounded by the longest wait they accept: a slot further away
+    than that is not reserved and the call fails at once.
+
+    Holds no ORM record, so it can be handed to worker threads.
+    """
+    __slots__ = ('dbname', 'key', 'rate', 'burst', 'max_wait', 'scope')
+
+    def __init__(self, dbname, key, rate, burst=1, max_wait=0.0, scope=None):
+        self.dbname = dbname
+        self.key = key
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_wait = max_wait
+        self.scope = scope
+
+    def reserve(self, max_wait=None):
+        """ Reserve a token and return the number of seconds to wait before using it.
+
+            :param float max_wait: longest acceptable wait, defaults to the one of the limiter
+            :raise RateLimited: when no token is available within ``max_wait`` seconds
+        """
+        if max_wait is None:
+            max_wait = self.max_wait
+        interval = 1.0 / self.rate
+        try:
+            wait = _reserve(self.dbname, self.key, interval, self.burst, max(max_wait, 0.0))
+        except Exception:
+            # the limiter must never be the reason a payment fails
+            _logger.warning('rate_limit.unavailable', key=eventlog.mask(self.key), exc_info=True)
+            return 0.0
+        if wait is None:
+            if self.scope:
+                self.scope.event('rate_limit', 'rejected')
+            _logger.info('rate_limit.rejected', key=eventlog.mask(self.key), max_wait=max_wait)
+            raise RateLimited('The payment gateway is busy, please try again in a moment.')
+        wait = max(wait, 0.0)
+        if self.scope:
+            self.scope.event('rate_limit', 'queued' if wait else 'immediate')
+        return wait
+
+
+def _reserve(dbname, key, interval, burst, max_wait):
+    from odoo.sql_db import db_connect
+
+    with db_connect(dbname).cursor() as cr:
+        # EXCLUDED.tat is "now + interval": the slot a call arriving on an idle bucket gets
+        cr.execute("""
+            INSERT INTO payment_rate_bucket AS b (key, tat)
+            VALUES (%(key)s, EXTRACT(EPOCH FROM now()) + %(interval)s)
+            ON CONFLICT (key) DO UPDATE
+               SET tat = GREATEST(b.tat + %(interval)s, EXCLUDED.tat)
+             WHERE GREATEST(b.tat + %(interval)s, EXCLUDED.tat) - EXCLUDED.tat <= %(allowance)s
+         RETURNING tat - EXTRACT(EPOCH FROM now()) - %(burst)s * %(interval)s
+        """, {'key': key, 'interval': interval, 'burst': burst, 'allowance': (burst - 1) * interval + max_wait})
+        row = cr.fetchone()
+    return row and row[0]
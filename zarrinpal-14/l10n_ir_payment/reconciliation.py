@@ -0,0 +1,88 @@
+"""Streaming export of the payment reconciliation report.
+
+Rows are read through a server-side cursor and written to the output file as
+they come, a batch at a time: the memory used does not depend on the number
+of transactions exported.
+"""
+import csv
+import io
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# rows of an xlsx worksheet, the report continues on a new sheet beyond
+XLSX_MAX_ROWS = 1048576
+
+
+def iter_rows(cr, query, params, batch_size=2000, name='payment_ir_reconciliation'):
+    """ Yield the rows of ``query``, fetched ``batch_size`` at a time through a server-side cursor opened on the
+    connection of ``cr``, within its transaction. """
+    with cr._cnx.cursor(name) as server_cr:
+        server_cr.itersize = batch_size
+        server_cr.execute(query, params)
+        while True:
+            rows = server_cr.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+
+class CsvWriter(object):
+    mimetype = 'text/csv'
+    extension = 'csv'
+
+    def __init__(self, fileobj, header):
+        # the BOM lets spreadsheet applications detect the encoding of Persian names
+        self._stream = io.TextIOWrapper(fileobj, encoding='utf-8-sig', newline='')
+        self._writer = csv.writer(self._stream)
+        self._writer.writerow(header)
+
+    def writerow(self, values):
+        self._writer.writerow(values)
+
+    def close(self):
+        self._stream.flush()
+        self._stream.detach()
+
+
+class XlsxWriter(object):
+    mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    extension = 'xlsx'
+
+    def __init__(self, fileobj, header):
+        if xlsxwriter is None:
+            raise ImportError('The xlsxwriter library is required to export xlsx files.')
+        # constant_memory flushes every row to a temporary file once the next one is started
+        self._workbook = xlsxwriter.Workbook(fileobj, {
+            'constant_memory': True,
+            'strings_to_formulas': False,
+            'strings_to_urls': False,
+            'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+        })
+        self._bold = self._workbook.add_format({'bold': True})
+        self._header = header
+        self._sheet = None
+        self._row = XLSX_MAX_ROWS
+
+    def writerow(self, values):
+        if self._row >= XLSX_MAX_ROWS:
+            self._sheet = self._workbook.add_worksheet()
+            self._sheet.write_row(0, 0, self._header, self._bold)
+            self._row = 1
+        self._sheet.write_row(self._row, 0, values)
+        self._row += 1
+
+    def close(self):
+        if self._sheet is None:
+            self._row = XLSX_MAX_ROWS
+            self.writerow([])
+        self._workbook.close()
+
+
+WRITERS = {
+    'csv': CsvWriter,
+    'xlsx': XlsxWriter,
+}
@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from collections import deque
+
+
+class HealthSettings(object):
+    __slots__ = ('failure_rate', 'min_calls', 'window')
+
+    def __init__(self, failure_rate=0.5, min_calls=10, window=60):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+
+
+class Tracker(object):
+    """ Reports the gateway calls made with one credential to the router.
+
+    Holds no ORM record, so it can be handed to worker threads.
+    """
+    __slots__ = ('dbname', 'credential_id', 'settings')
+
+    def __init__(self, dbname, credential_id, settings):
+        self.dbname = dbname
+        self.credential_id = credential_id
+        self.settings = settings
+
+    def start(self):
+        router.start(self)
+
+    def done(self, failed):
+        router.done(self, failed)
+
+
+class CredentialRouter(object):
+    """ Per-process router spreading the gateway calls of an acquirer over its credentials.
+
+    ``weighted`` is the smooth weighted round-robin of nginx: every credential
+    gets its share of the calls, interleaved rather than in bursts.
+    ``least_loaded`` picks the credential with the fewest calls in progress in
+    this worker relative to its weight. Both skip the credentials whose recent
+    calls failed more than allowed, unless all of them did.
+
+    Each worker routes its own calls, without coordinating with the others:
+    the shares hold over all workers, as each of them applies the weights.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._current = {}
+        self._in_flight = {}
+        self._calls = {}
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._current = {}
+            self._in_flight = {}
+            self._calls = {}
+            self._pid = os.getpid()
+
+    def _is_healthy(self, key, settings, now):
+        calls = self._calls.get(key)
+        if not calls:
+            return True
+        while calls and calls[0][0] < now - settings.window:
+            calls.popleft()
+        if len(calls) < settings.min_calls:
+            return True
+        failures = sum(1 for _at, failed in calls if failed)
+        return failures < settings.failure_rate * len(calls)
+
+    def select(self, dbname, acquirer_id, candidates, strategy, settings):
+        """ Return the id of the credential the next call should use.
+
+            :param candidates: list of ``(credential_id, weight)``
+            :param str strategy: 'weighted' or 'least_loaded'
+            :param HealthSettings settings: when credentials are deemed unhealthy
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._check_fork()
+            healthy = [
+                (credential_id, weight) for credential_id, weight in candidates
+                if self._is_healthy((dbname, credential_id), settings, now)
+            ] or candidates
+            if strategy == 'least_loaded':
+                return min(healthy, key=lambda c: (self._in_flight.get((dbname, c[0]), 0) / max(c[1], 1), -c[1]))[0]
+
+            current = self._current.setdefault((dbname, acquirer_id), {})
+            total = 0
+            best = None
+            for credential_id, weight in healthy:
+                weight = max(weight, 1)
+                current[credential_id] = current.get(credential_id, 0) + weight
+                total += weight
+                if best is None or current[credential_id] > current[best]:
+                    best = credential_id
+            current[best] -= total
+            return best
+
+    def start(self, tracker):
+        key = (tracker.dbname, tracker.credential_id)
+        with self._lock:
+            self._check_fork()
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def done(self, tracker, failed):
+        key = (tracker.dbname, tracker.credential_id)
+        now = time.monotonic()
+        with self._lock:
+            self._check_fork()
+            self._in_flight[key] = max(self._in_flight.get(key, 0) - 1, 0)
+            calls = self._calls.setdefault(key, deque())
+            calls.append((now, failed))
+            while calls and calls[0][0] < now - tracker.settings.window:
+                calls.popleft()
+
+
+router = CredentialRouter()
@@ -0,0 +1,70 @@
+"""Read-only snapshots of the configuration of the acquirers.
+
+The gateway code paths read the configuration of their acquirer from a
+snapshot rather than from the ORM: credentials, endpoints, callback url, fees,
+timeouts and limits are read once, then kept by every worker until the
+acquirer, one of its credentials or a system parameter is modified (the
+snapshots live in the registry cache, whose invalidation is signaled to all
+workers).
+
+A snapshot holds no ORM record, so it can be handed to worker threads.
+Providers add their own settings by subclassing :class:`AcquirerSnapshot`.
+"""
+from types import MappingProxyType
+
+
+class Snapshot(object):
+    """ Immutable object whose attributes are the ``__slots__`` of its class and of its parents. """
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self._fields():
+            object.__setattr__(self, name, values.pop(name))
+        if values:
+            raise TypeError('Unknown snapshot values: %s' % ', '.join(sorted(values)))
+
+    @classmethod
+    def _fields(cls):
+        return [name for klass in reversed(cls.__mro__) for name in getattr(klass, '__slots__', ())]
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, getattr(self, 'id', ''))
+
+
+class CredentialSnapshot(Snapshot):
+    __slots__ = ('id', 'active', 'weight', 'rate_limit_key', 'params')
+
+
+class AcquirerSnapshot(Snapshot):
+    __slots__ = (
+        'id', 'provider', 'dbname', 'base_url', 'params',
+        'circuit', 'health',
+        'rate_limit', 'rate_limit_key', 'rate_limit_rate', 'rate_limit_burst', 'rate_limit_max_wait',
+        'deadline_checkout', 'deadline_callback', 'gateway_journal', 'token_lifetime',
+        'credential_routing', 'credentials',
+        'fees_active', 'fees_dom_fixed', 'fees_dom_var', 'fees_int_fixed', 'fees_int_var',
+    )
+
+    def credential(self, credential_id):
+        """ Return the snapshot of the credential ``credential_id``, None when it is not one of the acquirer. """
+        for credential in self.credentials:
+            if credential.id == credential_id:
+                return credential
+        return None
+
+    def get_params(self, credential_id=None):
+        """ Return the gateway parameters (terminal, merchant, ...) of the calls made with ``credential_id``, or
+        with the acquirer itself. """
+        credential = self.credential(credential_id) if credential_id else None
+        return credential.params if credential else self.params
+
+
+def frozen(mapping):
+    """ Return a read-only view of a copy of ``mapping``. """
+    return MappingProxyType(dict(mapping))
@@ -0,0 +1,47 @@
+odoo.define('l10n_ir_payment.payment_status', function (require) {
+'use strict';
+
+var ajax = require('web.ajax');
+var publicWidget = require('web.public.widget');
+require('payment.processing');
+
+/**
+ * Waits on /longpolling/payment/ir/status for the transactions of the Iranian
+ * acquirers to change state, instead of polling /payment/process/poll on a
+ * timer. Falls back to the timer when the route has nothing to wait for or
+ * fails.
+ */
+publicWidget.registry.PaymentProcessing.include({
+    /**
+     * @override
+     */
+    processPolledData: function (transactions) {
+        var states = {};
+        (transactions || []).forEach(function (tx) {
+            states[tx.reference] = tx.state;
+        });
+        this._irStates = states;
+        return this._super.apply(this, arguments);
+    },
+    /**
+     * @override
+     */
+    startPolling: function () {
+        if (this._irPollOnTimer || !this._irStates) {
+            return this._super.apply(this, arguments);
+        }
+        var self = this;
+        ajax.jsonRpc('/longpolling/payment/ir/status', 'call', {states: this._irStates}).then(function (result) {
+            if (result.changed === null) {
+                self._irPollOnTimer = true;
+                self.startPolling();
+            } else {
+                self.poll();
+            }
+        }).guardedCatch(function () {
+            self._irPollOnTimer = true;
+            self.startPolling();
+        });
+    },
+});
+});
@@ -0,0 +1,147 @@
+"""Push notification of the state changes of the payment transactions.
+
+The transactions of the Iranian acquirers send a ``NOTIFY`` on the
+``l10n_ir_payment_tx`` channel of their database when they are authorized,
+done, cancelled or in error. The notification is delivered when the database
+transaction commits, and carries the ids of the payment transactions.
+
+Each worker has a single :class:`StatusDispatcher` listening to the channel
+of the databases requests are waiting on, with one dedicated connection per
+database, the way the bus module does. The ``/longpolling/payment/ir/status``
+route waits on it instead of having ``/payment/process`` poll the database
+every few seconds: it reads the states once, then sleeps until they change.
+"""
+import logging
+import os
+import select
+import threading
+import time
+
+import odoo
+from odoo import SUPERUSER_ID, api, sql_db
+
+_logger = logging.getLogger(__name__)
+
+CHANNEL = 'l10n_ir_payment_tx'
+# seconds a status request waits for a change
+TIMEOUT = 30
+# ids per notification, the payload of a NOTIFY being limited to 8000 bytes
+NOTIFY_BATCH = 500
+
+
+def notify(cr, ids):
+    """ Notify the listeners of the database of ``cr`` that the transactions ``ids`` changed state, once the
+    current database transaction commits. """
+    for index in range(0, len(ids), NOTIFY_BATCH):
+        cr.execute('SELECT pg_notify(%s, %s)', [CHANNEL, ','.join(str(id_) for id_ in ids[index:index + NOTIFY_BATCH])])
+
+
+class StatusDispatcher(object):
+    """ Per-process listener waking the requests waiting on the state of transactions. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._listening = set()
+        self._waiters = {}
+        self.Event = None
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._listening = set()
+            self._waiters = {}
+            self._pid = os.getpid()
+
+    def _start(self, dbname):
+        if odoo.evented:
+            import gevent
+            import gevent.event
+            self.Event = gevent.event.Event
+            gevent.spawn(self._run, dbname)
+        else:
+            self.Event = threading.Event
+            thread = threading.Thread(target=self._run, args=(dbname,), name='%s.listener' % __name__, daemon=True)
+            thread.start()
+        self._listening.add(dbname)
+
+    def subscribe(self, dbname, ids):
+        """ Return an event set as soon as one of the transactions ``ids`` of ``dbname`` changes state. It must be
+        given back to :meth:`unsubscribe`. """
+        with self._lock:
+            self._check_fork()
+            if dbname not in self._listening:
+                self._start(dbname)
+            event = self.Event()
+            for id_ in ids:
+                self._waiters.setdefault((dbname, id_), set()).add(event)
+        return event
+
+    def unsubscribe(self, dbname, ids, event):
+        with self._lock:
+            for id_ in ids:
+                events = self._waiters.get((dbname, id_))
+                if events is not None:
+                    events.discard(event)
+                    if not events:
+                        del self._waiters[(dbname, id_)]
+
+    def _wake(self, dbname, ids):
+        with self._lock:
+            events = set()
+            for id_ in ids:
+                events.update(self._waiters.pop((dbname, id_), ()))
+        for event in events:
+            event.set()
+
+    def _loop(self, dbname):
+        with sql_db.db_connect(dbname).cursor() as cr:
+            conn = cr._cnx
+            cr.execute('LISTEN %s' % CHANNEL)
+            cr.commit()
+            while True:
+                if select.select([conn], [], [], TIMEOUT) == ([], [], []):
+                    continue
+                conn.poll()
+                ids = set()
+                while conn.notifies:
+                    ids.update(int(id_) for id_ in conn.notifies.pop().payload.split(',') if id_)
+                self._wake(dbname, ids)
+
+    def _run(self, dbname):
+        while True:
+            try:
+                self._loop(dbname)
+            except Exception:
+                _logger.exception('Payment status listener of %s failed, retrying', dbname)
+                time.sleep(TIMEOUT)
+
+
+dispatcher = StatusDispatcher()
+
+
+def _read_states(dbname, ids):
+    """ Return the state by reference of the transactions ``ids`` whose changes are notified. """
+    with odoo.registry(dbname).cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        txs = env['payment.transaction'].browse(ids).exists().filtered(lambda tx: tx._ir_notifies_state())
+        return {tx.reference: tx.state for tx in txs}
+
+
+def wait_for_change(dbname, ids, states, timeout=TIMEOUT):
+    """ Wait until the state of one of the transactions ``ids`` differs from ``states``, the state by reference
+    last seen by the client, at most ``timeout`` seconds.
+
+        :return: whether a state changed, None when none of the transactions is notified
+    """
+    # subscribe first: a change committed while the states are read still wakes the request
+    event = dispatcher.subscribe(dbname, ids)
+    try:
+        current = _read_states(dbname, ids)
+        known = {reference: state for reference, state in current.items() if reference in states}
+        if not known:
+            return None
+        if any(states[reference] != state for reference, state in known.items()):
+            return True
+        return bool(event.wait(timeout))
+    finally:
+        dispatcher.unsubscribe(dbname, ids, event)
@@ -0,0 +1,8 @@
+from . import test_circuit
+from . import test_journal
+from . import test_locking
+from . import test_metrics
+from . import test_profiler
+from . import test_ratelimit
+from . import test_reconciliation_report
+from . import test_snapshot
@@ -0,0 +1,42 @@
+import itertools
+
+from odoo.tests import common
+
+
+class IrPaymentCommon(common.SavepointCase):
+    """ Base of the tests of the Iranian acquirers: a customer paying in rials and helpers creating acquirers and
+    transactions. """
+
+    _references = itertools.count(1)
+
+    @classmethod
+    def setUpClass(cls):
+        super(IrPaymentCommon, cls).setUpClass()
+        cls.currency_irr = cls.env.ref('base.IRR')
+        cls.currency_irr.active = True
+        cls.country_ir = cls.env.ref('base.ir')
+        cls.partner = cls.env['res.partner'].create({
+            'name': 'Payment Test',
+            'email': 'payment.test@example.com',
+            'phone': '09120000000',
+            'country_id': cls.country_ir.id,
+        })
+
+    @classmethod
+    def _create_acquirer(cls, provider, **values):
+        return cls.env['payment.acquirer'].create(dict({
+            'name': 'Test %s' % provider,
+            'provider': provider,
+            'state': 'test',
+        }, **values))
+
+    @classmethod
+    def _create_tx(cls, acquirer, **values):
+        return cls.env['payment.transaction'].create(dict({
+            'acquirer_id': acquirer.id,
+            'amount': 100000.0,
+            'currency_id': cls.currency_irr.id,
+            'partner_id': cls.partner.id,
+            'partner_country_id': cls.country_ir.id,
+            'reference': 'IR-TEST-%s' % next(cls._references),
+        }, **values))
@@ -0,0 +1,59 @@
+from unittest.mock import patch
+
+import psycopg2
+
+from odoo.tests import tagged
+
+from odoo.addons.l10n_ir_payment import circuit
+from odoo.addons.l10n_ir_payment.tests.common import IrPaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestCircuitBreaker(IrPaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestCircuitBreaker, cls).setUpClass()
+        cls.acquirer = cls._create_acquirer('manual')
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        # the breaker commits its state on a cursor of its own
+        self.addCleanup(circuit.CircuitBreaker().reset, self.env.cr.dbname, self.acquirer.id)
+
+    def _guard(self, **settings):
+        settings = dict({'min_calls': 2, 'failure_rate': 0.5, 'open_duration': 30}, **settings)
+        return circuit.Guard(self.env.cr.dbname, self.acquirer.id, circuit.CircuitSettings(**settings))
+
+    def test_failures_open_the_circuit_for_every_worker(self):
+        guard = self._guard()
+        worker = circuit.CircuitBreaker()
+        worker.after(guard, worker.before(guard), False)
+        self.assertFalse(worker.is_open(guard))
+        worker.after(guard, worker.before(guard), True)
+        self.assertTrue(worker.is_open(guard))
+        with self.assertRaises(circuit.GatewayUnavailable):
+            circuit.CircuitBreaker().before(guard)
+
+    def test_single_probe_when_half_open(self):
+        guard = self._guard(min_calls=1, open_duration=0)
+        worker, other = circuit.CircuitBreaker(), circuit.CircuitBreaker()
+        worker.after(guard, False, True)
+        self.assertTrue(worker.before(guard))
+        with self.assertRaises(circuit.GatewayUnavailable):
+            other.before(guard)
+        worker.after(guard, True, False)
+        self.assertFalse(circuit.CircuitBreaker().before(guard))
+
+    def test_locked_acquirer_does_not_block_the_breaker(self):
+        self.env.cr.execute("SELECT id FROM payment_acquirer WHERE id = %s FOR UPDATE", [self.acquirer.id])
+        guard = self._guard(min_calls=1)
+        circuit.CircuitBreaker().after(guard, False, True)
+        self.assertTrue(circuit.CircuitBreaker().is_open(guard))
+
+    def test_unreachable_state_lets_the_call_through(self):
+        guard = self._guard(min_calls=1, open_duration=0)
+        worker = circuit.CircuitBreaker()
+        worker.after(guard, False, True)
+        with patch('odoo.sql_db.db_connect', side_effect=psycopg2.OperationalError('lock timeout')):
+            self.assertFalse(worker.before(guard))
@@ -0,0 +1,27 @@
+import json
+
+from odoo.tests import tagged
+
+from odoo.addons.l10n_ir_payment.gateway import GatewayCall
+from odoo.addons.l10n_ir_payment.journal import Journal
+from odoo.addons.l10n_ir_payment.tests.common import IrPaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestJournal(IrPaymentCommon):
+
+    def test_stored_request_is_redacted(self):
+        payload = {
+            'merchant_id': '00000000-0000-0000-0000-000000000000',
+            'authority': 'A00000000000000000000000000000000123',
+            'metadata': {'mobile': '09121234567', 'email': 'customer@example.com'},
+        }
+        journal = Journal(self.env.cr.dbname)
+        journal.record(GatewayCall('request'), payload, {'data': {'code': 100}}, 100, 0.1)
+        journal.flush(self.env.cr)
+        self.env.cr.execute("SELECT request FROM payment_gateway_event WHERE method = 'request' ORDER BY id DESC LIMIT 1")
+        request = json.loads(self.env.cr.fetchone()[0])
+        self.assertEqual(request['merchant_id'], '[redacted]')
+        self.assertEqual(request['metadata'], {'mobile': '****4567', 'email': '****.com'})
+        # kept whole, to be looked up with the gateway
+        self.assertEqual(request['authority'], payload['authority'])
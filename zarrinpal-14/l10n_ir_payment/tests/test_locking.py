@@ -0,0 +1,24 @@
+from odoo.tests import tagged
+
+from odoo.addons.l10n_ir_payment.tests.common import IrPaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestLocking(IrPaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestLocking, cls).setUpClass()
+        cls.acquirer = cls._create_acquirer('manual')
+
+    def test_lock_reads_the_locked_rows_again(self):
+        txs = self._create_tx(self.acquirer) | self._create_tx(self.acquirer)
+        txs.flush()
+        # changed by the request that held the lock
+        self.env.cr.execute("UPDATE payment_transaction SET state = 'done' WHERE id = %s", [txs[0].id])
+        locked = txs._ir_lock()
+        self.assertEqual(locked, txs)
+        self.assertEqual(txs.mapped('state'), ['done', 'draft'])
+
+    def test_lock_nothing(self):
+        self.assertFalse(self.env['payment.transaction']._ir_lock())
@@ -0,0 +1,35 @@
+import time
+from unittest.mock import patch
+
+from odoo.tests import common, tagged
+
+from odoo.addons.l10n_ir_payment import metrics
+
+
+@tagged('post_install', '-at_install')
+class TestMetrics(common.BaseCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        patcher = patch.object(metrics, '_flush_rows')
+        self.flush_rows = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scope = metrics.Scope('test-db', 'manual', 1)
+
+    def test_idle_collector_flushes_on_its_own(self):
+        collector = metrics.MetricsCollector(flush_interval=0.05)
+        collector.event(self.scope, 'settle.attempt', 'ok')
+        deadline = time.monotonic() + 5
+        while not self.flush_rows.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.flush_rows.assert_called_once_with(
+            'test-db', {('event', 'manual', 1, 'settle.attempt', 'ok'): [1, 0.0] + [0] * len(metrics.BUCKETS)})
+
+    def test_inherited_deltas_are_left_to_the_parent(self):
+        collector = metrics.MetricsCollector()
+        collector.observe(self.scope, 'verify', 0, 0.2)
+        # as seen from a forked worker
+        collector._pid = -1
+        collector.flush()
+        self.flush_rows.assert_not_called()
+        self.assertIsNone(collector._flusher)
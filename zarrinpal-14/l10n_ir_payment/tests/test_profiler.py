@@ -0,0 +1,45 @@
+import sys
+import threading
+import time
+
+from odoo.tests import common, tagged
+
+from odoo.addons.l10n_ir_payment import profiler
+
+
+def _spin(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        sum(range(100))
+
+
+def _spin_elsewhere(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+@tagged('post_install', '-at_install')
+class TestProfiler(common.BaseCase):
+
+    def test_samples_the_profiled_thread_only(self):
+        stop = threading.Event()
+        other = threading.Thread(target=_spin_elsewhere, args=(stop,), daemon=True)
+        other.start()
+        self.addCleanup(other.join)
+        self.addCleanup(stop.set)
+        profile_function = sys.getprofile()
+        sampler = profiler.start(0.005)
+        self.assertTrue(profiler.is_active())
+        # a sampling profiler, the profiled thread is not instrumented
+        self.assertIs(sys.getprofile(), profile_function)
+        try:
+            _spin(0.2)
+        finally:
+            profiler.stop(sampler)
+        self.assertFalse(profiler.is_active())
+        self.assertTrue(sampler.samples['cpu'])
+        self.assertIn(':_spin', sampler.folded())
+        self.assertNotIn(':_spin_elsewhere', sampler.folded())
+
+    def test_default_interval(self):
+        self.assertEqual(profiler.Sampler(threading.get_ident()).interval, 0.02)
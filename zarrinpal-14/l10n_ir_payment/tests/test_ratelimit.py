@@ -0,0 +1,57 @@
+import threading
+import uuid
+
+from odoo.sql_db import db_connect
+from odoo.tests import common, tagged
+
+from odoo.addons.l10n_ir_payment import gateway, ratelimit
+
+
+class EchoCall(gateway.GatewayCall):
+
+    def _send(self, payload):
+        return payload, 0
+
+
+class RecordingLimiter(object):
+    max_wait = 0.0
+
+    def __init__(self):
+        self.threads = []
+
+    def reserve(self):
+        self.threads.append(threading.current_thread())
+        return 0.0
+
+
+@tagged('post_install', '-at_install')
+class TestRateLimit(common.TransactionCase):
+
+    def setUp(self):
+        super(TestRateLimit, self).setUp()
+        # the buckets are committed on a cursor of their own
+        self.key = 'test-%s' % uuid.uuid4().hex
+        self.addCleanup(self._drop_bucket)
+
+    def _drop_bucket(self):
+        with db_connect(self.env.cr.dbname).cursor() as cr:
+            cr.execute("DELETE FROM payment_rate_bucket WHERE key = %s", [self.key])
+
+    def test_burst_then_rejected(self):
+        limiter = ratelimit.RateLimiter(self.env.cr.dbname, self.key, rate=0.1, burst=2)
+        self.assertEqual(limiter.reserve(), 0.0)
+        self.assertEqual(limiter.reserve(), 0.0)
+        with self.assertRaises(ratelimit.RateLimited):
+            limiter.reserve()
+
+    def test_queued_within_max_wait(self):
+        limiter = ratelimit.RateLimiter(self.env.cr.dbname, self.key, rate=0.1, burst=1, max_wait=15)
+        self.assertEqual(limiter.reserve(), 0.0)
+        self.assertAlmostEqual(limiter.reserve(), 10.0, delta=1.0)
+
+    def test_batch_reserves_off_the_event_loop(self):
+        limiter = RecordingLimiter()
+        self.assertEqual(gateway.run_batch(EchoCall('verify', limiter=limiter), ['a', 'b']), ['a', 'b'])
+        self.assertEqual(len(limiter.threads), 2)
+        self.assertNotIn(threading.main_thread(), limiter.threads)
+        self.assertNotIn(threading.current_thread(), limiter.threads)
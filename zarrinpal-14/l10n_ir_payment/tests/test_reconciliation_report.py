@@ -0,0 +1,53 @@
+import datetime
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import tagged
+
+from odoo.addons.l10n_ir_payment.tests.common import IrPaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestReconciliationReport(IrPaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestReconciliationReport, cls).setUpClass()
+        cls.acquirer = cls._create_acquirer('manual')
+        cls.manager = cls.env['res.users'].create({
+            'name': 'Payment Accountant',
+            'login': 'payment.accountant',
+            'groups_id': [(6, 0, [cls.env.ref('base.group_user').id, cls.env.ref('account.group_account_manager').id])],
+        })
+
+    def _create_report(self):
+        today = fields.Date.today()
+        return self.env['payment.reconciliation.report'].with_user(self.manager).create({
+            'date_from': today - datetime.timedelta(days=1),
+            'date_to': today + datetime.timedelta(days=1),
+            'acquirer_ids': [(6, 0, self.acquirer.ids)],
+            'file_format': 'csv',
+        })
+
+    def test_report_is_generated_in_the_background(self):
+        tx = self._create_tx(self.acquirer)
+        report = self._create_report()
+        action = report.action_export()
+        self.assertEqual(action['res_id'], report.id)
+        self.assertEqual(report.state, 'queued')
+        self.assertFalse(report.attachment_id)
+
+        self.env['payment.reconciliation.report']._cron_generate_reports()
+        self.assertEqual(report.state, 'done')
+        self.assertIn(tx.reference, report.attachment_id.raw.decode())
+        self.assertEqual(report.attachment_id.mimetype, 'text/csv')
+        self.assertIn('/web/content/%s' % report.attachment_id.id, report.action_download()['url'])
+
+    def test_failed_report(self):
+        report = self._create_report()
+        report.action_export()
+        with patch.object(type(report), '_export', side_effect=ValueError('boom')):
+            self.env['payment.reconciliation.report']._cron_generate_reports()
+        self.assertEqual(report.state, 'failed')
+        self.assertEqual(report.error, 'boom')
+        self.assertFalse(report.attachment_id)
@@ -0,0 +1,26 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from odoo.addons.l10n_ir_payment.tests.common import IrPaymentCommon
+
+
+@tagged('post_install', '-at_install')
+class TestSnapshot(IrPaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSnapshot, cls).setUpClass()
+        cls.acquirer = cls._create_acquirer('manual')
+
+    def test_snapshot_follows_the_configuration(self):
+        self.assertEqual(self.acquirer._ir_snapshot().circuit.window, 60)
+        self.acquirer.circuit_window = 5
+        self.assertEqual(self.acquirer._ir_snapshot().circuit.window, 5)
+
+    def test_other_writes_keep_the_caches(self):
+        with patch.object(type(self.acquirer), 'clear_caches') as clear_caches:
+            self.acquirer.write({'name': 'Renamed', 'sequence': 3})
+            clear_caches.assert_not_called()
+            self.acquirer.write({'name': 'Renamed again', 'rate_limit_rate': 2.0})
+            clear_caches.assert_called_once_with()
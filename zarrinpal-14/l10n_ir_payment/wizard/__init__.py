@@ -0,0 +1 @@
+from . import payment_reconciliation_report
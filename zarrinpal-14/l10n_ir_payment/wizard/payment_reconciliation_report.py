@@ -0,0 +1,123 @@
+import datetime
+import tempfile
+
+import pytz
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+from odoo.addons.l10n_ir_payment import eventlog, reconciliation
+
+_logger = eventlog.getLogger(__name__)
+
+
+class PaymentReconciliationReport(models.TransientModel):
+    _name = 'payment.reconciliation.report'
+    _description = 'Payment Reconciliation Report'
+
+    date_from = fields.Date('From', required=True, default=lambda self: fields.Date.context_today(self) - datetime.timedelta(days=1))
+    date_to = fields.Date('To', required=True, default=lambda self: fields.Date.context_today(self) - datetime.timedelta(days=1))
+    acquirer_ids = fields.Many2many('payment.acquirer', string='Acquirers', help='All acquirers when empty.')
+    file_format = fields.Selection([('xlsx', 'Excel (xlsx)'), ('csv', 'CSV')], string='Format', default='xlsx', required=True)
+    issues_only = fields.Boolean('Issues Only', help='Only export the payments that do not match their gateway data or accounting.')
+    state = fields.Selection([
+        ('draft', 'New'),
+        ('queued', 'Generating'),
+        ('done', 'Ready'),
+        ('failed', 'Failed'),
+    ], default='draft', required=True, readonly=True)
+    attachment_id = fields.Many2one('ir.attachment', 'Report File', readonly=True, ondelete='set null')
+    error = fields.Char(readonly=True)
+
+    def unlink(self):
+        attachments = self.sudo().mapped('attachment_id')
+        res = super(PaymentReconciliationReport, self).unlink()
+        attachments.unlink()
+        return res
+
+    def _get_bounds(self):
+        """ Return the UTC datetimes the days of the report start and end at, in the timezone of the user. """
+        self.ensure_one()
+        tz = pytz.timezone(self.env.user.tz or 'UTC')
+
+        def to_utc(day):
+            return tz.localize(datetime.datetime.combine(day, datetime.time.min)).astimezone(pytz.utc).replace(tzinfo=None)
+        return to_utc(self.date_from), to_utc(self.date_to + datetime.timedelta(days=1))
+
+    def _get_filename(self):
+        self.ensure_one()
+        return 'payment-reconciliation-%s-%s.%s' % (
+            self.date_from, self.date_to, reconciliation.WRITERS[self.file_format].extension)
+
+    def _export(self, fileobj):
+        self.ensure_one()
+        date_from, date_to = self._get_bounds()
+        return self.env['payment.transaction'].ir_reconciliation_report(
+            fileobj, date_from, date_to, file_format=self.file_format, acquirer_ids=self.acquirer_ids.ids,
+            issues_only=self.issues_only)
+
+    def _generate(self):
+        """ Write the report to an attachment, as the user who asked for it. """
+        self.ensure_one()
+        report = self.with_user(self.create_uid)
+        with tempfile.TemporaryFile() as fileobj:
+            report._export(fileobj)
+            fileobj.seek(0)
+            attachment = report.env['ir.attachment'].create({
+                'name': report._get_filename(),
+                'raw': fileobj.read(),
+                'mimetype': reconciliation.WRITERS[report.file_format].mimetype,
+                'res_model': self._name,
+                'res_id': self.id,
+            })
+        self.write({'state': 'done', 'attachment_id': attachment.id})
+
+    @api.model
+    def _cron_generate_reports(self):
+        """ Generate the queued reports, each in a transaction of its own. Large reports take longer than the
+        time limit of an HTTP request, so they are never generated within one. """
+        for report in self.search([('state', '=', 'queued')], order='id'):
+            try:
+                with self.env.cr.savepoint():
+                    report._generate()
+            except Exception as e:
+                _logger.exception('reconciliation.failed', report=report.id)
+                report.write({'state': 'failed', 'error': str(e)})
+            self.env['payment.transaction']._ir_commit()
+
+    def _action_reopen(self):
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Payment Reconciliation'),
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def action_export(self):
+        """ Queue the report, which a scheduled action generates in the background. """
+        self.ensure_one()
+        if self.date_from > self.date_to:
+            raise UserError(_('The start date of the report must be before its end date.'))
+        if self.file_format == 'xlsx' and reconciliation.xlsxwriter is None:
+            raise UserError(_('The xlsxwriter library is not installed, please export as CSV.'))
+        self.write({'state': 'queued', 'attachment_id': False, 'error': False})
+        cron = self.env.ref('l10n_ir_payment.cron_ir_reconciliation_report', raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+        return self._action_reopen()
+
+    def action_refresh(self):
+        self.ensure_one()
+        return self._action_reopen()
+
+    def action_download(self):
+        self.ensure_one()
+        if not self.attachment_id:
+            raise UserError(_('The report is not ready yet.'))
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/web/content/%s?download=true' % self.attachment_id.id,
+            'target': 'self',
+        }
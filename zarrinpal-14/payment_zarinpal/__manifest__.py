@@ -6,10 +6,14 @@
     'version': '14.0.0.0.1.210817',
     'description': """ZarinPal Payment Acquirer""",
     'depends': ['l10n_ir_payment'],
+    'external_dependencies': {
+        'python': ['requests', 'urllib3'],
+    },
     'data': [
         'views/payment_views.xml',
         'views/payment_zarinpal_templates.xml',
         'data/payment_acquirer_data.xml',
+        'data/payment_zarinpal_cron.xml',
     ],
     'application': True,
     'post_init_hook': 'create_missing_journal_for_acquirers',
@@ -1,16 +1,41 @@
-import logging
 import werkzeug
 from odoo import http
 from odoo.http import request
+from odoo.addons.l10n_ir_payment import deadline, eventlog
+from odoo.addons.l10n_ir_payment.controllers.main import render_pay_retry
+from odoo.addons.l10n_ir_payment.gateway import RetryLater
+from odoo.addons.payment.models.payment_acquirer import ValidationError
 
-_logger = logging.getLogger(__name__)
+_logger = eventlog.getLogger(__name__, 'zarinpal')
 
 
 class ZarinPalController(http.Controller):
     redirect_url = 'payment/zarinpal/redirect/'
+    pay_url = '/payment/zarinpal/pay'
+
+    @http.route(pay_url, type='http', auth='public', methods=['GET', 'POST'], csrf=False)
+    def zarinpal_pay(self, reference=None, token=None, **post):
+        """ The customer submitted the payment form: ask ZarinPal for an authority, or reuse the one already
+        issued for the transaction, and send the customer to the payment page. """
+        tx = request.env['payment.transaction'].sudo()._ir_get_pay_tx('zarinpal', reference, token)
+        if not tx or tx.state not in ('draft', 'pending'):
+            return werkzeug.utils.redirect('/payment/process')
+        try:
+            with request.env['payment.profile'].sudo()._ir_profile('pay', 'zarinpal'), deadline.request_scope():
+                authority = tx._zarinpal_issue_authority()
+        except RetryLater as e:
+            # nothing was refused: the customer may submit the same payment again
+            return render_pay_retry(tx, e.args[0])
+        except ValidationError as e:
+            _logger.warning('pay.failed', tx=tx.reference, error=e.args[0])
+            tx._set_transaction_error(e.args[0])
+            return werkzeug.utils.redirect('/payment/process')
+        return werkzeug.utils.redirect(tx.acquirer_id.zarinpal_get_form_action_url() + authority)
 
     @http.route('/payment/zarinpal/redirect/', type='http', auth='public', csrf=False)
     def zarinpal_redirect(self, **get):
-        _logger.info(f'request from: {request.httprequest.remote_addr}, with content: {get}')
-        request.env['payment.transaction'].sudo().form_feedback(get, 'zarinpal')
+        _logger.info('callback.received', payload=get, remote_addr=request.httprequest.remote_addr, audit=True, sample=True)
+        # the budget of the callback, set on the acquirer, counts from here
+        with request.env['payment.profile'].sudo()._ir_profile('callback', 'zarinpal'), deadline.request_scope():
+            request.env['payment.transaction'].sudo().form_feedback(get, 'zarinpal')
         return werkzeug.utils.redirect("/payment/process")
@@ -0,0 +1,51 @@
+"""Fee schedule of the ZarinPal acquirers.
+
+ZarinPal charges a percentage of the amount, rounded down to the rial and
+capped. A :class:`FeeSchedule` holds the rule of an acquirer, read once with
+its configuration snapshot, and quotes the fees of one amount or of many at
+once. The batch quotation is vectorized with numpy when it is installed, and
+gives the same results as the scalar one: the operations are the same IEEE
+double operations, in the same order, and both return floats.
+"""
+import functools
+import math
+
+# below this many amounts, converting them to an array costs more than it saves
+NUMPY_MIN_SIZE = 32
+
+
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    """ Return the ``numpy`` module, or None when it is not installed. """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class FeeSchedule(object):
+    """ Fees of an acquirer: ``floor(percentage * amount / 100)``, at most ``upper_limit``. Holds no ORM record. """
+    __slots__ = ('active', 'percentage', 'upper_limit')
+
+    def __init__(self, active=False, percentage=0.0, upper_limit=0.0):
+        self.active = active
+        self.percentage = percentage
+        self.upper_limit = upper_limit
+
+    def compute(self, amount):
+        """ Return the fees of ``amount``. """
+        if not self.active:
+            return 0.0
+        return float(min(math.floor(self.percentage * amount / 100), self.upper_limit))
+
+    def compute_batch(self, amounts):
+        """ Return the list of the fees of ``amounts``, as :meth:`compute` gives them one by one. """
+        amounts = list(amounts)
+        if not self.active:
+            return [0.0] * len(amounts)
+        numpy = load_numpy()
+        if numpy is None or len(amounts) < NUMPY_MIN_SIZE:
+            return [self.compute(amount) for amount in amounts]
+        values = numpy.asarray(amounts, dtype=numpy.float64)
+        return numpy.minimum(numpy.floor(self.percentage * values / 100), self.upper_limit).tolist()
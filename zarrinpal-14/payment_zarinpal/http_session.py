@@ -0,0 +1,97 @@
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from odoo.addons.l10n_ir_payment.gateway import RestCall
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 15.0
+DEFAULT_VERIFY_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.3
+# urllib3 < 1.26, as pinned by Odoo 14, only knows the methods to retry as method_whitelist
+RETRY_METHODS_ARG = 'allowed_methods' if 'allowed_methods' in Retry.__init__.__code__.co_varnames else 'method_whitelist'
+
+
+class SessionRegistry(object):
+    """ Per-worker registry of keep-alive ``requests`` sessions.
+
+    Sessions are keyed by the acquirer and its connection settings, so editing
+    the settings of an acquirer transparently builds a new session. Retries are
+    only mounted on the urls given as ``retry_urls``: ZarinPal verify calls are
+    idempotent, payment requests are not.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._pid = os.getpid()
+
+    def _build_session(self, pool_size, retries, backoff, retry_urls):
+        session = requests.Session()
+        session.headers.update({'accept': 'application/json', 'content-type': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=0)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if retries:
+            retry = Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(502, 503, 504),
+                raise_on_status=False,
+                **{RETRY_METHODS_ARG: frozenset(['POST'])}
+            )
+            retry_adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+            for url in retry_urls:
+                session.mount(url, retry_adapter)
+        return session
+
+    def get(self, key, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_VERIFY_RETRIES, backoff=DEFAULT_RETRY_BACKOFF, retry_urls=()):
+        """ Return the session registered under ``key`` for these settings. """
+        settings = (pool_size, retries, backoff, tuple(retry_urls))
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked worker, never share the parent's sockets
+                self._sessions.clear()
+                self._pid = os.getpid()
+            entry = self._sessions.get(key)
+            if entry and entry[0] == settings:
+                return entry[1]
+            if entry:
+                entry[1].close()
+            session = self._build_session(pool_size, retries, backoff, retry_urls)
+            self._sessions[key] = (settings, session)
+            return session
+
+    def clear(self):
+        with self._lock:
+            for _settings, session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+session_registry = SessionRegistry()
+
+
+class ZarinPalCall(RestCall):
+    """ Call of the ZarinPal v4 REST API, whose answers carry their result code in ``data`` or ``errors``. """
+
+    def _journal_reference(self, payload, result):
+        # payment requests get their authority in the answer
+        if payload.get('authority'):
+            return payload['authority']
+        data = result.get('data') if isinstance(result, dict) else None
+        return data.get('authority') if isinstance(data, dict) else None
+
+    def _result_code(self, response):
+        if response.get('data'):
+            return response['data'].get('code')
+        if response.get('errors'):
+            return response['errors'].get('code')
+        return None
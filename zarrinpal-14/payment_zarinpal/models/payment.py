@@ -1,30 +1,94 @@
-import logging
-import requests
+import time
+from collections import Counter
+from datetime import timedelta
+
+from werkzeug import urls
+
 from odoo import api, fields, models, _
 from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo.tools import float_compare
+from odoo.addons.l10n_ir_payment import deadline, eventlog, gateway
+from odoo.addons.l10n_ir_payment.circuit import GatewayUnavailable
+from odoo.addons.l10n_ir_payment.gateway import DeadlineExceeded, GatewayError, GatewayTransportError, RetryLater
+from odoo.addons.l10n_ir_payment.ratelimit import RateLimited
+from odoo.addons.l10n_ir_payment.snapshot import AcquirerSnapshot, frozen
 from odoo.addons.payment_zarinpal.controllers.main import ZarinPalController
-import math
+from odoo.addons.payment_zarinpal import http_session
+from odoo.addons.payment_zarinpal.fees import FeeSchedule
+
+_logger = eventlog.getLogger(__name__, 'zarinpal')
 
-_logger = logging.getLogger(__name__)
 
+ZARINPAL_FORM_URL = 'https://www.zarinpal.com/pg/StartPay/'
+ZARINPAL_API_URL = 'https://api.zarinpal.com/pg/v4/payment/'
 
-def _get_zarinpal_urls():
+# verify answers: 100 verified, 101 already verified
+ZARINPAL_VERIFIED_CODES = (100, 101)
+# verify answers meaning the payment was not made: -50 amount mismatch, -51 unpaid or cancelled by the customer,
+# -53 authority of another merchant, -54 invalid authority
+ZARINPAL_UNPAID_CODES = (-50, -51, -53, -54)
+
+
+def _get_zarinpal_urls(api_url=None, form_url=None):
     """ ZarinPal URLS """
+    api_url = (api_url or ZARINPAL_API_URL).rstrip('/') + '/'
     return {
-        'zarinpal_form_url': 'https://www.zarinpal.com/pg/StartPay/',
-        'zarinpal_rest_url_get_token': 'https://api.zarinpal.com/pg/v4/payment/request.json',
-        'zarinpal_rest_url_verify': 'https://api.zarinpal.com/pg/v4/payment/verify.json',
+        'zarinpal_form_url': form_url or ZARINPAL_FORM_URL,
+        'zarinpal_rest_url_get_token': api_url + 'request.json',
+        'zarinpal_rest_url_verify': api_url + 'verify.json',
+        'zarinpal_rest_url_reverse': api_url + 'reverse.json',
+        'zarinpal_rest_url_inquiry': api_url + 'inquiry.json',
     }
 
 
+class ZarinPalSnapshot(AcquirerSnapshot):
+    __slots__ = (
+        'urls', 'pool_size', 'timeout', 'verify_retries', 'retry_backoff', 'background_concurrency', 'callback_url',
+        'fee_schedule',
+    )
+
+
 class AcquirerZarinPal(models.Model):
     _inherit = 'payment.acquirer'
 
     provider = fields.Selection(selection_add=[('zarinpal', 'ZarinPal')], ondelete={'zarinpal': 'set default'})
     zarinpal_merchant_id = fields.Char('Merchant ID', required_if_provider='zarinpal', groups='base.group_user')
+    zarinpal_access_token = fields.Char(
+        'Access Token', groups='base.group_system',
+        help='Access token of the ZarinPal merchant panel, which ZarinPal requires to reverse payments.')
 
     fees_dom_limit = fields.Float(string='Upper limit for domestic fees')
 
+    zarinpal_api_url = fields.Char(
+        'API URL', groups='base.group_user',
+        help='Overrides the base url of the ZarinPal REST API, e.g. to point to a local stand-in server. '
+             'Leave empty to use %s' % ZARINPAL_API_URL)
+    zarinpal_form_url = fields.Char(
+        'Payment Page URL', groups='base.group_user',
+        help='Overrides the url customers are sent to for paying. Leave empty to use %s' % ZARINPAL_FORM_URL)
+    zarinpal_pool_size = fields.Integer(
+        'Connection Pool Size', default=http_session.DEFAULT_POOL_SIZE, groups='base.group_user',
+        help='Maximum number of keep-alive connections each worker keeps open to ZarinPal.')
+    zarinpal_connect_timeout = fields.Float(
+        'Connect Timeout', default=http_session.DEFAULT_CONNECT_TIMEOUT, groups='base.group_user',
+        help='Seconds to wait for a connection to ZarinPal to be established.')
+    zarinpal_read_timeout = fields.Float(
+        'Read Timeout', default=http_session.DEFAULT_READ_TIMEOUT, groups='base.group_user',
+        help='Seconds to wait for ZarinPal to answer once connected.')
+    zarinpal_verify_retries = fields.Integer(
+        'Verify Retries', default=http_session.DEFAULT_VERIFY_RETRIES, groups='base.group_user',
+        help='Number of times a failed verify call is retried. Payment requests are never retried.')
+    zarinpal_retry_backoff = fields.Float(
+        'Retry Backoff', default=http_session.DEFAULT_RETRY_BACKOFF, groups='base.group_user',
+        help='Backoff factor, in seconds, between verify retries.')
+    zarinpal_background_concurrency = fields.Integer(
+        'Background Concurrency', default=8, groups='base.group_user',
+        help='Maximum number of simultaneous ZarinPal calls made by scheduled actions.')
+    zarinpal_reconcile_after = fields.Integer(
+        'Reconcile After', default=60, groups='base.group_user',
+        help='Minutes after its authority expired after which a pending payment is checked against ZarinPal by '
+             'the reconciliation.')
+
     def _get_feature_support(self):
         res = super(AcquirerZarinPal, self)._get_feature_support()
         res['fees'].append('zarinpal')
@@ -40,36 +104,151 @@ class AcquirerZarinPal(models.Model):
                                        the acquirer company country.
             :return float fees: computed fees
         """
-        if not self.fees_active:
-            return 0.0
-        percentage = self.fees_dom_var
-        upper_limit = self.fees_dom_limit
-        calculated_fees = math.floor(percentage * amount / 100)
-        return min(calculated_fees, upper_limit)
+        return self._ir_snapshot().fee_schedule.compute(amount)
+
+    def zarinpal_compute_fees_batch(self, amounts, currency_id=None, country_id=None):
+        """ Compute the zarinpal fees of many amounts at once, e.g. of the lines of a cart.
+
+            :param list amounts: the amounts to pay
+            :return list: the fees of each amount, as :meth:`zarinpal_compute_fees` computes them
+        """
+        self.ensure_one()
+        return self._ir_snapshot().fee_schedule.compute_batch(amounts)
 
     def zarinpal_form_generate_values(self, values):
         self.ensure_one()
-        transaction = self.env['payment.transaction'].search([('reference', '=', values['reference'])])
-        zarinpal_tx_values = dict(values)
-        # TODO: I really do not know how is this working! this implementation is based on a guess
-        new_context = dict(self.env.context)
-        new_context.update(
-            {'tx_url': transaction.acquirer_id.zarinpal_get_form_action_url() + transaction.acquirer_reference}
+        # the form posts to the pay route, which asks for the authority, see _ir_pay_route
+        return dict(values)
+
+    def _ir_pay_route(self):
+        if self.provider != 'zarinpal':
+            return super(AcquirerZarinPal, self)._ir_pay_route()
+        return ZarinPalController.pay_url
+
+    def _zarinpal_get_session(self, retries=True):
+        """ Return the pooled session of the acquirer, retrying the verify calls when ``retries`` is set. """
+        self.ensure_one()
+        config = self._ir_snapshot()
+        return http_session.session_registry.get(
+            (config.id, retries),
+            pool_size=config.pool_size,
+            retries=config.verify_retries if retries else 0,
+            backoff=config.retry_backoff,
+            retry_urls=(config.urls['zarinpal_rest_url_verify'],),
         )
-        self.sudo().env.context = new_context
-        return zarinpal_tx_values
 
-    @staticmethod
-    def zarinpal_get_form_action_url():
-        return _get_zarinpal_urls()['zarinpal_form_url']
+    def _zarinpal_gateway_call(self, url, method, credential=None):
+        """ Return the :class:`~odoo.addons.payment_zarinpal.http_session.ZarinPalCall` posting payloads to
+        ``url``. The call does not use the ORM, so it may be sent from a worker thread or in a batch.
 
-    @staticmethod
-    def zarinpal_get_rest_url_get_token():
-        return _get_zarinpal_urls()['zarinpal_rest_url_get_token']
+            :param str method: gateway method called, as reported in the metrics ('request', 'verify')
+            :param credential: ``payment.acquirer.credential`` the payloads are made with, if any
+        """
+        self.ensure_one()
+        config = self._ir_snapshot()
+        headers = None
+        if method == 'reversal':
+            # unlike the other endpoints, reverse authenticates the merchant with the token of its panel
+            headers = {'Authorization': 'Bearer %s' % self._zarinpal_get_access_token(credential)}
+        # each attempt of the session would get the whole time left: within a budget, the call is not retried
+        retries = deadline.remaining() is None
+        return http_session.ZarinPalCall(
+            method, url,
+            session=self._zarinpal_get_session(retries),
+            timeout=config.timeout,
+            retries=config.verify_retries if retries and method == 'verify' else 0,
+            scope=self._ir_metrics_scope(),
+            guard=self._ir_circuit_guard(),
+            limiter=self._ir_rate_limiter(credential),
+            tracker=self._ir_credential_tracker(credential),
+            journal=self._ir_gateway_journal(),
+            headers=headers,
+        )
 
-    @staticmethod
-    def zarinpal_get_rest_url_verify():
-        return _get_zarinpal_urls()['zarinpal_rest_url_verify']
+    def _zarinpal_post(self, url, payload, method, credential=None):
+        """ POST ``payload`` to ZarinPal through the pooled session of the acquirer and return the decoded answer. """
+        return self._zarinpal_gateway_call(url, method, credential).send(payload)
+
+    def _zarinpal_get_merchant_id(self, credential=None):
+        self.ensure_one()
+        return self._ir_snapshot().get_params(credential.id if credential else None)['merchant_id']
+
+    def _zarinpal_get_access_token(self, credential=None):
+        self.ensure_one()
+        return self._ir_snapshot().get_params(credential.id if credential else None)['access_token']
+
+    def _ir_rate_limit_key(self):
+        if self.provider != 'zarinpal':
+            return super(AcquirerZarinPal, self)._ir_rate_limit_key()
+        # ZarinPal throttles per merchant
+        return 'zarinpal:%s' % self.zarinpal_merchant_id
+
+    def _ir_gateway_params(self):
+        if self.provider != 'zarinpal':
+            return super(AcquirerZarinPal, self)._ir_gateway_params()
+        return {'merchant_id': self.zarinpal_merchant_id, 'access_token': self.zarinpal_access_token}
+
+    def _ir_snapshot_class(self):
+        if self.provider != 'zarinpal':
+            return super(AcquirerZarinPal, self)._ir_snapshot_class()
+        return ZarinPalSnapshot
+
+    def _ir_snapshot_fields(self):
+        names = {name for name in self._fields if name.startswith('zarinpal_')}
+        return super(AcquirerZarinPal, self)._ir_snapshot_fields() | names | {'fees_dom_limit'}
+
+    def _ir_snapshot_values(self):
+        values = super(AcquirerZarinPal, self)._ir_snapshot_values()
+        if self.provider != 'zarinpal':
+            return values
+        values.update(
+            urls=frozen(_get_zarinpal_urls(self.zarinpal_api_url, self.zarinpal_form_url)),
+            pool_size=max(self.zarinpal_pool_size, 1),
+            timeout=(self.zarinpal_connect_timeout, self.zarinpal_read_timeout),
+            verify_retries=max(self.zarinpal_verify_retries, 0),
+            retry_backoff=self.zarinpal_retry_backoff,
+            background_concurrency=self.zarinpal_background_concurrency,
+            callback_url=urls.url_join(values['base_url'], ZarinPalController.redirect_url),
+            fee_schedule=FeeSchedule(
+                active=self.fees_active, percentage=self.fees_dom_var, upper_limit=self.fees_dom_limit),
+        )
+        return values
+
+    def _zarinpal_get_urls(self):
+        self.ensure_one()
+        return self._ir_snapshot().urls
+
+    def zarinpal_get_form_action_url(self):
+        return self._zarinpal_get_urls()['zarinpal_form_url']
+
+    def zarinpal_get_rest_url_get_token(self):
+        return self._zarinpal_get_urls()['zarinpal_rest_url_get_token']
+
+    def zarinpal_get_rest_url_verify(self):
+        return self._zarinpal_get_urls()['zarinpal_rest_url_verify']
+
+    def zarinpal_get_rest_url_reverse(self):
+        return self._zarinpal_get_urls()['zarinpal_rest_url_reverse']
+
+    def zarinpal_get_rest_url_inquiry(self):
+        return self._zarinpal_get_urls()['zarinpal_rest_url_inquiry']
+
+
+class ZarinPalCredential(models.Model):
+    _inherit = 'payment.acquirer.credential'
+
+    zarinpal_merchant_id = fields.Char('Merchant ID', groups='base.group_system')
+    zarinpal_access_token = fields.Char('Access Token', groups='base.group_system')
+
+    def _ir_rate_limit_key(self):
+        if self.provider != 'zarinpal':
+            return super(ZarinPalCredential, self)._ir_rate_limit_key()
+        return 'zarinpal:%s' % self.zarinpal_merchant_id
+
+    def _ir_gateway_params(self):
+        if self.provider != 'zarinpal':
+            return super(ZarinPalCredential, self)._ir_gateway_params()
+        return {'merchant_id': self.zarinpal_merchant_id, 'access_token': self.zarinpal_access_token}
 
 
 class TxZarinPal(models.Model):
@@ -80,6 +259,22 @@ class TxZarinPal(models.Model):
     zarinpal_hashed_card_number = fields.Char('ZarinPal Hashed Card Number')
     zarinpal_fee_type = fields.Char('ZarinPal Fee Type')
     zarinpal_fee = fields.Integer('ZarinPal Fee')
+    zarinpal_authority_expiry = fields.Datetime('ZarinPal Authority Expiry', readonly=True, copy=False)
+    zarinpal_authority_amount = fields.Float('ZarinPal Authority Amount', readonly=True, copy=False)
+
+    def init(self):
+        super(TxZarinPal, self).init()
+        # callbacks look transactions up by authority, stored in acquirer_reference
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS payment_transaction_acquirer_reference_index
+            ON payment_transaction (acquirer_reference)
+            WHERE acquirer_reference IS NOT NULL
+        """)
+
+    def _ir_notifies_state(self):
+        if self.provider != 'zarinpal':
+            return super(TxZarinPal, self)._ir_notifies_state()
+        return True
 
     def _get_banking_required_document_name(self, data):
         if data.get('invoice_ids'):
@@ -89,30 +284,58 @@ class TxZarinPal(models.Model):
         else:
             raise ValidationError(_("Can't process payment without invoice and/or sale order!"))
 
+    def _zarinpal_get_document_name(self):
+        self.ensure_one()
+        if self.invoice_ids:
+            return self.invoice_ids[0].name
+        elif 'sale_order_ids' in self and self.sale_order_ids:
+            return self.sale_order_ids[0].name
+        raise ValidationError(_("Can't process payment without invoice and/or sale order!"))
+
     def zarinpal_create(self, data):
         acquirer = self.env['payment.acquirer'].browse(data['acquirer_id'])
+        acquirer._ir_check_circuit()
+        # fail before the form is submitted; the authority is only asked for then, see _zarinpal_issue_authority
+        self._get_banking_required_document_name(data)
+        return data
+
+    def _zarinpal_issue_authority(self):
+        """ Return the authority the customer pays this transaction with: the one already issued while it is valid
+        for the amount, a new one otherwise.
+
+            :raise RetryLater: when ZarinPal could not be reached
+            :raise ValidationError: when ZarinPal refused to issue an authority
+        """
+        self.ensure_one()
+        self._ir_lock_token()
+        acquirer = self.acquirer_id
+        scope = acquirer._ir_metrics_scope()
+        if self.acquirer_reference:
+            if self._ir_token_usable(self.zarinpal_authority_expiry, self.zarinpal_authority_amount):
+                scope.event('token', 'reused')
+                return self.acquirer_reference
+            scope.event('token', 'expired')
+
+        credential = acquirer._ir_select_credential()
         payload = {
-            'merchant_id': acquirer.zarinpal_merchant_id,
-            'amount': int(data['amount']),
-            'description': self._get_banking_required_document_name(data),
-            'callback_url': acquirer.get_base_url() + ZarinPalController.redirect_url,
+            'merchant_id': acquirer._zarinpal_get_merchant_id(credential),
+            'amount': int(self.amount),
+            'description': self._zarinpal_get_document_name(),
+            'callback_url': acquirer._ir_snapshot().callback_url,
         }
-        if data['partner_phone'] or data['partner_email']:
+        if self.partner_phone or self.partner_email:
             metadata_dict = {}
-            if data['partner_phone']:
-                metadata_dict['mobile'] = data['partner_phone']
-            if data['partner_email']:
-                metadata_dict['email'] = data['partner_email']
+            if self.partner_phone:
+                metadata_dict['mobile'] = self.partner_phone
+            if self.partner_email:
+                metadata_dict['email'] = self.partner_email
             payload['metadata'] = metadata_dict
         url = acquirer.zarinpal_get_rest_url_get_token()
         try:
-            custom_header = {"accept": "application/json", "content-type": "application/json'"}
-            req = requests.post(url, json=payload, headers=custom_header, timeout=15)
-            req.raise_for_status()
-            response = req.json()
+            with acquirer._ir_deadline('checkout'):
+                response = acquirer._zarinpal_post(url, payload, 'request', credential)
             if response['data'] and response['data']['code'] == 100:
-                data['acquirer_reference'] = response['data']['authority']
-                data['state'] = 'pending'
+                authority = response['data']['authority']
             elif response['errors'] and response['errors']['message']:
                 if response['errors']['validations']:
                     raise ValidationError(f"{response['errors']['message']}, {response['errors']['validations']}")
@@ -120,67 +343,278 @@ class TxZarinPal(models.Model):
                     raise ValidationError(response['errors']['message'])
             else:
                 raise ValidationError(_('Error occurred in getting token from ZarinPal!'))
+        except GatewayError as e:
+            _logger.warning('pay.unavailable', reference=self.reference, error=e)
+            raise RetryLater(_('ZarinPal could not be reached, please try again in a moment.'))
         except Exception as e:
             raise ValidationError(e.args[0])
-        return data
+        self.write({
+            'credential_id': credential.id,
+            'acquirer_reference': authority,
+            'zarinpal_authority_expiry': self._ir_token_expiry(),
+            'zarinpal_authority_amount': self.amount,
+        })
+        self._set_transaction_pending()
+        scope.event('token', 'issued')
+        return authority
 
     @api.model
     def _zarinpal_form_get_tx_from_data(self, data):
         authority, status = data.get('Authority'), data.get('Status')
         if not authority or not status:
             error_msg = 'ZarinPal: received data with missing authority (%s) or status (%s)' % (authority, status)
-            _logger.info(error_msg)
+            _logger.info('callback.incomplete', authority=authority, status=status)
             raise ValidationError(error_msg)
-        txs = self.env['payment.transaction'].search([('acquirer_reference', '=', authority)])
+        txs = self.env['payment.transaction'].search([('acquirer_reference', '=', authority)], limit=2)
         if not txs or len(txs) > 1:
             error_msg = 'ZarinPal: received data for authority %s' % (authority)
             if not txs:
                 error_msg += '; no order found'
             else:
                 error_msg += '; multiple order found'
-            _logger.info(error_msg)
+            _logger.info('callback.unknown_tx', authority=authority, found=len(txs))
             raise ValidationError(error_msg)
         return txs[0]
 
     def _zarinpal_form_get_invalid_parameters(self, data):
         invalid_parameters = []
-        _logger.info('Received a notification from ZarinPal with authority version %s', data.get('Authority'))
         if data.get('Status') != 'OK':
             invalid_parameters.append(('Status', data.get('Status'), 'OK'))
         return invalid_parameters
 
-    def _zarinpal_form_validate(self, data):
-        url = self.acquirer_id.zarinpal_get_rest_url_verify()
-        payload = {
-            'merchant_id': self.acquirer_id.zarinpal_merchant_id,
+    def _zarinpal_get_verify_payload(self):
+        return {
+            'merchant_id': self.acquirer_id._zarinpal_get_merchant_id(self.credential_id),
             'amount': int(self.amount),
             'authority': self.acquirer_reference,
         }
-        try:
-            custom_header = {"accept": "application/json", "content-type": "application/json'"}
-            req = requests.post(url, json=payload, headers=custom_header, timeout=15)
-            req.raise_for_status()
-            response = req.json()
-            if response['data'] and response['data']['code'] in [100, 101]:
-                if response['data'].get('card_pan', None):
-                    self.zarinpal_masked_card_number = response['data']['card_pan']
-                if response['data'].get('card_hash', None):
-                    self.zarinpal_hashed_card_number = response['data']['card_hash']
-                if response['data'].get('ref_id', None):
-                    self.zarinpal_tx_ref_id = response['data']['ref_id']
-                if response['data'].get('fee_type', None):
-                    self.zarinpal_fee_type = response['data']['fee_type']
-                if response['data'].get('fee', None):
-                    self.zarinpal_fee = response['data']['fee']
-                self._set_transaction_done()
-            elif response['errors'] and response['errors']['message']:
-                if response['errors']['validations']:
-                    raise ValidationError(f"{response['errors']['message']}, {response['errors']['validations']}")
-                else:
-                    raise ValidationError(response['errors']['message'])
+
+    @staticmethod
+    def _zarinpal_get_answer_code(response):
+        """ Return the result code of a ZarinPal answer, None when it has none. """
+        for key in ('data', 'errors'):
+            part = response.get(key) if isinstance(response, dict) else None
+            if isinstance(part, dict) and 'code' in part:
+                return part['code']
+        return None
+
+    def _zarinpal_get_verify_values(self, response):
+        """ Return the transaction values of a successful verify ``response``, raise otherwise. """
+        if response['data'] and response['data']['code'] in [100, 101]:
+            fields_map = {
+                'card_pan': 'zarinpal_masked_card_number',
+                'card_hash': 'zarinpal_hashed_card_number',
+                'ref_id': 'zarinpal_tx_ref_id',
+                'fee_type': 'zarinpal_fee_type',
+                'fee': 'zarinpal_fee',
+            }
+            return {field: response['data'][key] for key, field in fields_map.items() if response['data'].get(key, None)}
+        elif response['errors'] and response['errors']['message']:
+            if response['errors']['validations']:
+                raise ValidationError(f"{response['errors']['message']}, {response['errors']['validations']}")
             else:
-                raise ValidationError(_('Error occurred in verifying transaction from ZarinPal!'))
+                raise ValidationError(response['errors']['message'])
+        else:
+            raise ValidationError(_('Error occurred in verifying transaction from ZarinPal!'))
+
+    def _zarinpal_form_validate(self, data):
+        # browsers repeat the redirect: only one request may verify the payment
+        if not self._ir_lock():
+            _logger.info('callback.locked', tx=self.reference)
+            return True
+        if self.state != 'pending':
+            _logger.info('callback.duplicate', tx=self.reference, state=self.state)
+            return True
+        if self.acquirer_id._ir_circuit_guard().is_open():
+            # ZarinPal is known to be down: leave the transaction pending, reconciliation verifies it later
+            _logger.info('verify.deferred', tx=self.reference, reason='circuit open')
+            return True
+
+        url = self.acquirer_id.zarinpal_get_rest_url_verify()
+        payload = self._zarinpal_get_verify_payload()
+        try:
+            with self.acquirer_id._ir_deadline('callback'):
+                response = self.acquirer_id._zarinpal_post(url, payload, 'verify', self.credential_id)
+            values = self._zarinpal_get_verify_values(response)
+            self.write(values)
+            self._set_transaction_done()
+            _logger.info('tx.done', tx=self.reference, ref_id=values.get('zarinpal_tx_ref_id'), audit=True, sample=True)
+        except (GatewayUnavailable, RateLimited, DeadlineExceeded, GatewayTransportError) as e:
+            # the payment is not lost: leave the transaction pending, reconciliation verifies it later. A verify
+            # that timed out may have gone through, reconciliation also tells.
+            _logger.info('verify.deferred', tx=self.reference, reason=e)
         except Exception as e:
+            _logger.info('tx.failed', tx=self.reference, error=e.args and e.args[0], audit=True)
             self._set_transaction_error(e.args[0])
             return False
         return True
+
+    # --------------------------------------------------
+    # Reconciliation
+    # --------------------------------------------------
+
+    def _zarinpal_reconcile(self, acquirer):
+        """ Verify the pending transactions of ``self`` against ZarinPal and return the outcome counts. """
+        # payments are verified with the merchant they were made with
+        by_credential = {}
+        for tx in self:
+            by_credential[tx.credential_id] = by_credential.get(tx.credential_id, self.browse()) | tx
+        responses = {}
+        for credential, txs in by_credential.items():
+            payloads = [tx._zarinpal_get_verify_payload() for tx in txs]
+            results = gateway.run_batch(
+                acquirer._zarinpal_gateway_call(acquirer.zarinpal_get_rest_url_verify(), 'verify', credential),
+                payloads,
+                concurrency=acquirer._ir_snapshot().background_concurrency,
+            )
+            for tx, payload, response in zip(txs, payloads, results):
+                if isinstance(response, Exception):
+                    _logger.warning('reconcile.call_failed', tx=tx.reference, authority=payload['authority'], error=response)
+                    response = None
+                responses[tx] = response
+
+        stats = Counter()
+        done_txs = failed_txs = self.browse()
+        for tx in self:
+            response = responses[tx]
+            code = self._zarinpal_get_answer_code(response)
+            if code in ZARINPAL_VERIFIED_CODES:
+                values = tx._zarinpal_get_verify_values(response)
+                if values:
+                    tx.write(values)
+                done_txs |= tx
+            elif code in ZARINPAL_UNPAID_CODES:
+                _logger.info('reconcile.failed', tx=tx.reference, code=code, audit=True)
+                # pending transactions cannot be cancelled, only put in error
+                tx._set_transaction_error(_('ZarinPal did not receive the payment (code %s).') % code)
+                failed_txs |= tx
+            else:
+                # not reached, or an answer that does not tell whether the payment was made: ask again next run
+                if response is not None:
+                    _logger.warning('reconcile.unexpected_answer', tx=tx.reference, code=code)
+                stats['unchanged'] += 1
+        done_txs._set_transaction_done()
+        # only count the transactions the state machine actually moved
+        stats['done'] += len(done_txs.filtered(lambda tx: tx.state == 'done'))
+        stats['failed'] += len(failed_txs.filtered(lambda tx: tx.state == 'error'))
+        stats['unchanged'] += len(done_txs) + len(failed_txs) - stats['done'] - stats['failed']
+        return stats
+
+    # --------------------------------------------------
+    # Reconciliation report
+    # --------------------------------------------------
+
+    def _ir_reconciliation_columns(self):
+        return super(TxZarinPal, self)._ir_reconciliation_columns() + [
+            ('zarinpal_tx_ref_id', _('ZarinPal Reference'), 't.zarinpal_tx_ref_id'),
+            ('zarinpal_fee_type', _('ZarinPal Fee Type'), 't.zarinpal_fee_type'),
+            ('zarinpal_fee', _('ZarinPal Fee'), 't.zarinpal_fee'),
+        ]
+
+    def _ir_reconciliation_issues(self, row):
+        issues = super(TxZarinPal, self)._ir_reconciliation_issues(row)
+        if row['provider'] != 'zarinpal':
+            return issues
+        # ZarinPal only settles verified payments, which get a reference id
+        if row['state'] == 'done' and not row['zarinpal_tx_ref_id']:
+            issues.append('missing_settlement')
+        # the fee of the merchant is deducted from the settlement: it must be the one charged with the payment
+        if row['zarinpal_fee_type'] == 'Merchant' and row['zarinpal_fee'] is not None and \
+                float_compare(row['zarinpal_fee'], row['fees'] or 0.0, precision_rounding=row['rounding']):
+            issues.append('fee_mismatch')
+        return issues
+
+    # --------------------------------------------------
+    # Refunds
+    # --------------------------------------------------
+
+    def _zarinpal_refund_batch(self, acquirer, workers=None):
+        """ Reverse the payments of ``self`` and return ``(success, message)`` by transaction, ``success`` being
+        None when ZarinPal could not be reached.
+
+        ZarinPal only reverses payments within a short delay after they were made; older payments are reported as
+        failed with the message of ZarinPal. Payments whose reversal was sent by a run that stopped before
+        recording the answer are looked up first, so that they are never reversed twice. Reversed payments that were
+        only authorized are cancelled; done ones stay done, the refund being recorded in ``refund_state``, and their
+        accounting payment is cancelled.
+        """
+        results = {}
+        workers = workers or acquirer._ir_snapshot().background_concurrency
+        by_credential = {}
+        for tx in self:
+            by_credential[tx.credential_id] = by_credential.get(tx.credential_id, self.browse()) | tx
+        for credential, txs in by_credential.items():
+            if not acquirer._zarinpal_get_access_token(credential):
+                for tx in txs:
+                    results[tx] = (False, _('Set the access token of the ZarinPal merchant panel to reverse payments.'))
+                continue
+            payloads = {tx: {
+                'merchant_id': acquirer._zarinpal_get_merchant_id(credential),
+                'authority': tx.acquirer_reference,
+            } for tx in txs}
+
+            resumed = txs.filtered(lambda tx: tx.refund_attempts > 1)
+            if resumed:
+                answers = gateway.run_batch(
+                    acquirer._zarinpal_gateway_call(acquirer.zarinpal_get_rest_url_inquiry(), 'inquiry', credential),
+                    [payloads[tx] for tx in resumed], concurrency=workers)
+                for tx, answer in zip(resumed, answers):
+                    if not isinstance(answer, Exception) and answer.get('data') and \
+                            answer['data'].get('status') == 'REVERSED':
+                        results[tx] = (True, _('Reversed'))
+
+            to_reverse = txs.filtered(lambda tx: tx not in results)
+            answers = gateway.run_batch(
+                acquirer._zarinpal_gateway_call(acquirer.zarinpal_get_rest_url_reverse(), 'reversal', credential),
+                [payloads[tx] for tx in to_reverse], concurrency=workers)
+            for tx, answer in zip(to_reverse, answers):
+                if isinstance(answer, Exception):
+                    results[tx] = (None, str(answer))
+                elif answer.get('data') and answer['data'].get('code') == 100:
+                    results[tx] = (True, answer['data'].get('message') or _('Reversed'))
+                else:
+                    errors = answer.get('errors') or {}
+                    results[tx] = (False, '%s %s' % (errors.get('code', ''), errors.get('message', '')))
+        reversed_txs = self.browse([tx.id for tx, (success, _message) in results.items() if success])
+        reversed_txs.filtered(lambda tx: tx.state == 'authorized')._set_transaction_cancel()
+        # ZarinPal payments are done once verified, a state _set_transaction_cancel leaves as is
+        reversed_txs.filtered(lambda tx: tx.state == 'done')._ir_cancel_payments()
+        return results
+
+    @api.model
+    def _cron_zarinpal_reconcile(self, chunk_size=200):
+        """ Resolve pending ZarinPal transactions whose customer never came back from the gateway.
+
+        Transactions are walked by increasing id in chunks of ``chunk_size``, committing and clearing the
+        cache after each chunk, so that memory stays bounded whatever the number of stale transactions.
+        """
+        started = time.monotonic()
+        stats = Counter()
+        for acquirer in self.env['payment.acquirer'].search([('provider', '=', 'zarinpal')]):
+            stale = fields.Datetime.now() - timedelta(minutes=acquirer.zarinpal_reconcile_after)
+            # transactions whose authority is reused by a customer still paying are left alone
+            domain = [
+                ('acquirer_id', '=', acquirer.id),
+                ('state', '=', 'pending'),
+                ('acquirer_reference', '!=', False),
+                '|', ('zarinpal_authority_expiry', '=', False), ('zarinpal_authority_expiry', '<', stale),
+            ]
+            last_id = 0
+            while True:
+                txs = self.search(domain + [('id', '>', last_id)], order='id', limit=chunk_size)
+                if not txs:
+                    break
+                last_id = txs[-1].id
+                # a new authority may have been issued since the search
+                txs = txs._ir_lock().filtered(lambda tx: tx.state == 'pending' and (
+                    not tx.zarinpal_authority_expiry or tx.zarinpal_authority_expiry < stale))
+                stats.update(txs._zarinpal_reconcile(acquirer))
+                self._ir_commit()
+                self.invalidate_cache()
+        elapsed = time.monotonic() - started
+        total = sum(stats.values())
+        _logger.info(
+            'reconcile.done', total=total, elapsed='%.2fs' % elapsed,
+            throughput='%.1f' % (total / elapsed if elapsed else 0.0),
+            done=stats['done'], failed=stats['failed'], unchanged=stats['unchanged'])
+        return stats
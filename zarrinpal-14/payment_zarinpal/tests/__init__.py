@@ -0,0 +1,7 @@
+from . import test_callback_queries
+from . import test_duplicate_callbacks
+from . import test_fees
+from . import test_http_session
+from . import test_pay
+from . import test_reconcile
+from . import test_refund
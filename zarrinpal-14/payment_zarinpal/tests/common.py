@@ -0,0 +1,33 @@
+import datetime
+
+from odoo import fields
+
+from odoo.addons.l10n_ir_payment.tests.common import IrPaymentCommon
+
+
+class ZarinPalCommon(IrPaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super(ZarinPalCommon, cls).setUpClass()
+        cls.acquirer = cls._create_acquirer('zarinpal', zarinpal_merchant_id='00000000-0000-0000-0000-000000000000')
+        cls.Acquirer = type(cls.env['payment.acquirer'])
+
+    @classmethod
+    def _create_pending_tx(cls, **values):
+        """ Return a transaction whose authority has been issued, as the pay route leaves it. """
+        return cls._create_tx(cls.acquirer, **dict({
+            'state': 'pending',
+            'acquirer_reference': 'A%035d' % next(cls._references),
+            'zarinpal_authority_expiry': fields.Datetime.now() + datetime.timedelta(minutes=10),
+            'zarinpal_authority_amount': 100000.0,
+        }, **values))
+
+    @staticmethod
+    def _verify_answer(code=100, ref_id=201):
+        return {
+            'data': {'code': code, 'message': 'Verified', 'ref_id': ref_id, 'card_pan': '502229******5995',
+                     'card_hash': '1EBE3EBEBE35C7EC0F8D6EE4F2F859107A87822CA179BC9528767EA7B5489B69',
+                     'fee_type': 'Merchant', 'fee': 0},
+            'errors': [],
+        }
@@ -0,0 +1,29 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+from odoo.tests.common import warmup
+
+from odoo.addons.payment_zarinpal.tests.common import ZarinPalCommon
+
+
+@tagged('post_install', '-at_install')
+class TestCallbackQueries(ZarinPalCommon):
+    """ The callback resolves its transaction with a single indexed lookup, then verifies it. The counts are
+    ceilings: ``assertQueryCount`` only fails when more queries are made. """
+
+    @warmup
+    def test_callback_queries(self):
+        tx = self._create_pending_tx()
+        data = {'Authority': tx.acquirer_reference, 'Status': 'OK'}
+        with patch.object(self.Acquirer, '_zarinpal_post', return_value=self._verify_answer()), \
+                self.assertQueryCount(12):
+            self.env['payment.transaction'].form_feedback(data, 'zarinpal')
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.zarinpal_tx_ref_id, '201')
+
+    def test_lookup_is_a_single_query(self):
+        tx = self._create_pending_tx()
+        with self.assertQueryCount(1):
+            found = self.env['payment.transaction']._zarinpal_form_get_tx_from_data(
+                {'Authority': tx.acquirer_reference, 'Status': 'OK'})
+        self.assertEqual(found, tx)
@@ -0,0 +1,18 @@
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from odoo.addons.payment_zarinpal.tests.common import ZarinPalCommon
+
+
+@tagged('post_install', '-at_install')
+class TestDuplicateCallbacks(ZarinPalCommon):
+
+    def test_repeated_redirect_verifies_once(self):
+        tx = self._create_pending_tx()
+        data = {'Authority': tx.acquirer_reference, 'Status': 'OK'}
+        with patch.object(self.Acquirer, '_zarinpal_post', return_value=self._verify_answer()) as post:
+            self.env['payment.transaction'].form_feedback(data, 'zarinpal')
+            self.env['payment.transaction'].form_feedback(data, 'zarinpal')
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(tx.state, 'done')
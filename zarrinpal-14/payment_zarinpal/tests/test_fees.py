@@ -0,0 +1,36 @@
+from unittest.mock import patch
+
+from odoo.tests import common, tagged
+
+from odoo.addons.payment_zarinpal import fees
+
+
+@tagged('post_install', '-at_install')
+class TestFeeSchedule(common.BaseCase):
+
+    def setUp(self):
+        super(TestFeeSchedule, self).setUp()
+        self.schedule = fees.FeeSchedule(active=True, percentage=1.5, upper_limit=40000.0)
+        self.amounts = [0, 1, 999, 100000, 1234567, 5000000] * fees.NUMPY_MIN_SIZE
+
+    def test_compute(self):
+        self.assertEqual(self.schedule.compute(1234567), 18518.0)
+        self.assertIsInstance(self.schedule.compute(1234567), float)
+        # capped
+        self.assertEqual(self.schedule.compute(5000000), 40000.0)
+        self.assertEqual(fees.FeeSchedule().compute(5000000), 0.0)
+
+    def _check_batch(self):
+        batch = self.schedule.compute_batch(self.amounts)
+        scalar = [self.schedule.compute(amount) for amount in self.amounts]
+        self.assertEqual(batch, scalar)
+        self.assertEqual({type(fee) for fee in batch}, {float})
+
+    def test_batch_without_numpy(self):
+        with patch.object(fees, 'load_numpy', return_value=None):
+            self._check_batch()
+
+    def test_batch_with_numpy(self):
+        if fees.load_numpy() is None:
+            self.skipTest('numpy is not installed')
+        self._check_batch()
@@ -0,0 +1,52 @@
+from odoo.tests import common, tagged
+
+from odoo.addons.l10n_ir_payment import deadline
+from odoo.addons.payment_zarinpal.http_session import SessionRegistry
+from odoo.addons.payment_zarinpal.tests.common import ZarinPalCommon
+
+
+@tagged('post_install', '-at_install')
+class TestSessionRegistry(common.BaseCase):
+
+    def test_verify_retries_post(self):
+        registry = SessionRegistry()
+        verify_url = 'https://payment.zarinpal.com/pg/v4/payment/verify.json'
+        session = registry.get('acquirer', retries=2, retry_urls=[verify_url])
+        try:
+            retry = session.get_adapter(verify_url).max_retries
+            methods = getattr(retry, 'allowed_methods', None) or retry.method_whitelist
+            self.assertIn('POST', methods)
+            self.assertEqual(retry.total, 2)
+            # payment requests are not idempotent
+            request_url = 'https://payment.zarinpal.com/pg/v4/payment/request.json'
+            self.assertEqual(session.get_adapter(request_url).max_retries.total, 0)
+        finally:
+            registry.clear()
+
+    def test_settings_change_rebuilds_session(self):
+        registry = SessionRegistry()
+        try:
+            session = registry.get('acquirer', pool_size=4)
+            self.assertIs(registry.get('acquirer', pool_size=4), session)
+            self.assertIsNot(registry.get('acquirer', pool_size=8), session)
+        finally:
+            registry.clear()
+
+
+@tagged('post_install', '-at_install')
+class TestVerifyRetries(ZarinPalCommon):
+
+    def _verify_retries(self):
+        url = self.acquirer.zarinpal_get_rest_url_verify()
+        call = self.acquirer._zarinpal_gateway_call(url, 'verify')
+        return call.session.get_adapter(url).max_retries.total, call.retries
+
+    def test_verify_is_retried_without_budget(self):
+        retries = self.acquirer._ir_snapshot().verify_retries
+        self.assertTrue(retries)
+        self.assertEqual(self._verify_retries(), (retries, retries))
+
+    def test_verify_is_not_retried_within_a_budget(self):
+        # every attempt would get the whole time left
+        with deadline.budget(20):
+            self.assertEqual(self._verify_retries(), (0, 0))
@@ -0,0 +1,103 @@
+from unittest.mock import patch
+
+from odoo.exceptions import ValidationError
+from odoo.tests import HttpCase, tagged
+
+from odoo.addons.l10n_ir_payment.gateway import GatewayTransportError, RetryLater
+from odoo.addons.payment_zarinpal.tests.common import ZarinPalCommon
+
+AUTHORITY = 'A00000000000000000000000000000000001'
+
+
+def request_answer(authority=AUTHORITY):
+    return {'data': {'code': 100, 'message': 'Success', 'authority': authority, 'fee_type': 'Merchant', 'fee': 100},
+            'errors': []}
+
+
+@tagged('post_install', '-at_install')
+class TestPay(ZarinPalCommon):
+
+    def setUp(self):
+        super(TestPay, self).setUp()
+        patcher = patch.object(type(self.env['payment.transaction']), '_zarinpal_get_document_name',
+                               return_value='INV/2021/0001')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_authority_is_reused(self):
+        tx = self._create_tx(self.acquirer)
+        with patch.object(self.Acquirer, '_zarinpal_post', return_value=request_answer()) as post:
+            self.assertEqual(tx._zarinpal_issue_authority(), AUTHORITY)
+            self.assertEqual(tx._zarinpal_issue_authority(), AUTHORITY)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(tx.state, 'pending')
+
+    def test_authority_of_another_amount_is_not_reused(self):
+        tx = self._create_pending_tx()
+        tx.amount = 200000.0
+        other = 'A00000000000000000000000000000000002'
+        with patch.object(self.Acquirer, '_zarinpal_post', return_value=request_answer(other)) as post:
+            self.assertEqual(tx._zarinpal_issue_authority(), other)
+        self.assertEqual(post.call_count, 1)
+        self.assertEqual(tx.zarinpal_authority_amount, 200000.0)
+
+    def test_unreachable_gateway_may_be_retried(self):
+        tx = self._create_tx(self.acquirer)
+        with patch.object(self.Acquirer, '_zarinpal_post', side_effect=GatewayTransportError('timed out')), \
+                self.assertRaises(RetryLater):
+            tx._zarinpal_issue_authority()
+        self.assertEqual(tx.state, 'draft')
+        self.assertFalse(tx.acquirer_reference)
+
+    def test_refused_payment(self):
+        tx = self._create_tx(self.acquirer)
+        refused = {'data': [], 'errors': {'code': -11, 'message': 'Terminal is not active.', 'validations': []}}
+        with patch.object(self.Acquirer, '_zarinpal_post', return_value=refused), \
+                self.assertRaises(ValidationError) as error:
+            tx._zarinpal_issue_authority()
+        self.assertNotIsInstance(error.exception, RetryLater)
+
+
+@tagged('post_install', '-at_install')
+class TestPayRoute(HttpCase):
+
+    def setUp(self):
+        super(TestPayRoute, self).setUp()
+        self.env.ref('base.IRR').active = True
+        acquirer = self.env['payment.acquirer'].create({
+            'name': 'Test zarinpal',
+            'provider': 'zarinpal',
+            'state': 'test',
+            'zarinpal_merchant_id': '00000000-0000-0000-0000-000000000000',
+        })
+        self.tx = self.env['payment.transaction'].create({
+            'acquirer_id': acquirer.id,
+            'amount': 100000.0,
+            'currency_id': self.env.ref('base.IRR').id,
+            'partner_id': self.env['res.partner'].create({'name': 'Payment Test'}).id,
+            'reference': 'IR-TEST-ROUTE',
+        })
+        self.Acquirer = type(self.env['payment.acquirer'])
+        patcher = patch.object(type(self.env['payment.transaction']), '_zarinpal_get_document_name',
+                               return_value='INV/2021/0001')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _pay(self):
+        return self.url_open('/payment/zarinpal/pay?reference=%s&token=%s' % (
+            self.tx.reference, self.tx._ir_get_pay_token()), allow_redirects=False)
+
+    def test_unreachable_gateway_leaves_the_payment_as_is(self):
+        with patch.object(self.Acquirer, '_zarinpal_post', side_effect=GatewayTransportError('timed out')):
+            response = self._pay()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ZarinPal could not be reached', response.text)
+        self.tx.invalidate_cache()
+        self.assertEqual(self.tx.state, 'draft')
+
+    def test_refused_payment_is_an_error(self):
+        refused = {'data': [], 'errors': {'code': -11, 'message': 'Terminal is not active.', 'validations': []}}
+        with patch.object(self.Acquirer, '_zarinpal_post', return_value=refused):
+            self._pay()
+        self.tx.invalidate_cache()
+        self.assertEqual(self.tx.state, 'error')
@@ -0,0 +1,63 @@
+import datetime
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import tagged
+
+from odoo.addons.payment_zarinpal.tests.common import ZarinPalCommon
+
+
+@tagged('post_install', '-at_install')
+class TestReconcile(ZarinPalCommon):
+
+    def _reconcile(self, tx, answer):
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=lambda call, payloads, **kw: [answer]):
+            return tx._zarinpal_reconcile(self.acquirer)
+
+    def test_verified(self):
+        tx = self._create_pending_tx()
+        stats = self._reconcile(tx, self._verify_answer(code=101))
+        self.assertEqual(stats['done'], 1)
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.zarinpal_tx_ref_id, '201')
+
+    def test_unpaid_is_failed(self):
+        tx = self._create_pending_tx()
+        stats = self._reconcile(tx, {'data': [], 'errors': {'code': -51, 'message': 'Session is not active', 'validations': []}})
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(tx.state, 'error')
+        self.assertIn('-51', tx.state_message)
+
+    def test_only_state_changes_are_counted(self):
+        tx = self._create_pending_tx()
+        # done in the meantime, e.g. by a callback: neither done again nor put in error
+        tx._set_transaction_done()
+        stats = self._reconcile(tx, {'data': [], 'errors': {'code': -51, 'message': 'Session is not active', 'validations': []}})
+        self.assertFalse(stats['failed'])
+        self.assertEqual(stats['unchanged'], 1)
+        self.assertEqual(tx.state, 'done')
+
+    def test_unclear_answers_leave_the_payment_pending(self):
+        for answer in (None, {}, {'data': []}, 'Bad Gateway', {'errors': {'code': -12, 'message': 'Too many attempts'}}):
+            tx = self._create_pending_tx()
+            stats = self._reconcile(tx, answer)
+            self.assertEqual(stats['unchanged'], 1, answer)
+            self.assertEqual(tx.state, 'pending', answer)
+
+    def test_expired_authority_is_reconciled(self):
+        tx = self._create_pending_tx(zarinpal_authority_expiry=fields.Datetime.now() - datetime.timedelta(minutes=90))
+        unpaid = {'data': [], 'errors': {'code': -51, 'message': 'Session is not active', 'validations': []}}
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=lambda call, payloads, **kw: [unpaid]):
+            stats = self.env['payment.transaction']._cron_zarinpal_reconcile()
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(tx.state, 'error')
+
+    def test_old_payment_with_a_valid_authority_is_left_alone(self):
+        tx = self._create_pending_tx()
+        # created long ago, its authority was issued again a moment ago for a customer now paying
+        self.env.cr.execute("UPDATE payment_transaction SET create_date = create_date - interval '1 day' WHERE id = %s",
+                            [tx.id])
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch') as run_batch:
+            self.env['payment.transaction']._cron_zarinpal_reconcile()
+        run_batch.assert_not_called()
+        self.assertEqual(tx.state, 'pending')
@@ -0,0 +1,82 @@
+import datetime
+import io
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.exceptions import UserError
+from odoo.tests import tagged
+
+from odoo.addons.payment_zarinpal.tests.common import ZarinPalCommon
+
+
+@tagged('post_install', '-at_install')
+class TestRefund(ZarinPalCommon):
+
+    def setUp(self):
+        super(TestRefund, self).setUp()
+        self.calls = []
+
+    def _refund(self, txs, answer):
+        def run_batch(call, payloads, **kw):
+            self.calls.append((call, payloads))
+            return [answer for _payload in payloads]
+        with patch('odoo.addons.l10n_ir_payment.gateway.run_batch', side_effect=run_batch):
+            return txs.ir_bulk_refund()
+
+    def _create_paid_tx(self):
+        if not self.acquirer.journal_id:
+            self.acquirer.journal_id = self.env['account.journal'].search([
+                ('type', '=', 'bank'), ('company_id', '=', self.acquirer.company_id.id)], limit=1)
+        tx = self._create_pending_tx()
+        tx._set_transaction_done()
+        tx._create_payment()
+        self.assertEqual(tx.payment_id.state, 'posted')
+        return tx
+
+    def _reconciliation_issues(self):
+        today = fields.Date.today()
+        return self.env['payment.transaction'].ir_reconciliation_report(
+            io.BytesIO(), today - datetime.timedelta(days=1), today + datetime.timedelta(days=1),
+            acquirer_ids=self.acquirer.ids)
+
+    def test_reversed_payment_is_refunded(self):
+        self.acquirer.zarinpal_access_token = 'panel-token'
+        tx = self._create_paid_tx()
+        report = self._refund(tx, {'data': {'code': 100, 'message': 'Reversed'}, 'errors': []})
+        self.assertEqual(report['done'], 1)
+        self.assertEqual(tx.refund_state, 'done')
+        # the transaction stays done, its accounting payment is cancelled
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.payment_id.state, 'cancel')
+        self.assertFalse(self._reconciliation_issues()['refund_not_booked'])
+        [(call, payloads)] = self.calls
+        self.assertEqual(call.method, 'reversal')
+        self.assertEqual(call.headers, {'Authorization': 'Bearer panel-token'})
+        self.assertEqual(payloads, [{'merchant_id': self.acquirer.zarinpal_merchant_id, 'authority': tx.acquirer_reference}])
+
+    def test_refund_with_a_posted_payment_is_reported(self):
+        self.acquirer.zarinpal_access_token = 'panel-token'
+        tx = self._create_paid_tx()
+        payment_class = type(self.env['account.payment'])
+        with patch.object(payment_class, 'action_draft', side_effect=UserError('Locked period')):
+            self._refund(tx, {'data': {'code': 100, 'message': 'Reversed'}, 'errors': []})
+        self.assertEqual(tx.refund_state, 'done')
+        self.assertEqual(tx.payment_id.state, 'posted')
+        self.assertEqual(self._reconciliation_issues()['refund_not_booked'], 1)
+
+    def test_refused_reversal_keeps_the_payment(self):
+        self.acquirer.zarinpal_access_token = 'panel-token'
+        tx = self._create_pending_tx()
+        tx._set_transaction_done()
+        report = self._refund(tx, {'data': [], 'errors': {'code': -62, 'message': 'Reversal time is over'}})
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(tx.refund_state, 'failed')
+        self.assertEqual(tx.state, 'done')
+
+    def test_no_reversal_without_access_token(self):
+        tx = self._create_pending_tx()
+        tx._set_transaction_done()
+        report = self._refund(tx, {'data': {'code': 100, 'message': 'Reversed'}, 'errors': []})
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(tx.state, 'done')
+        self.assertFalse(self.calls)
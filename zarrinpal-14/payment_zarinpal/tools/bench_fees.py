@@ -0,0 +1,64 @@
+"""Micro-benchmark of the ZarinPal fee quotation.
+
+Compares quoting the fees of many amounts one call at a time with the batch
+quotation, and checks that both give the same fees::
+
+    python bench_fees.py --amounts 1000 --repeat 200 --percentage 1 --upper-limit 30000
+
+Runs without Odoo: it only loads ``fees.py`` of the module.
+"""
+import argparse
+import importlib.util
+import os
+import random
+import time
+
+
+def load_fees():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fees.py')
+    spec = importlib.util.spec_from_file_location('zarinpal_fees', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench(func, repeat):
+    best = None
+    for _i in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--amounts', type=int, default=1000, help='amounts quoted per run')
+    parser.add_argument('--repeat', type=int, default=200, help='runs of each path, the best one is reported')
+    parser.add_argument('--percentage', type=float, default=1.0)
+    parser.add_argument('--upper-limit', type=float, default=30000.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    fees = load_fees()
+    schedule = fees.FeeSchedule(active=True, percentage=args.percentage, upper_limit=args.upper_limit)
+    rng = random.Random(args.seed)
+    # whole rials as well as fractional amounts, below and above the cap
+    amounts = [rng.choice([rng.randint(1000, 50000000), rng.uniform(1000, 50000000)]) for _i in range(args.amounts)]
+
+    scalar = [schedule.compute(amount) for amount in amounts]
+    batch = schedule.compute_batch(amounts)
+    mismatches = [(amount, a, b) for amount, a, b in zip(amounts, scalar, batch) if a != b or type(a) is not type(b)]
+    if mismatches:
+        raise SystemExit('batch and scalar fees differ for %d amounts, e.g. %r' % (len(mismatches), mismatches[:5]))
+
+    scalar_time = bench(lambda: [schedule.compute(amount) for amount in amounts], args.repeat)
+    batch_time = bench(lambda: schedule.compute_batch(amounts), args.repeat)
+    print('numpy:  %s' % ('yes' if fees.load_numpy() else 'no, pure Python fallback'))
+    print('scalar: %8.1f us per %d amounts' % (scalar_time * 1e6, len(amounts)))
+    print('batch:  %8.1f us per %d amounts (x%.1f)' % (batch_time * 1e6, len(amounts), scalar_time / batch_time))
+
+
+if __name__ == '__main__':
+    main()
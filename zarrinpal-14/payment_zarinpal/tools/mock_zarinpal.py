@@ -0,0 +1,169 @@
+"""Local stand-in for the ZarinPal v4 REST gateway.
+
+Serves ``/pg/v4/payment/request.json``, ``verify.json``, ``reverse.json``,
+``inquiry.json`` and the ``/pg/StartPay/<authority>`` payment page, which immediately sends the customer
+back to the callback url as if the payment had succeeded. Latency, error codes
+and failure rates are configurable so that the acquirer can be benchmarked
+without reaching the real gateway::
+
+    python mock_zarinpal.py --port 8801 --latency 120 --jitter 40 --error-rate 0.02
+
+Point the acquirer to it with API URL ``http://127.0.0.1:8801/pg/v4/payment/``
+and Payment Page URL ``http://127.0.0.1:8801/pg/StartPay/``.
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode
+
+_logger = logging.getLogger(__name__)
+
+
+class MockSettings(object):
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_code=-9, failure_rate=0.0, verify_code=100):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.failure_rate = failure_rate
+        self.verify_code = verify_code
+
+
+class MockZarinPalHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        _logger.debug(format, *args)
+
+    def _wait(self):
+        settings = self.server.settings
+        delay = settings.latency + random.uniform(-settings.jitter, settings.jitter)
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def _send_json(self, status, body):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _error(self, code, message):
+        return {'data': [], 'errors': {'code': code, 'message': message, 'validations': []}}
+
+    def do_POST(self):
+        settings = self.server.settings
+        payload = self._read_json()
+        self._wait()
+        if random.random() < settings.failure_rate:
+            return self._send_json(503, {'message': 'Service Unavailable'})
+        if random.random() < settings.error_rate:
+            return self._send_json(200, self._error(settings.error_code, 'Mock error'))
+
+        if self.path.endswith('/request.json'):
+            authority = 'A' + uuid.uuid4().hex[:35].upper()
+            with self.server.lock:
+                self.server.payments[authority] = payload
+            return self._send_json(200, {
+                'data': {'code': 100, 'message': 'Success', 'authority': authority, 'fee_type': 'Merchant', 'fee': 100},
+                'errors': [],
+            })
+        if self.path.endswith('/verify.json'):
+            with self.server.lock:
+                request_payload = self.server.payments.get(payload.get('authority'))
+            if not request_payload:
+                return self._send_json(200, self._error(-54, 'Invalid authority.'))
+            if int(request_payload.get('amount', 0)) != int(payload.get('amount', 0)):
+                return self._send_json(200, self._error(-50, 'Session is not valid, amounts values is not the same.'))
+            return self._send_json(200, {
+                'data': {
+                    'code': settings.verify_code,
+                    'message': 'Verified',
+                    'card_hash': uuid.uuid4().hex.upper(),
+                    'card_pan': '502229******5995',
+                    'ref_id': random.randint(10 ** 8, 10 ** 9),
+                    'fee_type': 'Merchant',
+                    'fee': 100,
+                },
+                'errors': [],
+            })
+        if self.path.endswith('/reverse.json') and not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self._send_json(401, {'message': 'Unauthenticated.'})
+        if self.path.endswith('/reverse.json') or self.path.endswith('/inquiry.json'):
+            with self.server.lock:
+                request_payload = self.server.payments.get(payload.get('authority'))
+                if request_payload is None:
+                    return self._send_json(200, self._error(-54, 'Invalid authority.'))
+                if self.path.endswith('/inquiry.json'):
+                    status = 'REVERSED' if request_payload.get('reversed') else 'VERIFIED'
+                    return self._send_json(200, {'data': {'code': 100, 'message': 'Success', 'status': status}, 'errors': []})
+                if request_payload.get('reversed'):
+                    return self._send_json(200, self._error(-63, 'Session is already reversed.'))
+                request_payload['reversed'] = True
+            return self._send_json(200, {'data': {'code': 100, 'message': 'Reversed'}, 'errors': []})
+        return self._send_json(404, {'message': 'Not Found'})
+
+    def do_GET(self):
+        # payment page: the customer pays at once and is sent back to the shop
+        if '/StartPay/' in self.path:
+            authority = self.path.rsplit('/', 1)[-1]
+            with self.server.lock:
+                payload = self.server.payments.get(authority)
+            if not payload:
+                return self._send_json(404, {'message': 'Unknown authority'})
+            location = '%s?%s' % (payload['callback_url'], urlencode({'Authority': authority, 'Status': 'OK'}))
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        return self._send_json(404, {'message': 'Not Found'})
+
+
+def make_server(host='127.0.0.1', port=8801, settings=None):
+    """ Build the mock server; call ``serve_forever`` on it, or use :func:`start_in_thread`. """
+    server = ThreadingHTTPServer((host, port), MockZarinPalHandler)
+    server.daemon_threads = True
+    server.settings = settings or MockSettings()
+    server.payments = {}
+    server.lock = threading.Lock()
+    return server
+
+
+def start_in_thread(host='127.0.0.1', port=0, settings=None):
+    server = make_server(host, port, settings)
+    thread = threading.Thread(target=server.serve_forever, name='mock-zarinpal', daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8801)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response latency, in milliseconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency jitter, in milliseconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answered with a gateway error')
+    parser.add_argument('--error-code', type=int, default=-9, help='gateway error code returned for those calls')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of calls answered with HTTP 503')
+    parser.add_argument('--verify-code', type=int, default=100, help='code returned by successful verify calls')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    settings = MockSettings(args.latency, args.jitter, args.error_rate, args.error_code, args.failure_rate, args.verify_code)
+    server = make_server(args.host, args.port, settings)
+    _logger.info('Mock ZarinPal listening on http://%s:%s', args.host, server.server_port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()